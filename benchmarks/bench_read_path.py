@@ -0,0 +1,63 @@
+"""
+Benchmark the ORM read path against the Core record read path
+
+Loads 10k customers with two addresses each and measures the CPU time and
+peak Python memory of listing them through the ORM and through
+service.queries. Run from the repository root with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_read_path
+"""
+import logging
+import time
+import tracemalloc
+from service import app
+from service.models import db, Customer, Address
+from service.queries import find_customers
+
+ROWS = 10000
+
+logging.disable(logging.CRITICAL)
+
+
+def populate(rows):
+    """ Inserts rows customers with two addresses each """
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Customer.__table__.insert(), [
+        {"id": i, "username": "user%d" % i, "password": "secret",
+         "first_name": "First%d" % (i % 100), "last_name": "Last%d" % (i % 1000),
+         "locked": False}
+        for i in range(1, rows + 1)
+    ])
+    db.session.execute(Address.__table__.insert(), [
+        {"customer_id": i, "street_address": "%d Main Street" % j, "city": "New York",
+         "state": "NY", "zipcode": "10001", "country": "United States"}
+        for i in range(1, rows + 1) for j in range(2)
+    ])
+    db.session.commit()
+
+
+def orm_read():
+    """ The read path before service.queries: ORM objects plus lazy addresses """
+    customers = Customer.query.options(db.selectinload(Customer.addresses)).all()
+    return [(customer, list(customer.addresses)) for customer in customers]
+
+
+def measure(name, func):
+    """ Prints the CPU time and peak memory of func """
+    db.session.remove()
+    tracemalloc.start()
+    start = time.process_time()
+    func()
+    elapsed = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-8s %8.1f ms CPU %8.1f MiB peak per %d rows"
+          % (name, elapsed * 1000, peak / 2 ** 20, ROWS))
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        populate(ROWS)
+        measure("orm", orm_read)
+        measure("records", find_customers)
+        db.drop_all()
@@ -19,6 +19,107 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Tune SQLite databases (WAL, synchronous=NORMAL, mmap) for single node deployments
+SQLITE_TUNED = os.getenv("SQLITE_TUNED", "True").lower() == "true"
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 2 ** 20)))
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+# Connections kept open by the pool of the SQLite engine
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "32"))
+
+# Where the customers are stored: sql, memory or sharded
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sql")
+# The shards of the sharded backend, a comma separated list of database URIs
+SHARD_DATABASE_URIS = [uri for uri in os.getenv("SHARD_DATABASE_URIS", "").split(",") if uri]
+
+# Read replicas serving GET requests, a comma separated list of database URIs
+REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+SQLALCHEMY_BINDS = {"replica_{}".format(i): uri for i, uri in enumerate(REPLICA_URIS)}
+REPLICA_BINDS = list(SQLALCHEMY_BINDS)
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "10"))
+REPLICA_CHECK_TIMEOUT = float(os.getenv("REPLICA_CHECK_TIMEOUT", "1"))
+READ_YOUR_WRITES_SECONDS = int(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Change feed page sizes, and how old a change must be before it is served
+# (younger changes may still be committing out of order)
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "100"))
+CHANGES_MAX_PAGE_SIZE = int(os.getenv("CHANGES_MAX_PAGE_SIZE", "1000"))
+CHANGES_SETTLE_SECONDS = float(os.getenv("CHANGES_SETTLE_SECONDS", "2"))
+
+# Record domain events in the outbox table and publish them to OUTBOX_SINK
+# (stdout, file:/path/events.jsonl or a webhook URL)
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "False").lower() == "true"
+OUTBOX_PUBLISHER = os.getenv("OUTBOX_PUBLISHER", "False").lower() == "true"
+OUTBOX_SINK = os.getenv("OUTBOX_SINK", "stdout")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "60"))
+
+# The most customers a single POST /customers:batchGet may ask for
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "500"))
+
+# Cache customer reads in every worker, invalidated across the workers with
+# Postgres LISTEN/NOTIFY on CACHE_CHANNEL (see service.cache)
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "False").lower() == "true"
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+CACHE_CHANNEL = os.getenv("CACHE_CHANNEL", "customers_changed")
+# Cached customer list results (0 disables), results above QUERY_CACHE_MAX_ROWS are not kept
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1000"))
+QUERY_CACHE_MAX_ROWS = int(os.getenv("QUERY_CACHE_MAX_ROWS", "1000"))
+# Remembered ids of missing customers (0 disables) and for how many seconds
+NEGATIVE_CACHE_SIZE = int(os.getenv("NEGATIVE_CACHE_SIZE", "10000"))
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "30"))
+# Let concurrent requests of a worker for the same customer share one read
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "True").lower() == "true"
+
+# Answer username availability checks from a Bloom filter of the usernames
+# sized for USERNAME_FILTER_CAPACITY names at a USERNAME_FILTER_ERROR_RATE false positive rate
+USERNAME_FILTER = os.getenv("USERNAME_FILTER", "False").lower() == "true"
+USERNAME_FILTER_CAPACITY = int(os.getenv("USERNAME_FILTER_CAPACITY", "1000000"))
+USERNAME_FILTER_ERROR_RATE = float(os.getenv("USERNAME_FILTER_ERROR_RATE", "0.01"))
+# Autocomplete usernames from a sorted in-memory index of at most
+# USERNAME_INDEX_MAX_USERNAMES names, about len(username) + 4 bytes each and
+# about 150 bytes each while it is built in the background (see service.usernames)
+USERNAME_INDEX = os.getenv("USERNAME_INDEX", "False").lower() == "true"
+USERNAME_INDEX_MAX_USERNAMES = int(os.getenv("USERNAME_INDEX_MAX_USERNAMES", "10000000"))
+USERNAME_INDEX_MERGE_AT = int(os.getenv("USERNAME_INDEX_MERGE_AT", "10000"))
+AUTOCOMPLETE_LIMIT = int(os.getenv("AUTOCOMPLETE_LIMIT", "10"))
+AUTOCOMPLETE_MAX_LIMIT = int(os.getenv("AUTOCOMPLETE_MAX_LIMIT", "100"))
+
+# The largest page of the customer list
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", "1000"))
+# X-Total-Count of unfiltered lists is estimated from the table statistics
+# of Postgres, unless it estimates fewer rows than this and counting is cheap
+EXACT_COUNT_BELOW = int(os.getenv("EXACT_COUNT_BELOW", "10000"))
+# Pages of the q= customer search, and the least trigram similarity of a
+# misspelled word in the in-process search of databases other than Postgres
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "100"))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "1000"))
+SEARCH_SIMILARITY = float(os.getenv("SEARCH_SIMILARITY", "0.3"))
+
+# Let Postgres build the customer JSON documents for GET requests
+JSON_AGGREGATION = os.getenv("JSON_AGGREGATION", "False").lower() == "true"
+# Keep the serialized document of every customer in the customer_document
+# table, rewritten in the transaction of each write, and serve the GET requests
+# from it with READ_MODEL_READS (run `flask rebuild-read-model` before turning
+# the reads on for existing customers, `flask check-read-model` compares them)
+READ_MODEL = os.getenv("READ_MODEL", "False").lower() == "true"
+READ_MODEL_READS = os.getenv("READ_MODEL_READS", "False").lower() == "true"
+
+# Keep the customer statistics rolled up in customer_stats and region_stats by
+# every write, at the cost of an upsert per write and a count of the other
+# addresses of the customer per address write. Without it /customers/stats
+# counts the customers on every request (run `flask rebuild-stats` before
+# turning it on for existing customers)
+STATS_ROLLUPS = os.getenv("STATS_ROLLUPS", "False").lower() == "true"
+
+# Compress responses larger than COMPRESS_MIN_SIZE bytes (gzip/brotli/zstd)
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "True").lower() == "true"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1400"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
 
@@ -0,0 +1,664 @@
+"""
+Per worker caching of customer reads
+
+Every gunicorn worker keeps its own CustomerCache of the customers it served
+recently, so a cached read costs no database round trip and needs no cache
+server. The catch is that another worker may handle the write that makes an
+entry stale, which is what the invalidation bus below takes care of.
+
+With CACHE_ENABLED the write paths of service.models call publish_change()
+with the id of the changed Customer inside their transaction. On Postgres
+this runs NOTIFY on the CACHE_CHANNEL channel, which Postgres only delivers
+once the transaction commits, to every listening connection. Each worker runs
+an InvalidationListener thread that LISTENs on the channel and evicts the
+notified customers from the local caches. Notifications sent while the
+listener was disconnected are lost, so after every reconnect it flushes the
+local caches completely before trusting the channel again. A worker waits
+for the first LISTEN before it scans the usernames for its filter and index.
+If the listener does not connect in time, its first connect flushes as well.
+
+The committing worker also evicts its own entries right after the commit so
+it reads its own writes without waiting for the listener, which is all a
+database without LISTEN/NOTIFY (SQLite on a single node) needs.
+
+The QueryCache keeps the results of the customer list filters. It does not
+track which customers a result holds, any change retires all its entries.
+
+The NegativeCache remembers for a few seconds the ids of customers that do
+not exist, so clients polling unknown ids get their 404 without a query.
+Creating a customer notifies its id like any other change.
+
+SingleFlight lets concurrent requests of a worker for the same customer
+share one database read, which matters most right after a popular entry
+expired or was evicted.
+"""
+import copy
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, text
+from service.replicas import RoutingSession
+
+logger = logging.getLogger("flask.app")
+
+CHANGED_CUSTOMERS = "changed_customers"
+TAKEN_USERNAMES = "taken_usernames"
+RELEASED_USERNAMES = "released_usernames"
+USERNAME_PREFIX = "username:"
+RELEASED_PREFIX = "released:"
+NOTIFY_QUERY = text("SELECT pg_notify(:channel, :payload)")
+
+
+######################################################################
+#  I N V A L I D A T I O N   B U S
+######################################################################
+
+class InvalidationBus:
+    """ Hands the changed customer ids of this worker to the local caches """
+
+    def __init__(self):
+        self._subscribers = []
+        self._username_subscribers = []
+        self._release_subscribers = []
+        self.changes = 0
+        self.flushes = 0
+
+    def subscribe(self, evict, flush):
+        """
+        Registers a local cache
+
+        Args:
+            evict (function): called with the id of every changed Customer
+            flush (function): called when changes may have been missed
+        """
+        self._subscribers.append((evict, flush))
+
+    def subscribe_usernames(self, add, remove=None):
+        """
+        Registers a local username index
+
+        Args:
+            add (function): called with every new username
+            remove (function): called with the usernames of deleted and
+                renamed customers
+        """
+        self._username_subscribers.append(add)
+        if remove is not None:
+            self._release_subscribers.append(remove)
+
+    def changed(self, customer_id):
+        """ Evicts a changed Customer from every local cache """
+        self.changes += 1
+        for evict, _ in self._subscribers:
+            evict(customer_id)
+
+    def username_taken(self, username):
+        """ Hands a new username to the local username indexes """
+        for add in self._username_subscribers:
+            add(username)
+
+    def username_released(self, username):
+        """ Removes a username that is no longer used from the local username indexes """
+        for remove in self._release_subscribers:
+            remove(username)
+
+    def flush(self):
+        """ Empties every local cache """
+        self.flushes += 1
+        for _, flush in self._subscribers:
+            flush()
+
+    def dispatch(self, payload):
+        """ Applies the payload of a notification """
+        if payload and payload.startswith(USERNAME_PREFIX):
+            self.username_taken(payload[len(USERNAME_PREFIX):])
+            return
+        if payload and payload.startswith(RELEASED_PREFIX):
+            self.username_released(payload[len(RELEASED_PREFIX):])
+            return
+        try:
+            customer_id = int(payload)
+        except (TypeError, ValueError):
+            logger.warning("Unexpected cache notification %r, flushing", payload)
+            self.flush()
+            return
+        self.changed(customer_id)
+
+
+bus = InvalidationBus()
+
+
+def publish_change(session, customer_id, channel):
+    """ Invalidates a Customer in every worker once the session commits """
+    if customer_id is None:
+        return
+    session.info.setdefault(CHANGED_CUSTOMERS, set()).add(customer_id)
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(NOTIFY_QUERY, {"channel": channel, "payload": str(customer_id)})
+
+
+def publish_username(session, username, channel, released=False):
+    """ Announces a new or no longer used username to every worker once the session commits """
+    key, prefix = (RELEASED_USERNAMES, RELEASED_PREFIX) if released else \
+        (TAKEN_USERNAMES, USERNAME_PREFIX)
+    session.info.setdefault(key, set()).add(username)
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(NOTIFY_QUERY, {"channel": channel, "payload": prefix + username})
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _evict_committed(session):
+    """ Evicts the committed changes from the caches of this worker """
+    for customer_id in session.info.pop(CHANGED_CUSTOMERS, ()):
+        bus.changed(customer_id)
+    # a username freed and taken again by the same transaction stays taken
+    for username in session.info.pop(RELEASED_USERNAMES, ()):
+        bus.username_released(username)
+    for username in session.info.pop(TAKEN_USERNAMES, ()):
+        bus.username_taken(username)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_rolled_back(session):
+    """ Rolled back changes left the cached customers as they were """
+    session.info.pop(CHANGED_CUSTOMERS, None)
+    session.info.pop(TAKEN_USERNAMES, None)
+    session.info.pop(RELEASED_USERNAMES, None)
+
+
+class InvalidationListener:
+    """
+    Applies the notifications of all workers from a background thread
+
+    Args:
+        engine (Engine): the Postgres database the writers notify
+        bus (InvalidationBus): the bus of the local caches
+        channel (string): the notification channel
+        timeout (float): seconds of silence after which the connection is checked
+        max_backoff (float): the longest wait between reconnects
+    """
+
+    def __init__(self, engine, bus, channel="customers_changed", timeout=5.0, max_backoff=30.0):
+        # pylint: disable=redefined-outer-name, too-many-arguments
+        self.engine = engine
+        self.bus = bus
+        self.channel = channel
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flush_on_connect = False
+        self.listening = threading.Event()
+        self.connects = 0
+
+    def listen(self):
+        """ Listens on one connection until it fails or stop() is called """
+        connection = self.engine.raw_connection()
+        connection.detach()  # never hand a listening connection back to the pool
+        try:
+            dbapi = connection.connection
+            dbapi.autocommit = True  # LISTEN takes effect at once
+            cursor = dbapi.cursor()
+            cursor.execute('LISTEN "{}"'.format(self.channel))
+            with self._lock:
+                # changes notified while we were reconnecting, or while the caches
+                # were filled before the first LISTEN, are lost
+                flush = self.connects or self._flush_on_connect
+                self.connects += 1
+                self.listening.set()
+            if flush:
+                self.bus.flush()
+            logger.info("Listening for cache invalidations on %s", self.channel)
+            while not self._stop.is_set():
+                if select.select([dbapi], [], [], self.timeout) == ([], [], []):
+                    cursor.execute("SELECT 1")  # notices a dead connection
+                dbapi.poll()
+                while dbapi.notifies:
+                    self.bus.dispatch(dbapi.notifies.pop(0).payload)
+        finally:
+            connection.close()
+
+    def run(self):
+        """ Listens and reconnects until stop() is called """
+        backoff = min(1.0, self.max_backoff)
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.listen()
+            except Exception as error:  # any failure of the connection is retried
+                logger.warning("Cache invalidation listener failed, reconnecting in %.1fs: %s",
+                               backoff, error)
+                self.bus.flush()
+            if time.monotonic() - started > self.max_backoff:
+                backoff = min(1.0, self.max_backoff)
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def wait_listening(self, timeout=5.0):
+        """
+        Waits for the first LISTEN, call it before the caches start filling
+
+        Returns:
+            bool: False when the listener did not connect in time, its first
+                connect then flushes what the caches loaded meanwhile
+        """
+        if self.listening.wait(timeout):
+            return True
+        with self._lock:
+            if self.connects:
+                return True
+            self._flush_on_connect = True
+        logger.warning("No cache invalidation listener after %.1fs, flushing when it connects",
+                       timeout)
+        return False
+
+    def start(self):
+        """ Starts the listener thread """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="cache-invalidation", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the listener thread within one timeout """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+######################################################################
+#  C U S T O M E R   C A C H E
+######################################################################
+
+class CustomerCache:
+    """
+    A bounded least recently used cache of customers
+
+    Args:
+        size (int): the maximum number of cached customers
+        ttl (float): seconds after which an entry is reloaded anyway
+    """
+
+    def __init__(self, size=10000, ttl=300.0):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every eviction, a load racing with one is not cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_load(self, customer_id, load, cacheable=True):
+        """
+        Returns the cached customer or the one returned by load()
+
+        Args:
+            customer_id (int): the id of the Customer
+            load (function): reads the Customer from the database, or None
+            cacheable (bool): False when the loaded customer must not be kept
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(customer_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+        customer = load()
+        if customer is None or not cacheable:
+            return customer
+        with self._lock:
+            if generation == self._generation:
+                self._entries[customer_id] = (customer, now + self.ttl)
+                self._entries.move_to_end(customer_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return customer
+
+    def evict(self, customer_id):
+        """ Removes a customer from the cache """
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(customer_id, None) is not None:
+                self.evictions += 1
+
+    def clear(self):
+        """ Removes all customers from the cache """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def metrics(self):
+        """ Returns the size and the hit counters of the cache """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+######################################################################
+#  Q U E R Y   C A C H E
+######################################################################
+
+class QueryCache:
+    """
+    A bounded least recently used cache of customer list results
+
+    Nothing tracks which customers a result holds: every committed write of
+    a Customer or an Address bumps the generation of the cache and the
+    results of older generations are simply never served again.
+
+    Args:
+        size (int): the maximum number of cached results
+        max_rows (int): larger results are not cached
+    """
+
+    def __init__(self, size=1000, max_rows=1000):
+        self.size = size
+        self.max_rows = max_rows
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_load(self, key, load, cacheable=True):
+        """
+        Returns the cached result of a query or the one returned by load()
+
+        Args:
+            key (tuple): the normalized query, see query_key()
+            load (function): runs the query against the database
+            cacheable (bool): False when the loaded result must not be kept
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self.generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        result = load()
+        if not cacheable or len(result) > self.max_rows:
+            return result
+        with self._lock:
+            # a result loaded while a write committed is kept but never served
+            self._entries[key] = (generation, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def invalidate(self, customer_id=None):
+        """ Retires all the cached results """
+        # pylint: disable=unused-argument
+        with self._lock:
+            self.generation += 1
+
+    def metrics(self):
+        """ Returns the size and the hit counters of the cache """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.size,
+                "generation": self.generation,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+def query_key(**filters):
+    """
+    Returns the cache key of a customer list query
+
+    Filters that are not set are left out and the prefix filter, which is
+    matched case insensitively, is lowercased so equivalent queries share
+    an entry. False is kept, locked=false is a filter
+    """
+    if filters.get("prefix_username"):
+        filters["prefix_username"] = filters["prefix_username"].lower()
+    return tuple(sorted((name, value) for name, value in filters.items()
+                        if value or value is False))
+
+
+######################################################################
+#  N E G A T I V E   C A C H E
+######################################################################
+
+class NegativeCache:
+    """
+    A bounded cache of the ids of customers that do not exist
+
+    Args:
+        size (int): the maximum number of remembered ids
+        ttl (float): seconds an id is remembered as missing
+    """
+
+    def __init__(self, size=10000, ttl=30.0):
+        self.size = size
+        self.ttl = ttl
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every eviction, a miss racing with one is not remembered
+        self._generation = 0
+        self.absorbed = 0
+        self.remembered = 0
+
+    def __len__(self):
+        return len(self._expires)
+
+    def get_or_load(self, customer_id, load, cacheable=True):
+        """
+        Returns None for a customer known to be missing, else what load() returns
+
+        Args:
+            customer_id (int): the id of the Customer
+            load (function): reads the Customer, None when it does not exist
+            cacheable (bool): False when a miss must not be remembered
+        """
+        now = time.monotonic()
+        with self._lock:
+            expires = self._expires.get(customer_id)
+            if expires is not None:
+                if expires > now:
+                    self.absorbed += 1
+                    return None
+                del self._expires[customer_id]
+            generation = self._generation
+        customer = load()
+        if customer is not None or not cacheable:
+            return customer
+        with self._lock:
+            if generation == self._generation:
+                self._expires[customer_id] = now + self.ttl
+                self._expires.move_to_end(customer_id)
+                self.remembered += 1
+                while len(self._expires) > self.size:
+                    self._expires.popitem(last=False)
+        return None
+
+    def evict(self, customer_id):
+        """ Forgets that a customer is missing """
+        with self._lock:
+            self._generation += 1
+            self._expires.pop(customer_id, None)
+
+    def clear(self):
+        """ Forgets all the missing customers """
+        with self._lock:
+            self._generation += 1
+            self._expires.clear()
+
+    def metrics(self):
+        """ Returns the size of the cache and the 404s it answered """
+        with self._lock:
+            return {
+                "size": len(self._expires),
+                "max_size": self.size,
+                "absorbed": self.absorbed,
+                "remembered": self.remembered,
+            }
+
+
+######################################################################
+#  S I N G L E   F L I G H T
+######################################################################
+
+class _Flight:
+    """ A read in progress and its outcome """
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SharedReadError(Exception):
+    """ The read a request shared failed, the error it raised is the __cause__ """
+
+
+def _follower_error(error):
+    """
+    Returns a new exception like the one a shared read raised
+
+    Every waiting request raises its own exception so their tracebacks do not
+    pile up on the one of the failed read, which keeps its own
+    """
+    try:
+        # a copy has the type and the arguments of error but no traceback yet
+        fresh = copy.copy(error)
+    except Exception:  # pylint: disable=broad-except
+        fresh = None
+    if fresh is None or fresh.args != error.args:
+        # its __init__ does not take back its own arguments
+        return SharedReadError(str(error))
+    return fresh
+
+
+class SingleFlight:
+    """ Coalesces concurrent identical reads into a single one """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, load):
+        """
+        Returns the result of load(), or of the identical read in progress
+
+        Args:
+            key (tuple): identifies the read, equal keys must return equal results
+            load (function): performs the read
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise _follower_error(flight.error) from flight.error
+            return flight.result
+        try:
+            flight.result = load()
+        except Exception as error:  # the waiting requests fail the same way
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def metrics(self):
+        """ Returns how many reads ran and how many requests shared them """
+        with self._lock:
+            return {
+                "reads": self.leaders,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._flights),
+            }
+
+
+single_flight = SingleFlight()
+listener = None
+
+
+def create_cache(app):
+    """ Returns the customer cache of this worker subscribed to the bus """
+    cache = CustomerCache(app.config.get("CACHE_SIZE", 10000), app.config.get("CACHE_TTL", 300))
+    bus.subscribe(cache.evict, cache.clear)
+    return cache
+
+
+def start_listener(app, engine):
+    """ Starts listening for the changes made by the other workers """
+    global listener
+    if engine.dialect.name != "postgresql":
+        logger.info("No cache invalidation listener for %s, single worker only",
+                    engine.dialect.name)
+        return None
+    listener = InvalidationListener(engine, bus, app.config.get("CACHE_CHANNEL",
+                                                                "customers_changed"))
+    listener.start()
+    return listener
+
+
+def create_negative_cache(app):
+    """ Returns the negative cache of this worker subscribed to the bus """
+    cache = NegativeCache(app.config.get("NEGATIVE_CACHE_SIZE", 10000),
+                          app.config.get("NEGATIVE_CACHE_TTL", 30))
+    bus.subscribe(cache.evict, cache.clear)
+    return cache
+
+
+def create_query_cache(app):
+    """ Returns the query cache of this worker subscribed to the bus """
+    cache = QueryCache(app.config.get("QUERY_CACHE_SIZE", 1000),
+                       app.config.get("QUERY_CACHE_MAX_ROWS", 1000))
+    bus.subscribe(cache.invalidate, cache.invalidate)
+    return cache
+
+
+def cache_metrics(**caches):
+    """ Returns the metrics of the caches and of the bus of this worker """
+    metrics = {name: cache.metrics() for name, cache in caches.items() if cache is not None}
+    metrics.update({
+        "invalidations": bus.changes,
+        "flushes": bus.flushes,
+        "listener_connects": listener.connects if listener is not None else 0,
+    })
+    return metrics
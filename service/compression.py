@@ -0,0 +1,132 @@
+"""
+Response compression for the Customer service
+
+Customer lists repeat the same keys and country/state values over and over,
+so they compress very well. Responses are compressed with the best encoding
+the client accepts (zstd, brotli or gzip) once they are larger than
+COMPRESS_MIN_SIZE, so small single customer responses are sent as they are.
+Streamed responses are compressed chunk by chunk and flushed after every
+chunk so clients keep receiving data as it is produced.
+
+brotli and zstandard are optional, gzip is always available.
+"""
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/javascript", "text/html",
+                          "text/css", "text/plain", "text/csv", "application/x-ndjson",
+                          "application/msgpack", "application/cbor"}
+
+
+class GzipCompressor:
+    """ Streaming gzip compressor """
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(max(1, min(level, 9)), zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """ Compresses data and flushes it so the chunk can be sent """
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ Returns the end of the compressed stream """
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+    """ Streaming brotli compressor """
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=max(0, min(level, 11)))
+
+    def compress(self, data):
+        """ Compresses data and flushes it so the chunk can be sent """
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        """ Returns the end of the compressed stream """
+        return self.compressor.finish()
+
+
+class ZstdCompressor:
+    """ Streaming zstd compressor """
+
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=max(1, min(level, 22))).compressobj()
+
+    def compress(self, data):
+        """ Compresses data and flushes it so the chunk can be sent """
+        return self.compressor.compress(data) + \
+            self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        """ Returns the end of the compressed stream """
+        return self.compressor.flush()
+
+
+def available_encodings():
+    """ Returns the supported encodings in order of preference """
+    encodings = {}
+    if zstandard is not None:
+        encodings["zstd"] = ZstdCompressor
+    if brotli is not None:
+        encodings["br"] = BrotliCompressor
+    encodings["gzip"] = GzipCompressor
+    return encodings
+
+
+def _compress_stream(chunks, compressor):
+    """ Compresses an iterable of byte chunks one chunk at a time """
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_response(response):
+    """
+    Compresses a response with the best encoding accepted by the client
+
+    Meant to be registered with ``app.after_request``
+    Args:
+        response (Response): the response to compress
+    """
+    if not current_app.config.get("COMPRESS_ENABLED", True):
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or "Content-Encoding" in response.headers
+            or request.method == "HEAD"):
+        return response
+
+    if not response.is_streamed:
+        minimum = current_app.config.get("COMPRESS_MIN_SIZE", 1400)
+        if response.calculate_content_length() < minimum:
+            return response
+
+    encodings = available_encodings()
+    encoding = request.accept_encodings.best_match(list(encodings))
+    if encoding is None:
+        return response
+    compressor = encodings[encoding](current_app.config.get("COMPRESS_LEVEL", 6))
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.iter_encoded(), compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+    response.headers["Content-Encoding"] = encoding
+    return response
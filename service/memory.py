@@ -0,0 +1,363 @@
+"""
+In-memory storage engine for Customers
+
+Keeps every Customer in the memory of the process, for tests, demos and
+single node deployments where nothing has to survive a restart. No lookup
+scans the customers:
+
+  - hash indexes map ids and usernames to customers
+  - secondary hash indexes map first and last names to sets of ids
+  - a set holds the ids of the few locked customers
+  - counters of the addresses per country and state answer the statistics
+  - a sorted list of (lowercased username, id) answers prefix searches with a
+    binary search, case insensitive like the ILIKE of the SQL backend
+
+Records are never modified in place, a change stores a new record. The
+records handed out are consistent snapshots that callers may keep without
+holding the lock.
+
+Changes are appended to a log ordered by (timestamp, id, type). The entries
+superseded by a later change of the same customer are skipped when reading
+the feed and dropped when the log is compacted.
+"""
+import bisect
+import itertools
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from service.models import Customer, Address, ResourceConflictError
+from service.queries import CustomerRecord, AddressRecord, Change, CUSTOMER_COLUMNS, \
+    ADDRESS_COLUMNS, EXACT_COUNT, stats_document
+from service.repository import CustomerRepository
+from service.cache import bus
+
+logger = logging.getLogger("flask.app")
+
+# the fields of an address in the order of the AddressRecord arguments
+ADDRESS_FIELDS = ADDRESS_COLUMNS[2:]
+# superseded change log entries tolerated before compacting
+COMPACT_SLACK = 1024
+
+
+def _copy(customer, **changes):
+    """ Returns a new CustomerRecord with some of its fields changed """
+    values = {name: changes.get(name, getattr(customer, name)) for name in CUSTOMER_COLUMNS}
+    copy = CustomerRecord(**values)
+    copy.addresses = changes.get("addresses", customer.addresses)
+    return copy
+
+
+def _discard(index, key, customer_id):
+    """ Removes an id from a secondary index """
+    ids = index[key]
+    ids.discard(customer_id)
+    if not ids:
+        del index[key]
+
+
+class MemoryRepository(CustomerRepository):
+    """ Stores the Customers in indexed dictionaries """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """ Removes all Customers and restarts the ids """
+        with self._lock:
+            self._customers = {}  # id -> CustomerRecord, in id order
+            self._by_username = {}  # username -> id
+            self._by_first_name = {}  # first name -> set of ids
+            self._by_last_name = {}  # last name -> set of ids
+            self._locked = set()  # ids of the locked customers
+            self._address_count = 0
+            self._regions = {}  # (country, state) -> [customers, addresses]
+            self._usernames = []  # sorted (lowercased username, id)
+            self._address_owners = {}  # address id -> customer id
+            self._customer_ids = itertools.count(1)
+            self._address_ids = itertools.count(1)
+            self._change_log = []  # sorted (timestamp, id, type)
+            self._latest_changes = {}  # id -> its last change log entry
+
+    ##################################################################
+    # Indexes
+    ##################################################################
+
+    def _index(self, customer):
+        self._customers[customer.id] = customer
+        self._by_username[customer.username] = customer.id
+        self._by_first_name.setdefault(customer.first_name, set()).add(customer.id)
+        self._by_last_name.setdefault(customer.last_name, set()).add(customer.id)
+        bisect.insort(self._usernames, (customer.username.lower(), customer.id))
+        if customer.locked:
+            self._locked.add(customer.id)
+        self._count_addresses(customer, 1)
+        for address in customer.addresses:
+            self._address_owners[address.address_id] = customer.id
+
+    def _unindex(self, customer):
+        del self._by_username[customer.username]
+        _discard(self._by_first_name, customer.first_name, customer.id)
+        _discard(self._by_last_name, customer.last_name, customer.id)
+        self._locked.discard(customer.id)
+        self._count_addresses(customer, -1)
+        del self._usernames[bisect.bisect_left(self._usernames,
+                                               (customer.username.lower(), customer.id))]
+        for address in customer.addresses:
+            del self._address_owners[address.address_id]
+
+    def _count_addresses(self, customer, sign):
+        """ Adds (sign 1) or removes (sign -1) the addresses of a customer from the statistics """
+        self._address_count += sign * len(customer.addresses)
+        regions = Counter((address.country, address.state) for address in customer.addresses)
+        for region, count in regions.items():
+            counts = self._regions.setdefault(region, [0, 0])
+            counts[0] += sign
+            counts[1] += sign * count
+            if not counts[1]:
+                del self._regions[region]
+
+    def _replace(self, customer, updated):
+        """ Stores an updated copy of a customer, keeping its place in id order """
+        self._unindex(customer)
+        self._index(updated)
+        self._log_change(updated.id, "upsert")
+
+    def _log_change(self, customer_id, change_type):
+        timestamp = datetime.utcnow()
+        if self._change_log and timestamp <= self._change_log[-1][0]:
+            # keep the log in order when the clock does not move forward
+            timestamp = self._change_log[-1][0] + timedelta(microseconds=1)
+        entry = (timestamp, customer_id, change_type)
+        self._change_log.append(entry)
+        self._latest_changes[customer_id] = entry
+        if len(self._change_log) > 2 * len(self._latest_changes) + COMPACT_SLACK:
+            self._change_log = sorted(self._latest_changes.values())
+
+    def _ids_with_prefix(self, prefix):
+        prefix = prefix.lower()
+        ids = set()
+        for position in range(bisect.bisect_left(self._usernames, (prefix,)),
+                              len(self._usernames)):
+            username, customer_id = self._usernames[position]
+            if not username.startswith(prefix):
+                break
+            ids.add(customer_id)
+        return ids
+
+    def _new_address(self, customer_id, values):
+        return AddressRecord(customer_id, next(self._address_ids),
+                             *[values[name] for name in ADDRESS_FIELDS])
+
+    ##################################################################
+    # Customers
+    ##################################################################
+
+    def create_customer(self, data):
+        values = Customer().deserialize(data).serialize()
+        with self._lock:
+            if values["username"] in self._by_username:
+                raise ResourceConflictError("Username '" + values["username"] + "' already exists.")
+            customer_id = next(self._customer_ids)
+            customer = CustomerRecord(customer_id, values["username"], values["password"],
+                                      values["first_name"], values["last_name"], False)
+            customer.addresses = [self._new_address(customer_id, address)
+                                  for address in values["addresses"]]
+            self._index(customer)
+            self._log_change(customer_id, "upsert")
+        bus.username_taken(customer.username)
+        logger.info("Created customer %s in memory", customer_id)
+        return customer
+
+    def find_customer(self, customer_id, fields=None):
+        return self._customers.get(customer_id)
+
+    def find_by_username(self, username):
+        customer_id = self._by_username.get(username)
+        return None if customer_id is None else self._customers.get(customer_id)
+
+    def iter_usernames(self):
+        with self._lock:
+            return list(self._by_username)
+
+    def sees_all_writes(self):
+        # a single process holds all the data
+        return True
+
+    def get_customers(self, customer_ids):
+        # records are replaced, never changed, so the lock gives one snapshot
+        with self._lock:
+            return [self._customers[customer_id] for customer_id in set(customer_ids)
+                    if customer_id in self._customers]
+
+    def list_customers(self, username=None, first_name=None, last_name=None,
+                       prefix_username=None, locked=None, sort=None, descending=False,
+                       after=None, limit=None, fields=None):
+        customers = self._filter_customers(username, first_name, last_name, prefix_username,
+                                           locked)
+        if sort is not None:
+            def key(customer):
+                return getattr(customer, sort), customer.id
+            customers.sort(key=key, reverse=descending)
+            if after is not None:
+                customers = [customer for customer in customers
+                             if (key(customer) < tuple(after) if descending
+                                 else key(customer) > tuple(after))]
+        return customers if limit is None else customers[:limit]
+
+    def _filter_customers(self, username, first_name, last_name, prefix_username, locked):
+        with self._lock:
+            candidates = []
+            if locked is not None:
+                candidates.append(self._locked if locked else
+                                  self._customers.keys() - self._locked)
+            if username:
+                customer_id = self._by_username.get(username)
+                candidates.append(() if customer_id is None else (customer_id,))
+            if first_name:
+                candidates.append(self._by_first_name.get(first_name, ()))
+            if last_name:
+                candidates.append(self._by_last_name.get(last_name, ()))
+            if prefix_username:
+                candidates.append(self._ids_with_prefix(prefix_username))
+            if not candidates:
+                return list(self._customers.values())
+            # intersect starting from the most selective index
+            candidates.sort(key=len)
+            ids = set(candidates[0]).intersection(*candidates[1:])
+            return [self._customers[customer_id] for customer_id in sorted(ids)]
+
+    def count_customers(self, username=None, first_name=None, last_name=None,
+                        prefix_username=None, locked=None):
+        customers = self._filter_customers(username, first_name, last_name, prefix_username,
+                                           locked)
+        return len(customers), EXACT_COUNT
+
+    def count_lock_states(self):
+        with self._lock:
+            return {"locked": len(self._locked),
+                    "unlocked": len(self._customers) - len(self._locked)}
+
+    def customer_stats(self):
+        with self._lock:
+            return stats_document(len(self._customers), len(self._locked), self._address_count,
+                                  [region + tuple(counts)
+                                   for region, counts in self._regions.items()])
+
+    def rebuild_stats(self):
+        # the statistics are kept by the indexes, they are never out of date
+        pass
+
+    def update_customer(self, customer_id, values):
+        with self._lock:
+            customer = self._customers.get(customer_id)
+            if customer is None:
+                return None
+            username = values.get("username", customer.username)
+            if username != customer.username and username in self._by_username:
+                raise ResourceConflictError("Username '" + username + "' already exists.")
+            updated = _copy(customer, **values)
+            self._replace(customer, updated)
+        if updated.username != customer.username:
+            bus.username_released(customer.username)
+            bus.username_taken(updated.username)
+        return updated
+
+    def set_locked(self, customer_id, locked):
+        return self.update_customer(customer_id, {"locked": locked})
+
+    def delete_customer(self, customer_id):
+        with self._lock:
+            customer = self._customers.pop(customer_id, None)
+            if customer is not None:
+                self._unindex(customer)
+                self._log_change(customer_id, "delete")
+        if customer is not None:
+            bus.username_released(customer.username)
+
+    ##################################################################
+    # Addresses
+    ##################################################################
+
+    def create_address(self, customer_id, data):
+        with self._lock:
+            customer = self._customers.get(customer_id)
+            if customer is None:
+                return None
+            values = Address().deserialize(data).serialize()
+            address = self._new_address(customer_id, values)
+            self._replace(customer, _copy(customer, addresses=customer.addresses + [address]))
+        return address
+
+    def find_address(self, customer_id, address_id):
+        customer = self._customers.get(customer_id)
+        if customer is None or self._address_owners.get(address_id) != customer_id:
+            return None
+        for address in customer.addresses:
+            if address.address_id == address_id:
+                return address
+        return None
+
+    def update_address(self, customer_id, address_id, data):
+        with self._lock:
+            if self.find_address(customer_id, address_id) is None:
+                return None
+            values = Address().deserialize(data).serialize()
+            customer = self._customers[customer_id]
+            updated = AddressRecord(customer_id, address_id,
+                                    *[values[name] for name in ADDRESS_FIELDS])
+            addresses = [updated if address.address_id == address_id else address
+                         for address in customer.addresses]
+            self._replace(customer, _copy(customer, addresses=addresses))
+        return updated
+
+    def delete_address(self, customer_id, address_id):
+        with self._lock:
+            if self.find_address(customer_id, address_id) is None:
+                return
+            customer = self._customers[customer_id]
+            addresses = [address for address in customer.addresses
+                         if address.address_id != address_id]
+            self._replace(customer, _copy(customer, addresses=addresses))
+
+    ##################################################################
+    # Change feed
+    ##################################################################
+
+    def list_changes(self, since=None, until=None, limit=100):
+        changes = []
+        with self._lock:
+            start = 0
+            if since is not None:
+                start = bisect.bisect_left(self._change_log, (since[0], since[1] + 1))
+            for position in range(start, len(self._change_log)):
+                entry = self._change_log[position]
+                timestamp, customer_id, change_type = entry
+                if len(changes) >= limit or (until is not None and timestamp > until):
+                    break
+                if self._latest_changes[customer_id] is not entry:
+                    continue
+                customer = self._customers[customer_id] if change_type == "upsert" else None
+                changes.append(Change(change_type, customer_id, timestamp, customer))
+        return changes
+
+    ##################################################################
+    # Schema
+    ##################################################################
+
+    def upgrade_schema(self):
+        # nothing is stored, there is nothing to upgrade
+        return []
+
+    ##################################################################
+    # Read model
+    ##################################################################
+
+    def check_documents(self):
+        # the customers are served from memory, there are no stored documents
+        with self._lock:
+            return {"checked": len(self._customers), "missing": [], "stale": [], "orphaned": []}
+
+    def rebuild_documents(self):
+        return 0
@@ -3,14 +3,25 @@ Models for Customer
 
 All of the models are stored in this module
 """
+import json
 import logging
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+import random
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from flask import Flask, current_app
+from sqlalchemy import inspect, select, func, and_, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+from service.replicas import RoutingSQLAlchemy
+from service.sqlite import configure_sqlite, tune_sqlite
+from service.cache import publish_change, publish_username
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# reads of GET requests are routed to the replicas when there are any
+db = RoutingSQLAlchemy()
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
@@ -24,6 +35,356 @@ class UnsupportedKeyError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
+def commit():
+    """ Commits the session unless the changes are being batched """
+    if db.session.info.get("batched"):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+@contextmanager
+def batched_commits():
+    """
+    Commits all creates, updates and deletes of the block at once
+
+    Every commit waits for the write lock and, on SQLite, appends to the WAL,
+    so loading many rows is much faster with a single commit. The changes are
+    rolled back when the block raises.
+    """
+    if db.session.info.get("batched"):
+        yield
+        return
+    db.session.info["batched"] = True
+    try:
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.info.pop("batched", None)
+
+def touch_customer(customer_id):
+    """ Marks a Customer as changed when one of its addresses changes """
+    if customer_id is None:
+        return
+    table = Customer.__table__
+    db.session.execute(
+        table.update().where(table.c.id == customer_id).values(updated_at=datetime.utcnow())
+    )
+
+def record_event(event_type, resource):
+    """
+    Adds a domain event to the outbox in the transaction of the change
+
+    Args:
+        event_type (string): e.g. customer.created or address.deleted
+        resource (Customer or Address): the changed resource
+    """
+    if not current_app.config.get("OUTBOX_ENABLED"):
+        return
+    db.session.flush()  # assigns the ids of new rows
+    customer_id = resource.customer_id if isinstance(resource, Address) else resource.id
+    db.session.add(OutboxEvent(event_type=event_type, customer_id=customer_id,
+                               payload=json.dumps(resource.serialize())))
+
+def username_changes(customer):
+    """ Returns the new and the old usernames of a pending change, before a flush forgets them """
+    history = inspect(customer).attrs.username.history
+    return list(history.added), list(history.deleted)
+
+def notify_change(resource, deleted=False, usernames=None):
+    """
+    Invalidates the cached reads of the changed Customer in every worker
+
+    Args:
+        resource (Customer or Address): the changed resource
+        deleted (bool): the Customer is about to be deleted
+        usernames (tuple): the new and the old usernames of the Customer,
+            see username_changes(), taken before anything flushed the change
+    """
+    config = current_app.config
+    if not (config.get("CACHE_ENABLED") or config.get("USERNAME_FILTER")
+            or config.get("USERNAME_INDEX")):
+        return
+    new_usernames, old_usernames = [], []
+    if isinstance(resource, Customer) and deleted:
+        old_usernames = [resource.username]
+    elif isinstance(resource, Customer):
+        new_usernames, old_usernames = usernames or username_changes(resource)
+    db.session.flush()  # assigns the ids of new rows
+    customer_id = resource.customer_id if isinstance(resource, Address) else resource.id
+    publish_change(db.session, customer_id, config.get("CACHE_CHANNEL"))
+    for username in new_usernames:
+        publish_username(db.session, username, config.get("CACHE_CHANNEL"))
+    for username in old_usernames:
+        publish_username(db.session, username, config.get("CACHE_CHANNEL"), released=True)
+
+######################################################################
+#  S T A T I S T I C S   R O L L U P S
+######################################################################
+
+# the totals every write changes are spread over this many rows of
+# customer_stats, so concurrent transactions rarely wait for the same row lock
+STATS_SLOTS = 8
+
+def _add_counts(execute, dialect, table, key, counts):
+    """ Adds counts to the columns of the row of table with the primary key key """
+    if dialect == "postgresql":
+        statement = postgresql.insert(table).values(dict(key, **counts))
+        statement = statement.on_conflict_do_update(
+            index_elements=list(key),
+            set_={name: table.c[name] + statement.excluded[name] for name in counts}
+        )
+        execute(statement)
+        return
+    # other databases have a single writer, nobody inserts the row in between
+    match = and_(*[table.c[name] == value for name, value in key.items()])
+    changed = execute(table.update().where(match).values(
+        {name: table.c[name] + value for name, value in counts.items()}
+    )).rowcount
+    if not changed:
+        execute(table.insert().values(dict(key, **counts)))
+
+class StatsDelta:
+    """
+    The changes a write makes to the rolled up statistics
+
+    A region is the (country, state) of an address, its customers are the
+    customers with at least one address there
+    """
+
+    def __init__(self):
+        self.customers = 0
+        self.locked = 0
+        self.addresses = 0
+        self.regions = {}  # (country, state) -> [customers, addresses]
+
+    def _count_region(self, region, customers, addresses):
+        counts = self.regions.setdefault(region, [0, 0])
+        counts[0] += customers
+        counts[1] += addresses
+
+    def customer(self, locked, regions, sign=1):
+        """
+        Counts a created (sign 1) or a deleted (sign -1) customer
+
+        Args:
+            locked (bool): the customer is locked
+            regions (list): the (country, state) of each of its addresses
+        """
+        self.customers += sign
+        if locked:
+            self.locked += sign
+        self.addresses += sign * len(regions)
+        for region, count in Counter(regions).items():
+            self._count_region(region, sign, sign * count)
+
+    def lock(self, locked):
+        """ Counts a customer being locked or unlocked """
+        self.locked += 1 if locked else -1
+
+    def address(self, execute, customer_id, address_id, old_region=None, new_region=None):
+        """
+        Counts an address created (no old_region), moved or deleted (no new_region)
+
+        The other addresses of the customer are read to tell whether it has
+        just arrived in or left a region
+        """
+        if old_region == new_region:
+            return
+        if old_region is None:
+            self.addresses += 1
+        if new_region is None:
+            self.addresses -= 1
+        table = Address.__table__
+        for region, sign in ((old_region, -1), (new_region, 1)):
+            if region is None:
+                continue
+            others = execute(select([func.count()]).select_from(table).where(and_(
+                table.c.customer_id == customer_id, table.c.address_id != address_id,
+                table.c.country == region[0], table.c.state == region[1]
+            ))).scalar()
+            self._count_region(region, 0 if others else sign, sign)
+
+    def apply(self, execute, dialect):
+        """ Adds the changes to the rollup tables in the transaction of the write """
+        totals = {"customers": self.customers, "locked": self.locked,
+                  "addresses": self.addresses}
+        if any(totals.values()):
+            _add_counts(execute, dialect, CustomerStats.__table__,
+                        {"slot": random.randrange(STATS_SLOTS)}, totals)
+        # always in the same order, concurrent writes cannot deadlock
+        for (country, state), (customers, addresses) in sorted(self.regions.items()):
+            if customers or addresses:
+                _add_counts(execute, dialect, RegionStats.__table__,
+                            {"country": country, "state": state},
+                            {"customers": customers, "addresses": addresses})
+
+def stats_rollups_enabled():
+    """ Returns True when the writes keep the rollup tables up to date """
+    return bool(current_app.config.get("STATS_ROLLUPS"))
+
+def record_stats(delta):
+    """ Applies a StatsDelta in the transaction of the session """
+    delta.apply(db.session.execute, db.engine.dialect.name)
+
+######################################################################
+#  R E A D   M O D E L
+######################################################################
+
+# Key order of the customer documents, matches the API models
+CUSTOMER_DOCUMENT_KEYS = ("id", "locked", "addresses", "first_name", "last_name",
+                          "username", "password")
+ADDRESS_DOCUMENT_KEYS = ("customer_id", "address_id", "street_address", "city", "state",
+                         "zipcode", "country")
+
+def build_documents(execute, customer_ids, lock=False):
+    """
+    Returns the JSON text of the Customers as the API serializes them by id
+
+    Missing Customers are left out
+
+    Args:
+        execute (function): runs a statement, db.session.execute or Connection.execute
+        lock (bool): lock the customer rows first (FOR UPDATE on Postgres), so
+            the addresses are read after the concurrent writes committed
+    """
+    customer_ids = list(customer_ids)
+    if not customer_ids:
+        return {}
+    customers, addresses = Customer.__table__, Address.__table__
+    names = [name for name in CUSTOMER_DOCUMENT_KEYS if name != "addresses"]
+    query = select([customers.c[name] for name in names]).where(customers.c.id.in_(customer_ids))
+    if lock:
+        query = query.with_for_update()
+    documents = {}
+    for row in execute(query):
+        document = dict(zip(names, row))
+        document["addresses"] = []
+        documents[document["id"]] = document
+    if documents:
+        query = select([addresses.c[name] for name in ADDRESS_DOCUMENT_KEYS]).where(
+            addresses.c.customer_id.in_(list(documents))
+        ).order_by(addresses.c.address_id)
+        for row in execute(query):
+            documents[row[0]]["addresses"].append(dict(zip(ADDRESS_DOCUMENT_KEYS, row)))
+    # json.dumps of the ordered keys writes exactly what the compiled serializers write
+    return {customer_id: json.dumps({key: document[key] for key in CUSTOMER_DOCUMENT_KEYS})
+            for customer_id, document in documents.items()}
+
+def write_documents(execute, customer_ids):
+    """
+    Stores the current documents of the Customers in the read model
+
+    A changed document gets the next version, the document of a deleted
+    Customer is removed. Run it in the transaction of the write, after the
+    changes were flushed.
+
+    Returns:
+        int: the number of documents created, changed or removed
+    """
+    customer_ids = list(customer_ids)
+    if not customer_ids:
+        return 0
+    table = CustomerDocument.__table__
+    documents = build_documents(execute, customer_ids, lock=True)
+    stored = dict(execute(select([table.c.customer_id, table.c.document]).where(
+        table.c.customer_id.in_(customer_ids)
+    )).fetchall())
+    now = datetime.utcnow()
+    written = 0
+    for customer_id in customer_ids:
+        document = documents.get(customer_id)
+        match = table.c.customer_id == customer_id
+        if document is None and customer_id in stored:
+            execute(table.delete().where(match))
+        elif document is not None and customer_id not in stored:
+            execute(table.insert().values(customer_id=customer_id, version=1,
+                                          document=document, updated_at=now))
+        elif document is not None and stored[customer_id] != document:
+            execute(table.update().where(match).values(version=table.c.version + 1,
+                                                       document=document, updated_at=now))
+        else:
+            continue
+        written += 1
+    return written
+
+def record_document(resource):
+    """
+    Rewrites the read model document of a changed Customer in the transaction of the change
+
+    Args:
+        resource (Customer or Address): the changed resource
+    """
+    if not current_app.config.get("READ_MODEL"):
+        return
+    db.session.flush()  # assigns the ids of new rows, the document is read back from the tables
+    customer_id = resource.customer_id if isinstance(resource, Address) else resource.id
+    if customer_id is not None:
+        write_documents(db.session.execute, [customer_id])
+
+######################################################################
+#  S C H E M A   U P G R A D E S
+######################################################################
+
+def upgrade_schema(engine, tables=None):
+    """
+    Brings the tables of an existing database up to the models
+
+    create_all() only creates the missing tables, so the columns and the
+    indexes added to the existing tables are added here. The new NOT NULL
+    timestamps of the existing rows are backfilled with the time of the
+    upgrade. Run it once per database before the new code serves requests
+    (flask upgrade-db), it can be run again safely.
+
+    Args:
+        engine (Engine): the database to upgrade
+        tables (list): the tables of the models to upgrade, all of them by default
+    Returns:
+        list: a description of every change made
+    """
+    tables = list(db.Model.metadata.sorted_tables if tables is None else tables)
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    changes = ["created table " + table.name for table in tables if table.name not in existing]
+    db.Model.metadata.create_all(engine, tables=tables)
+    backfill = datetime.utcnow().isoformat(" ")
+    for table in tables:
+        if table.name not in existing:
+            continue
+        present = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in present:
+                continue
+            ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+                table.name, column.name, column.type.compile(dialect=engine.dialect))
+            if not column.nullable:
+                if not isinstance(column.type, db.DateTime):
+                    raise ValueError("Cannot backfill {}.{}".format(table.name, column.name))
+                # a constant default, SQLite cannot add a column defaulting to CURRENT_TIMESTAMP
+                ddl += " NOT NULL DEFAULT '{}'".format(backfill)
+            with engine.begin() as connection:
+                connection.execute(text(ddl))
+            changes.append("added column {}.{}".format(table.name, column.name))
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                _create_index(engine, index)
+                changes.append("created index " + index.name)
+    return changes
+
+def _create_index(engine, index):
+    """ Creates an index, on Postgres without blocking the writes to its table """
+    if engine.dialect.name != "postgresql":
+        index.create(engine)
+        return
+    ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+    # CONCURRENTLY cannot run inside a transaction
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text(ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)))
+
 class Customer(db.Model):
     """
     Class that represents a Customer
@@ -32,6 +393,11 @@ class Customer(db.Model):
     app = None
 
     __tablename__ = 'customer'
+    # the sorted customer lists page through these, ties broken by id
+    __table_args__ = (
+        db.Index("ix_customer_last_name_id", "last_name", "id"),
+        db.Index("ix_customer_first_name_id", "first_name", "id"),
+    )
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
@@ -40,6 +406,9 @@ class Customer(db.Model):
     last_name = db.Column(db.String(32), nullable=False)
     addresses = db.relationship('Address', backref='customer', lazy=True, cascade="all, delete-orphan")
     locked=db.Column(db.Boolean,default=False,nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+                           onupdate=datetime.utcnow, index=True)
 
     def __repr__(self):
         return "<Customer %r id=[%s]>" % (self.username, self.id)
@@ -51,7 +420,12 @@ class Customer(db.Model):
         logger.info("Creating %s", self.username)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
-        db.session.commit()
+        usernames = username_changes(self)  # before record_event flushes
+        record_event("customer.created", self)
+        notify_change(self, usernames=usernames)
+        self._record_stats(1)
+        record_document(self)
+        commit()
 
     def update(self):
         """
@@ -60,20 +434,64 @@ class Customer(db.Model):
         logger.info("Saving %s", self.username)
         if not self.id:
             raise DataValidationError("Customer update called with empty ID field")
-        db.session.commit()
+        usernames = username_changes(self)  # before record_event flushes
+        self._record_lock_stats()
+        self._record_update()
+        notify_change(self, usernames=usernames)
+        record_document(self)
+        commit()
 
     def save(self):
         """
         Updates a Customer to the database
         """
         logger.info("Saving %s", self.username)
-        db.session.commit()
+        usernames = username_changes(self)  # before record_event flushes
+        self._record_lock_stats()
+        self._record_update()
+        notify_change(self, usernames=usernames)
+        record_document(self)
+        commit()
+
+    def _record_stats(self, sign):
+        """ Counts the Customer in the statistics, sign is 1 when created, -1 when deleted """
+        if not stats_rollups_enabled():
+            return
+        delta = StatsDelta()
+        delta.customer(self.locked, [(address.country, address.state)
+                                     for address in self.addresses], sign)
+        record_stats(delta)
+
+    def _record_lock_stats(self):
+        """ Counts a pending lock or unlock in the statistics, before a flush """
+        if not stats_rollups_enabled():
+            return
+        history = inspect(self).attrs.locked.history
+        was_locked = bool(history.deleted[0]) if history.deleted else False
+        if history.added and bool(history.added[0]) != was_locked:
+            delta = StatsDelta()
+            delta.lock(bool(history.added[0]))
+            record_stats(delta)
+
+    def _record_update(self):
+        """ Adds the event matching the pending changes to the outbox """
+        if not db.session.is_modified(self):
+            return
+        if inspect(self).attrs.locked.history.has_changes():
+            record_event("customer.locked" if self.locked else "customer.unlocked", self)
+        else:
+            record_event("customer.updated", self)
 
     def delete(self):
         """ Removes a Customer from the data store """
         logger.info("Deleting %s", self.username)
+        record_event("customer.deleted", self)
+        notify_change(self, deleted=True)
+        self._record_stats(-1)
         db.session.delete(self)
-        db.session.commit()
+        db.session.add(CustomerTombstone(customer_id=self.id))
+        record_document(self)
+        commit()
 
     def serialize(self):
         """ Serializes a Customer into a dictionary """
@@ -152,9 +570,11 @@ class Customer(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        configure_sqlite(app)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        tune_sqlite(app, db.engine)
         db.create_all()  # make our sqlalchemy tables
 
     @classmethod
@@ -215,6 +635,11 @@ class Customer(db.Model):
         logger.info("Processing Prefix username query for %s ...", username)
         return cls.query.filter(cls.username.ilike(username + '%'))
 
+# few customers are locked, the index of the locked ones stays small and is
+# read by the locked=true filter and the lock counts without a table scan
+db.Index("ix_customer_locked_id", Customer.id,
+         postgresql_where=Customer.locked.is_(True), sqlite_where=Customer.locked.is_(True))
+
 class Address(db.Model):
     """
     Class that represents an Address
@@ -230,6 +655,9 @@ class Address(db.Model):
     state = db.Column(db.String(100), nullable=False)
     zipcode = db.Column(db.String(100), nullable=False)
     country = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+                           onupdate=datetime.utcnow, index=True)
 
     def __repr__(self):
         return "<Address with id=[%s] %s, %s, %s %s, %s>" % (self.address_id, self.street_address, self.city, self.state, self.zipcode, self.country)
@@ -241,7 +669,12 @@ class Address(db.Model):
         logger.info("Creating address with street address %s", self.street_address)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
-        db.session.commit()
+        touch_customer(self.customer_id)
+        record_event("address.created", self)
+        self._record_stats(new_region=(self.country, self.state))
+        notify_change(self)
+        record_document(self)
+        commit()
 
     def update(self):
         """
@@ -250,15 +683,45 @@ class Address(db.Model):
         logger.info("Saving address with street address %s", self.street_address)
         if not self.address_id:
             raise DataValidationError("Address update called with empty address_id field")
-        db.session.commit()
+        old_region = self._loaded_region()  # before a flush forgets the old values
+        touch_customer(self.customer_id)
+        record_event("address.updated", self)
+        self._record_stats(old_region, (self.country, self.state))
+        notify_change(self)
+        record_document(self)
+        commit()
 
     def delete(self):
         """
         Removes an Address from the data store
         """
         logger.info("Deleting address with street address %s", self.street_address)
+        old_region = self._loaded_region()  # before a flush forgets the old values
+        record_event("address.deleted", self)
+        notify_change(self)
+        self._record_stats(old_region=old_region)
         db.session.delete(self)
-        db.session.commit()
+        touch_customer(self.customer_id)
+        record_document(self)
+        commit()
+
+    def _loaded_region(self):
+        """ The (country, state) of the Address as loaded, before pending changes """
+        region = []
+        for name in ("country", "state"):
+            history = inspect(self).attrs[name].history
+            region.append(history.deleted[0] if history.deleted else getattr(self, name))
+        return tuple(region)
+
+    def _record_stats(self, old_region=None, new_region=None):
+        """ Counts the creation, move or deletion of the Address in the statistics """
+        if not stats_rollups_enabled():
+            return
+        db.session.flush()  # assigns the id of a new address
+        delta = StatsDelta()
+        delta.address(db.session.execute, self.customer_id, self.address_id,
+                      old_region, new_region)
+        record_stats(delta)
 
     def serialize(self):
         """ Serializes an Address into a dictionary """
@@ -315,4 +778,84 @@ class Address(db.Model):
             customer_id (int): the customer id of the Addresses you want to match
         """
         logger.info("Processing query addresses by customer_id for %s ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id)
\ No newline at end of file
+        return cls.query.filter(cls.customer_id == customer_id)
+
+class CustomerTombstone(db.Model):
+    """
+    Class that records the deletion of a Customer for the change feed
+    """
+
+    __tablename__ = 'customer_tombstone'
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return "<CustomerTombstone customer_id=[%s] at %s>" % (self.customer_id, self.deleted_at)
+
+class OutboxEvent(db.Model):
+    """
+    Class that represents a domain event waiting to be published
+    """
+
+    __tablename__ = 'outbox_event'
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(32), nullable=False)
+    customer_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<OutboxEvent %s id=[%s] customer_id=[%s]>" % (self.event_type, self.id, self.customer_id)
+
+class CustomerStats(db.Model):
+    """
+    Class that holds one slot of the rolled up totals of the Customers
+
+    The totals are the sums of the STATS_SLOTS rows
+    """
+
+    __tablename__ = 'customer_stats'
+    # Table Schema
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    customers = db.Column(db.Integer, nullable=False, default=0)
+    locked = db.Column(db.Integer, nullable=False, default=0)
+    addresses = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<CustomerStats slot=[%s] customers=%s>" % (self.slot, self.customers)
+
+class RegionStats(db.Model):
+    """
+    Class that holds the rolled up customers and addresses of a country and state
+    """
+
+    __tablename__ = 'region_stats'
+    # Table Schema
+    country = db.Column(db.String(100), primary_key=True)
+    state = db.Column(db.String(100), primary_key=True)
+    customers = db.Column(db.Integer, nullable=False, default=0)
+    addresses = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<RegionStats %s, %s customers=%s>" % (self.state, self.country, self.customers)
+
+class CustomerDocument(db.Model):
+    """
+    Class that holds the serialized document of a Customer for the reads
+
+    The writes of the Customers and their Addresses keep it up to date when
+    READ_MODEL is enabled, see write_documents
+    """
+
+    __tablename__ = 'customer_document'
+    # Table Schema
+    customer_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    document = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<CustomerDocument customer_id=[%s] version=%s>" % (self.customer_id, self.version)
@@ -0,0 +1,265 @@
+"""
+Transactional outbox publishing for the Customer service
+
+With OUTBOX_ENABLED every create, update, delete, lock and unlock of a
+Customer or an Address adds a domain event to the outbox_event table in the
+same transaction as the change (see record_event in service.models), so an
+event exists exactly when its change was committed and the write itself
+never waits for a broker.
+
+The OutboxPublisher drains the table in the background, oldest first, in
+batches of OUTBOX_BATCH_SIZE and hands them to a sink:
+
+  stdout               one JSON event per line on the standard output
+  file:/path/to.jsonl  appended to a JSON lines file
+  http(s)://...        POSTed as a JSON array to a webhook
+
+Delivery is at least once: events are only deleted from the outbox after the
+sink accepted their batch, so consumers must ignore duplicate event ids.
+Events are delivered in id order, so the events of a customer arrive in the
+order of its changes. Several publishers may run (one per web worker with
+OUTBOX_PUBLISHER), but on Postgres only one delivers at a time: a batch is
+read and delivered under a transaction-level advisory lock, and the other
+publishers skip their turn while the lock is held. On other databases, run a
+single publisher. A slow sink is never sent more than one batch at a time
+and a failing one is retried with an exponential backoff while the outbox
+absorbs the new events; the backlog and the age of the oldest event are
+reported by metrics().
+
+Run the publisher inside the web workers with OUTBOX_PUBLISHER or as its own
+process with:
+  python -m service.outbox
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.request
+from datetime import datetime
+from sqlalchemy import select, func
+from service.models import db, OutboxEvent
+
+logger = logging.getLogger("flask.app")
+
+outbox_table = OutboxEvent.__table__
+
+# The advisory lock held by the publisher delivering a batch on Postgres
+OUTBOX_LOCK_KEY = 0x6F757462  # "outb"
+
+
+######################################################################
+#  S I N K S
+######################################################################
+
+class StdoutSink:
+    """ Writes the events as JSON lines to the standard output """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def deliver(self, events):
+        """ Delivers a batch of events or raises """
+        self.stream.write("".join(json.dumps(event) + "\n" for event in events))
+        self.stream.flush()
+
+
+class FileSink:
+    """ Appends the events to a JSON lines file """
+
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, events):
+        """ Delivers a batch of events or raises """
+        with open(self.path, "a", encoding="utf-8") as stream:
+            stream.write("".join(json.dumps(event) + "\n" for event in events))
+            stream.flush()
+            os.fsync(stream.fileno())
+
+
+class WebhookSink:
+    """ POSTs the events as a JSON array to a webhook """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def deliver(self, events):
+        """ Delivers a batch of events or raises """
+        request = urllib.request.Request(
+            self.url, data=json.dumps(events).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST"
+        )
+        # urlopen raises HTTPError for every status >= 400
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+def create_sink(spec):
+    """ Returns the sink described by OUTBOX_SINK """
+    if spec == "stdout":
+        return StdoutSink()
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec.startswith(("http://", "https://")):
+        return WebhookSink(spec)
+    raise ValueError("Unknown OUTBOX_SINK '{}'".format(spec))
+
+
+######################################################################
+#  P U B L I S H E R
+######################################################################
+
+def envelope(row):
+    """ Returns the event delivered for an outbox row """
+    return {
+        "id": row.id,
+        "type": row.event_type,
+        "customer_id": row.customer_id,
+        "occurred_at": row.created_at.isoformat() + "Z",
+        "data": json.loads(row.payload),
+    }
+
+
+def outbox_backlog(connection):
+    """ Returns the number of waiting events and the age in seconds of the oldest """
+    count, oldest = connection.execute(
+        select([func.count(outbox_table.c.id), func.min(outbox_table.c.created_at)])
+    ).first()
+    lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+    return count, max(lag, 0.0)
+
+
+class OutboxPublisher:
+    """
+    Drains the outbox into a sink from a background thread
+
+    Args:
+        engine (Engine): the database holding the outbox
+        sink: an object with a deliver(events) method raising on failure
+        batch_size (int): the maximum number of events per delivery
+        interval (float): seconds between polls of an empty outbox
+        max_backoff (float): the longest wait between retries of a failing sink
+    """
+
+    def __init__(self, engine, sink, batch_size=100, interval=1.0, max_backoff=60.0):
+        self.engine = engine
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.published = 0
+        self.batches = 0
+        self.failures = 0
+        self.backlog = 0
+        self.lag = 0.0
+        self.last_error = None
+
+    def publish_batch(self):
+        """ Delivers the oldest batch of events and returns its size """
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name == "postgresql" and not connection.execute(
+                    select([func.pg_try_advisory_xact_lock(OUTBOX_LOCK_KEY)])).scalar():
+                # another publisher is delivering the older events, ours must follow them
+                return 0
+            query = select([outbox_table]).order_by(outbox_table.c.id).limit(self.batch_size)
+            rows = connection.execute(query).fetchall()
+            if rows:
+                # an exception here rolls back and keeps the events in the outbox
+                self.sink.deliver([envelope(row) for row in rows])
+                connection.execute(outbox_table.delete().where(
+                    outbox_table.c.id.in_([row.id for row in rows])))
+            backlog, lag = outbox_backlog(connection)
+        with self._lock:
+            self.published += len(rows)
+            self.batches += 1 if rows else 0
+            self.backlog, self.lag = backlog, lag
+        return len(rows)
+
+    def run(self):
+        """ Publishes until stop() is called """
+        backoff = self.interval
+        while not self._stop.is_set():
+            try:
+                count = self.publish_batch()
+            except Exception as error:  # any failure of the sink or the database is retried
+                with self._lock:
+                    self.failures += 1
+                    self.last_error = str(error)
+                logger.warning("Outbox delivery failed, retrying in %.1fs: %s", backoff, error)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = self.interval
+            if count < self.batch_size:
+                # the outbox is drained, wait for new events
+                self._stop.wait(self.interval)
+
+    def start(self):
+        """ Starts the publisher thread """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="outbox-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the publisher thread after the batch in flight """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def metrics(self):
+        """ Returns the delivery counters and the backlog seen by the last batch """
+        with self._lock:
+            return {
+                "published": self.published,
+                "batches": self.batches,
+                "failures": self.failures,
+                "backlog": self.backlog,
+                "lag_seconds": round(self.lag, 3),
+                "last_error": self.last_error,
+            }
+
+
+publisher = None
+
+
+def start_publisher(app):
+    """ Starts the publisher configured for app """
+    global publisher
+    publisher = OutboxPublisher(
+        db.get_engine(app), create_sink(app.config.get("OUTBOX_SINK", "stdout")),
+        batch_size=app.config.get("OUTBOX_BATCH_SIZE", 100),
+        interval=app.config.get("OUTBOX_POLL_INTERVAL", 1.0),
+        max_backoff=app.config.get("OUTBOX_MAX_BACKOFF", 60.0),
+    )
+    publisher.start()
+    logger.info("Outbox publisher started")
+    return publisher
+
+
+def outbox_metrics():
+    """ Returns the metrics of the outbox and of the publisher of this process """
+    with db.engine.connect() as connection:
+        backlog, lag = outbox_backlog(connection)
+    metrics = publisher.metrics() if publisher is not None else {}
+    metrics.update({"backlog": backlog, "lag_seconds": round(lag, 3)})
+    return metrics
+
+
+if __name__ == "__main__":
+    # use the module the service imported, not this __main__ copy
+    from service import app, outbox
+    if outbox.publisher is None:
+        outbox.start_publisher(app)
+    try:
+        while True:
+            time.sleep(60)
+            app.logger.info("Outbox %s", outbox.publisher.metrics())
+    except KeyboardInterrupt:
+        outbox.publisher.stop()
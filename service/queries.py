@@ -0,0 +1,775 @@
+"""
+Read queries for Customer
+
+Read only endpoints never modify what they load, so building ORM instances,
+registering them in the identity map and instrumenting their attributes is
+wasted work. The functions in this module run Core level SELECTs and return
+compact ``__slots__`` records that the serializers can encode directly.
+"""
+import base64
+import calendar
+import json
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, func, cast, literal_column, text, String, Text, and_, or_, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from service.models import db, Customer, Address, CustomerTombstone, CustomerStats, \
+    RegionStats, CustomerDocument, DataValidationError, CUSTOMER_DOCUMENT_KEYS, build_documents, \
+    write_documents, stats_rollups_enabled
+
+logger = logging.getLogger("flask.app")
+
+customer_table = Customer.__table__
+address_table = Address.__table__
+tombstone_table = CustomerTombstone.__table__
+customer_stats_table = CustomerStats.__table__
+region_stats_table = RegionStats.__table__
+document_table = CustomerDocument.__table__
+
+CUSTOMER_COLUMNS = ("id", "username", "password", "first_name", "last_name", "locked")
+ADDRESS_COLUMNS = ("customer_id", "address_id", "street_address", "city", "state",
+                   "zipcode", "country")
+# The orders of the customer list, each backed by an index ending with the id
+SORT_COLUMNS = ("id", "username", "last_name", "first_name")
+# The kinds of X-Total-Count
+EXACT_COUNT = "exact"
+ESTIMATED_COUNT = "estimated"
+# The row count of the customer table the planner would assume: the analyzed
+# rows per page times the current number of pages
+ESTIMATED_ROWS = text(
+    "SELECT CASE WHEN relpages > 0 THEN reltuples / relpages * "
+    "(pg_relation_size(oid) / current_setting('block_size')::int) ELSE reltuples END "
+    "FROM pg_class WHERE oid = 'customer'::regclass"
+)
+
+
+class AddressRecord:
+    """ A read only Address row """
+
+    __slots__ = ADDRESS_COLUMNS
+
+    def __init__(self, customer_id, address_id, street_address, city, state, zipcode, country):
+        self.customer_id = customer_id
+        self.address_id = address_id
+        self.street_address = street_address
+        self.city = city
+        self.state = state
+        self.zipcode = zipcode
+        self.country = country
+
+    def __repr__(self):
+        return "<AddressRecord id=[%s] customer_id=[%s]>" % (self.address_id, self.customer_id)
+
+    def serialize(self):
+        """ Serializes an AddressRecord into a dictionary """
+        return {key: getattr(self, key) for key in ADDRESS_COLUMNS}
+
+
+class CustomerRecord:
+    """ A read only Customer row together with its addresses """
+
+    __slots__ = CUSTOMER_COLUMNS + ("addresses",)
+
+    def __init__(self, id, username, password, first_name, last_name, locked):
+        # pylint: disable=redefined-builtin, too-many-arguments
+        self.id = id
+        self.username = username
+        self.password = password
+        self.first_name = first_name
+        self.last_name = last_name
+        self.locked = locked
+        self.addresses = []
+
+    def __repr__(self):
+        return "<CustomerRecord %r id=[%s]>" % (self.username, self.id)
+
+    def serialize(self):
+        """ Serializes a CustomerRecord into a dictionary """
+        customer_dict = {key: getattr(self, key) for key in CUSTOMER_COLUMNS}
+        customer_dict["addresses"] = [address.serialize() for address in self.addresses]
+        return customer_dict
+
+
+def customer_criteria(username=None, first_name=None, last_name=None, prefix_username=None,
+                      locked=None):
+    """ Builds the WHERE clauses for the customer list filters """
+    criteria = []
+    if locked is not None:
+        criteria.append(locked_criteria(locked))
+    if username:
+        criteria.append(customer_table.c.username == username)
+    if first_name:
+        criteria.append(customer_table.c.first_name == first_name)
+    if last_name:
+        criteria.append(customer_table.c.last_name == last_name)
+    if prefix_username:
+        criteria.append(customer_table.c.username.ilike(prefix_username + "%"))
+    return criteria
+
+
+def locked_criteria(locked):
+    """
+    The WHERE clause of the locked or of the unlocked customers
+
+    The locked one repeats the condition of the partial index
+    ix_customer_locked_id so the planners can tell the index covers it
+    """
+    if locked:
+        return customer_table.c.locked.is_(True)
+    return customer_table.c.locked.isnot(True)  # customers without a lock state are unlocked
+
+
+def _sort_column(sort, collation=None):
+    """ Returns the column of sort, its strings compared with collation if any """
+    column = customer_table.c[sort]
+    if collation is not None and isinstance(column.type, String):
+        column = column.collate(collation)
+    return column
+
+
+def page_order(sort, descending=False, collation=None):
+    """
+    The ORDER BY of a customer list sorted by one of SORT_COLUMNS, ties by id
+
+    The strings are sorted with collation when given, instead of the one of
+    their column
+    """
+    columns = [_sort_column(sort, collation)]
+    if sort != "id":
+        columns.append(customer_table.c.id)
+    return [column.desc() if descending else column for column in columns]
+
+
+def page_criteria(sort, descending, after, collation=None):
+    """
+    The keyset condition of the customers after a page
+
+    Args:
+        sort (string): one of SORT_COLUMNS
+        descending (bool): the list is sorted in descending order
+        after (tuple): the (sort value, id) of the last customer of the page
+        collation (string): the collation the list is sorted with, see page_order()
+    """
+    value, customer_id = after
+    if sort == "id":
+        key, bound = customer_table.c.id, customer_id
+    else:
+        # a row comparison lets the (column, id) index seek straight to the page
+        key = tuple_(_sort_column(sort, collation), customer_table.c.id)
+        bound = tuple_(value, customer_id)
+    return key < bound if descending else key > bound
+
+
+def encode_page_cursor(sort, customer):
+    """ Encodes the position of a customer in a sorted list as an opaque cursor """
+    position = json.dumps([sort, getattr(customer, sort), customer.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_page_cursor(cursor, sort):
+    """ Decodes a cursor of a list sorted by sort into a (sort value, id) position """
+    try:
+        position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, customer_id = json.loads(position.decode("utf-8"))
+    except (ValueError, TypeError):
+        raise DataValidationError("Invalid page cursor '{}'".format(cursor))
+    if cursor_sort != sort or not isinstance(customer_id, int):
+        raise DataValidationError("The page cursor '{}' is not for sort={}".format(cursor, sort))
+    return value, customer_id
+
+
+def _attach_addresses(customers, criteria=None):
+    """
+    Loads the addresses of customers in a single query
+
+    Args:
+        customers (list): the CustomerRecords to complete
+        criteria (list): the criteria the customers were found with, or None
+            to look the addresses up by the ids of the customers
+    """
+    if not customers:
+        return customers
+    by_id = {customer.id: customer for customer in customers}
+    query = select([address_table.c[name] for name in ADDRESS_COLUMNS])
+    if len(customers) == 1:
+        query = query.where(address_table.c.customer_id == customers[0].id)
+    elif criteria is None:
+        query = query.where(address_table.c.customer_id.in_(list(by_id)))
+    else:
+        ids = select([customer_table.c.id])
+        for criterion in criteria:
+            ids = ids.where(criterion)
+        query = query.where(address_table.c.customer_id.in_(ids))
+    query = query.order_by(address_table.c.address_id)
+    for row in db.session.execute(query):
+        customer = by_id.get(row[0])
+        # the criteria also match the customers committed since the first query
+        if customer is not None:
+            customer.addresses.append(AddressRecord(*row))
+    return customers
+
+
+def projected_columns(fields=None, sort=None):
+    """
+    Returns the CUSTOMER_COLUMNS to select for a sparse fieldset
+
+    Args:
+        fields (tuple): the requested fields of the customers, None for all
+        sort (string): the sort column, read for the cursor of the next page
+    """
+    if fields is None:
+        return CUSTOMER_COLUMNS
+    # the id is always selected, the addresses and the pages are found by it
+    selected = set(fields) | {"id", sort}
+    return tuple(name for name in CUSTOMER_COLUMNS if name in selected)
+
+
+def customer_records(rows, columns=CUSTOMER_COLUMNS):
+    """ Returns the CustomerRecords of rows of columns, the other fields left None """
+    if columns == CUSTOMER_COLUMNS:
+        return [CustomerRecord(*row) for row in rows]
+    records = []
+    for row in rows:
+        values = dict.fromkeys(CUSTOMER_COLUMNS)
+        values.update(zip(columns, row))
+        records.append(CustomerRecord(**values))
+    return records
+
+
+def find_customers(criteria=(), sort=None, descending=False, after=None, limit=None,
+                   fields=None):
+    """
+    Returns CustomerRecords matching all of the criteria
+
+    Args:
+        criteria (list): SQL expressions built with customer_criteria()
+        sort (string): one of SORT_COLUMNS, or None for the order of the database
+        descending (bool): sort in descending order
+        after (tuple): the (sort value, id) position of the last customer already seen
+        limit (int): the maximum number of customers to return
+        fields (tuple): only select these fields, the addresses are not read
+            unless they are one of them
+    """
+    logger.info("Processing customer records query")
+    criteria = list(criteria)
+    if after is not None:
+        criteria.append(page_criteria(sort, descending, after))
+    columns = projected_columns(fields, sort)
+    query = select([customer_table.c[name] for name in columns])
+    for criterion in criteria:
+        query = query.where(criterion)
+    if sort is not None:
+        query = query.order_by(*page_order(sort, descending))
+    if limit is not None:
+        query = query.limit(limit)
+    customers = customer_records(db.session.execute(query), columns)
+    if fields is not None and "addresses" not in fields:
+        return customers
+    # a page is found by its ids, the criteria would also match the following pages
+    return _attach_addresses(customers, criteria if limit is None else None)
+
+
+def find_customer(customer_id, fields=None):
+    """ Returns the CustomerRecord with the given id or None """
+    logger.info("Processing record lookup for id %s ...", customer_id)
+    customers = find_customers([customer_table.c.id == customer_id], fields=fields)
+    return customers[0] if customers else None
+
+
+def fetch_customers_by_ids(execute, customer_ids):
+    """
+    Returns the CustomerRecords with the given ids in two queries
+
+    Args:
+        execute (function): runs a statement, db.session.execute or Connection.execute
+        customer_ids (list): the ids to look up, missing ones are left out
+    """
+    query = select([customer_table.c[name] for name in CUSTOMER_COLUMNS]).where(
+        customer_table.c.id.in_(customer_ids)
+    )
+    customers = {row[0]: CustomerRecord(*row) for row in execute(query)}
+    if customers:
+        addresses = select([address_table.c[name] for name in ADDRESS_COLUMNS]).where(
+            address_table.c.customer_id.in_(list(customers))
+        ).order_by(address_table.c.address_id)
+        for row in execute(addresses):
+            customers[row[0]].addresses.append(AddressRecord(*row))
+    return list(customers.values())
+
+
+def find_customers_by_ids(customer_ids):
+    """
+    Returns the CustomerRecords with the given ids read from one snapshot
+
+    On Postgres both queries run in a REPEATABLE READ transaction of their
+    own, so no write can land between them. Other databases run them in the
+    session
+    """
+    logger.info("Processing batch lookup of %d ids ...", len(customer_ids))
+    if not customer_ids:
+        return []
+    engine = db.session.get_bind()
+    if engine.dialect.name != "postgresql":
+        return fetch_customers_by_ids(db.session.execute, customer_ids)
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="REPEATABLE READ")
+        with connection.begin():
+            return fetch_customers_by_ids(connection.execute, customer_ids)
+
+
+def fetch_customer_count(execute, dialect, criteria=(), exact_below=10000):
+    """
+    Returns the number of customers matching all of the criteria and its kind
+
+    Filtered counts are exact, the filters are served by indexes. Counting a
+    whole Postgres table reads all of it, so its size is estimated from the
+    statistics of the planner instead, unless they find fewer than
+    exact_below rows or the table was never analyzed.
+
+    Args:
+        execute (function): runs a statement, db.session.execute or Connection.execute
+        dialect (string): the name of the database dialect
+        criteria (list): SQL expressions built with customer_criteria()
+        exact_below (int): the smallest estimate returned instead of a count
+    Returns:
+        tuple: the count and EXACT_COUNT or ESTIMATED_COUNT
+    """
+    if not criteria and dialect == "postgresql":
+        estimate = execute(ESTIMATED_ROWS).scalar()
+        if estimate is not None and estimate >= exact_below:
+            return int(estimate), ESTIMATED_COUNT
+    query = select([func.count()]).select_from(customer_table)
+    for criterion in criteria:
+        query = query.where(criterion)
+    return execute(query).scalar(), EXACT_COUNT
+
+
+def find_customer_count(criteria=(), exact_below=10000):
+    """ Returns the number of customers matching all of the criteria and its kind """
+    logger.info("Processing customer count query")
+    return fetch_customer_count(db.session.execute, db.session.get_bind().dialect.name,
+                                criteria, exact_below)
+
+
+def fetch_lock_counts(execute):
+    """
+    Returns the numbers of locked and unlocked customers
+
+    The locked ones are counted from the small partial index and the unlocked
+    ones are the total minus them
+
+    Args:
+        execute (function): runs a statement, db.session.execute or Connection.execute
+    """
+    locked = select([func.count()]).select_from(customer_table).where(locked_criteria(True))
+    total = select([func.count()]).select_from(customer_table)
+    locked, total = execute(select([locked.as_scalar(), total.as_scalar()])).first()
+    return {"locked": locked, "unlocked": total - locked}
+
+
+def find_lock_counts():
+    """ Returns the numbers of locked and unlocked customers """
+    logger.info("Processing lock count query")
+    return fetch_lock_counts(db.session.execute)
+
+
+def iter_usernames():
+    """ Streams the usernames of all the customers """
+    logger.info("Processing username scan")
+    query = select([customer_table.c.username]).execution_options(stream_results=True)
+    for row in db.session.execute(query):
+        yield row[0]
+
+
+def find_address(address_id):
+    """ Returns the AddressRecord with the given id or None """
+    logger.info("Processing address record lookup for id %s ...", address_id)
+    query = select([address_table.c[name] for name in ADDRESS_COLUMNS]).where(
+        address_table.c.address_id == address_id
+    )
+    row = db.session.execute(query).first()
+    return AddressRecord(*row) if row else None
+
+
+######################################################################
+#  S T A T I S T I C S
+######################################################################
+
+def stats_document(customers, locked, addresses, regions):
+    """
+    Returns the statistics of the customers
+
+    Args:
+        regions (list): (country, state, customers, addresses) tuples
+    """
+    return {
+        "customers": customers,
+        "locked": locked,
+        "unlocked": customers - locked,
+        "locked_ratio": locked / customers if customers else 0.0,
+        "addresses": addresses,
+        "addresses_per_customer": addresses / customers if customers else 0.0,
+        "regions": [{"country": country, "state": state, "customers": region_customers,
+                     "addresses": region_addresses}
+                    for country, state, region_customers, region_addresses in sorted(regions)
+                    if region_customers or region_addresses],
+    }
+
+
+def _stats_totals():
+    """ The scalar subqueries counting the customers, the locked ones and the addresses """
+    count = select([func.count()]).select_from(customer_table)
+    return [count.as_scalar(), count.where(locked_criteria(True)).as_scalar(),
+            select([func.count()]).select_from(address_table).as_scalar()]
+
+
+def _region_counts():
+    """ The customers and the addresses of every (country, state) """
+    return select([address_table.c.country, address_table.c.state,
+                   func.count(address_table.c.customer_id.distinct()), func.count()]) \
+        .group_by(address_table.c.country, address_table.c.state)
+
+
+def fetch_stats(execute, rollups=True):
+    """
+    Returns the totals and the regions of the customers
+
+    Reading the rollup tables costs the same however many customers there
+    are, the writes of service.models keep them up to date with STATS_ROLLUPS.
+    Without rollups the customers and the addresses are counted
+
+    Args:
+        execute (function): runs a statement, db.session.execute or Connection.execute
+        rollups (bool): read the rollup tables
+    Returns:
+        tuple: the customers, locked and addresses totals and a list of
+            (country, state, customers, addresses) tuples
+    """
+    if rollups:
+        totals = execute(select([func.coalesce(func.sum(customer_stats_table.c[name]), 0)
+                                 for name in ("customers", "locked", "addresses")])).first()
+        regions = execute(select([region_stats_table.c[name] for name in
+                                  ("country", "state", "customers", "addresses")])).fetchall()
+    else:
+        totals = execute(select(_stats_totals())).first()
+        regions = execute(_region_counts()).fetchall()
+    return tuple(totals), [tuple(row) for row in regions]
+
+
+def find_stats():
+    """ Returns the statistics of the customers """
+    logger.info("Processing statistics query")
+    totals, regions = fetch_stats(db.session.execute, stats_rollups_enabled())
+    return stats_document(*totals, regions)
+
+
+def rebuild_stats_tables(execute, dialect):
+    """
+    Recomputes the rollup tables from the customers and the addresses
+
+    Run it in a transaction. On Postgres the rollup tables are locked first:
+    the writes wait until the rebuild commits and add their changes to the
+    new totals. Other databases have a single writer.
+
+    Args:
+        execute (function): runs a statement, Connection.execute
+        dialect (string): the name of the database dialect
+    """
+    if dialect == "postgresql":
+        execute(text("LOCK TABLE customer_stats, region_stats IN EXCLUSIVE MODE"))
+    execute(customer_stats_table.delete())
+    execute(region_stats_table.delete())
+    execute(customer_stats_table.insert().from_select(
+        ["slot", "customers", "locked", "addresses"],
+        select([literal_column("0")] + _stats_totals())
+    ))
+    execute(region_stats_table.insert().from_select(
+        ["country", "state", "customers", "addresses"], _region_counts()
+    ))
+
+
+######################################################################
+#  S E R V E R   S I D E   J S O N   D O C U M E N T S
+######################################################################
+
+def json_aggregation_available():
+    """ Returns True when the database can build the JSON documents itself """
+    return bool(current_app.config.get("JSON_AGGREGATION")) and \
+        db.engine.dialect.name == "postgresql"
+
+
+def _address_document(address):
+    """ Builds a json_build_object() expression for an address table """
+    pairs = []
+    for name in ADDRESS_COLUMNS:
+        pairs.extend([literal_column("'%s'" % name), address.c[name]])
+    return func.json_build_object(*pairs)
+
+
+def _customer_document():
+    """ Builds a json_build_object() expression for a customer with its addresses """
+    address = address_table.alias("a")
+    addresses = select([
+        func.coalesce(
+            func.json_agg(aggregate_order_by(_address_document(address), address.c.address_id)),
+            literal_column("'[]'::json"),
+        )
+    ]).where(address.c.customer_id == customer_table.c.id).as_scalar()
+    pairs = []
+    for name in CUSTOMER_DOCUMENT_KEYS:
+        value = addresses if name == "addresses" else customer_table.c[name]
+        pairs.extend([literal_column("'%s'" % name), value])
+    return func.json_build_object(*pairs)
+
+
+def customer_documents_query(criteria=()):
+    """ Returns a SELECT producing one JSON array of all matching customers as text """
+    documents = select([_customer_document().label("document")])
+    for criterion in criteria:
+        documents = documents.where(criterion)
+    documents = documents.alias("documents")
+    return select([
+        cast(func.coalesce(func.json_agg(documents.c.document), literal_column("'[]'::json")), Text)
+    ])
+
+
+def customer_document_query(customer_id):
+    """ Returns a SELECT producing the JSON document of a single customer as text """
+    return select([cast(_customer_document(), Text)]).where(customer_table.c.id == customer_id)
+
+
+def find_customer_documents(criteria=()):
+    """ Returns the JSON text of an array of customers built by the database """
+    logger.info("Processing customer documents query")
+    return db.session.execute(customer_documents_query(criteria)).scalar()
+
+
+def find_customer_document(customer_id):
+    """ Returns the JSON text of a customer built by the database or None """
+    logger.info("Processing document lookup for id %s ...", customer_id)
+    return db.session.execute(customer_document_query(customer_id)).scalar()
+
+
+######################################################################
+#  R E A D   M O D E L
+######################################################################
+
+def read_model_enabled():
+    """ Returns True when the GET requests are served from the stored documents """
+    config = current_app.config
+    return bool(config.get("READ_MODEL") and config.get("READ_MODEL_READS"))
+
+
+def fetch_stored_document(execute, customer_id):
+    """ Returns the stored JSON text of a customer or None """
+    return execute(select([document_table.c.document]).where(
+        document_table.c.customer_id == customer_id
+    )).scalar()
+
+
+def fetch_stored_documents(execute, criteria=()):
+    """ Returns the (id, JSON text) of the stored documents of the matching customers in id order """
+    query = select([document_table.c.customer_id, document_table.c.document]).select_from(
+        document_table.join(customer_table, customer_table.c.id == document_table.c.customer_id)
+    )
+    for criterion in criteria:
+        query = query.where(criterion)
+    return [tuple(row) for row in execute(query.order_by(document_table.c.customer_id))]
+
+
+def find_stored_document(customer_id):
+    """ Returns the stored JSON text of a customer or None """
+    logger.info("Processing stored document lookup for id %s ...", customer_id)
+    return fetch_stored_document(db.session.execute, customer_id)
+
+
+def find_stored_documents(criteria=()):
+    """ Returns the JSON text of an array of the stored documents of the matching customers """
+    logger.info("Processing stored documents query")
+    documents = fetch_stored_documents(db.session.execute, criteria)
+    return "[" + ", ".join(document for _, document in documents) + "]"
+
+
+def check_documents(engine, batch_size=500):
+    """
+    Compares the stored documents with the customers they were built from
+
+    The check reads a single snapshot of the database (REPEATABLE READ on
+    Postgres), so the writes committing meanwhile are not taken for stale
+    documents
+
+    Returns:
+        dict: the number of customers checked and the ids of the customers
+            without a document (missing), with an outdated one (stale) and of
+            the documents of deleted customers (orphaned)
+    """
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            connection = connection.execution_options(isolation_level="REPEATABLE READ")
+        with connection.begin():
+            return _check_documents(connection.execute, batch_size)
+
+
+def _check_documents(execute, batch_size):
+    report = {"checked": 0, "missing": [], "stale": [], "orphaned": []}
+    last_id = None
+    while True:
+        query = select([customer_table.c.id]).order_by(customer_table.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(customer_table.c.id > last_id)
+        customer_ids = [row[0] for row in execute(query)]
+        if not customer_ids:
+            break
+        expected = build_documents(execute, customer_ids)
+        stored = dict(execute(select([document_table.c.customer_id, document_table.c.document])
+                              .where(document_table.c.customer_id.in_(customer_ids))).fetchall())
+        for customer_id in customer_ids:
+            if customer_id not in stored:
+                report["missing"].append(customer_id)
+            elif stored[customer_id] != expected.get(customer_id):
+                report["stale"].append(customer_id)
+        report["checked"] += len(customer_ids)
+        last_id = customer_ids[-1]
+    report["orphaned"] = [row[0] for row in execute(
+        select([document_table.c.customer_id]).where(
+            ~document_table.c.customer_id.in_(select([customer_table.c.id]))
+        ).order_by(document_table.c.customer_id)
+    )]
+    return report
+
+
+def rebuild_documents(engine, batch_size=500):
+    """
+    Rewrites the stored documents of all the customers from the tables
+
+    Every batch is written in its own transaction with the customer rows
+    locked like the writes lock them, so the service keeps running during a
+    rebuild. Documents that did not change keep their version.
+
+    Returns:
+        int: the number of documents created, changed or removed
+    """
+    written, last_id = 0, None
+    while True:
+        query = select([customer_table.c.id]).order_by(customer_table.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(customer_table.c.id > last_id)
+        with engine.begin() as connection:
+            customer_ids = [row[0] for row in connection.execute(query)]
+            written += write_documents(connection.execute, customer_ids)
+        if len(customer_ids) < batch_size:
+            break
+        last_id = customer_ids[-1]
+    with engine.begin() as connection:
+        written += connection.execute(document_table.delete().where(
+            ~document_table.c.customer_id.in_(select([customer_table.c.id]))
+        )).rowcount
+    return written
+
+
+######################################################################
+#  C H A N G E   F E E D
+######################################################################
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class Change:
+    """ An upsert or a delete of a Customer in the change feed """
+
+    __slots__ = ("type", "id", "timestamp", "customer")
+
+    def __init__(self, type, id, timestamp, customer=None):
+        # pylint: disable=redefined-builtin
+        self.type = type
+        self.id = id
+        self.timestamp = timestamp
+        self.customer = customer
+
+    def __repr__(self):
+        return "<Change %s id=[%s] at %s>" % (self.type, self.id, self.timestamp)
+
+    @property
+    def key(self):
+        """ The position of the change in the feed """
+        return (self.timestamp, self.id)
+
+    @property
+    def changed_at(self):
+        """ The time of the change in ISO 8601 (UTC) """
+        return self.timestamp.isoformat() + "Z"
+
+    @property
+    def cursor(self):
+        """ The cursor continuing the feed after this change """
+        return encode_cursor(self.key)
+
+
+def encode_cursor(key):
+    """ Encodes a (timestamp, id) feed position as an opaque cursor """
+    timestamp, customer_id = key
+    microseconds = calendar.timegm(timestamp.utctimetuple()) * 10 ** 6 + timestamp.microsecond
+    return "{}-{}".format(microseconds, customer_id)
+
+
+def decode_cursor(cursor):
+    """ Decodes a cursor into a (timestamp, id) feed position """
+    try:
+        microseconds, customer_id = cursor.split("-")
+        return (EPOCH + timedelta(microseconds=int(microseconds)), int(customer_id))
+    except (ValueError, OverflowError):
+        raise DataValidationError("Invalid change feed cursor '{}'".format(cursor))
+
+
+def _after(timestamp_column, id_column, since):
+    """ The rows of a feed table after the since position """
+    timestamp, last_id = since
+    return or_(timestamp_column > timestamp,
+               and_(timestamp_column == timestamp, id_column > last_id))
+
+
+def fetch_changes(execute, since=None, until=None, limit=100):
+    """
+    Returns up to limit Changes of one database in feed order
+
+    Args:
+        execute (function): runs a statement, db.session.execute or Connection.execute
+        since (tuple): the (timestamp, id) position of the last change already seen
+        until (datetime): leaves out the changes made after this time
+        limit (int): the maximum number of changes to return
+    """
+    upserts = select([customer_table.c[name] for name in CUSTOMER_COLUMNS]
+                     + [customer_table.c.updated_at])
+    deletes = select([tombstone_table.c.customer_id, tombstone_table.c.deleted_at])
+    if since is not None:
+        upserts = upserts.where(_after(customer_table.c.updated_at, customer_table.c.id, since))
+        deletes = deletes.where(_after(tombstone_table.c.deleted_at,
+                                       tombstone_table.c.customer_id, since))
+    if until is not None:
+        upserts = upserts.where(customer_table.c.updated_at <= until)
+        deletes = deletes.where(tombstone_table.c.deleted_at <= until)
+    upserts = upserts.order_by(customer_table.c.updated_at, customer_table.c.id).limit(limit)
+    deletes = deletes.order_by(tombstone_table.c.deleted_at,
+                               tombstone_table.c.customer_id).limit(limit)
+
+    changes = [Change("upsert", row[0], row[-1], CustomerRecord(*row[:-1]))
+               for row in execute(upserts)]
+    changes.extend(Change("delete", row[0], row[1]) for row in execute(deletes))
+    changes.sort(key=lambda change: change.key)
+    del changes[limit:]
+
+    customers = {change.id: change.customer for change in changes if change.customer}
+    if customers:
+        addresses = select([address_table.c[name] for name in ADDRESS_COLUMNS]).where(
+            address_table.c.customer_id.in_(list(customers))
+        ).order_by(address_table.c.address_id)
+        for row in execute(addresses):
+            customers[row[0]].addresses.append(AddressRecord(*row))
+    return changes
+
+
+def find_changes(since=None, until=None, limit=100):
+    """ Returns up to limit Changes after the since position """
+    logger.info("Processing change feed query after %s", since)
+    return fetch_changes(db.session.execute, since, until, limit)
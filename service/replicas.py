@@ -0,0 +1,206 @@
+"""
+Read replica routing for the Customer service
+
+Writes always go to the primary database (SQLALCHEMY_DATABASE_URI) while
+GET and HEAD requests, and the POST actions listed in READ_ENDPOINTS that
+only read, are served by one of the replicas listed in DATABASE_REPLICA_URIS,
+which are configured as SQLAlchemy binds.
+
+Clients read their own writes: every successful write sets a cookie that
+keeps the client on the primary for READ_YOUR_WRITES_SECONDS, and a request
+may always ask for the primary with the X-Read-Primary header.
+
+Replicas are checked by a background thread at most every
+REPLICA_CHECK_INTERVAL seconds, so requests never wait for a slow replica:
+each lag query is cancelled after REPLICA_CHECK_TIMEOUT seconds. A replica
+that is unreachable or lags more than REPLICA_MAX_LAG seconds behind the
+primary is taken out of rotation until it catches up, and reads go to the
+primary until the first check has finished.
+"""
+import itertools
+import logging
+import threading
+import time
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, text
+
+logger = logging.getLogger("flask.app")
+
+READ_METHODS = ("GET", "HEAD")
+# The endpoints of POST actions that only read, e.g. a batch lookup, see read_endpoint()
+READ_ENDPOINTS = set()
+READ_PRIMARY_HEADER = "X-Read-Primary"
+READ_PRIMARY_COOKIE = "read_primary_until"
+# the time since the last replayed transaction keeps growing while the primary
+# is idle, a replica that replayed everything it received is not lagging
+POSTGRES_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+def replica_lag(engine, timeout=None):
+    """
+    Returns how many seconds a replica lags behind its primary
+
+    Args:
+        engine (Engine): the engine of the replica
+        timeout (float): seconds after which the lag query is cancelled
+    """
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            with connection.begin():
+                if timeout:
+                    connection.execute(text(
+                        "SET LOCAL statement_timeout = {:d}".format(int(timeout * 1000))
+                    ))
+                return float(connection.execute(POSTGRES_LAG_QUERY).scalar() or 0)
+        # other databases can only tell us that they are reachable
+        connection.execute(text("SELECT 1"))
+        return 0.0
+
+
+class ReplicaPool:
+    """ Keeps track of the healthy replicas and hands them out in turn """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._checked_at = None
+        self._checking = False
+        self._generation = 0
+        self.healthy = []
+        self.checks = 0
+
+    def reset(self):
+        """ Forgets the health of all replicas so they are checked again """
+        with self._lock:
+            self._checked_at = None
+            self._generation += 1
+            self.healthy = []
+
+    def check(self, db, app):
+        """ Measures the lag of every replica and keeps the healthy ones """
+        with self._lock:
+            generation = self._generation
+        max_lag = app.config.get("REPLICA_MAX_LAG", 5)
+        timeout = app.config.get("REPLICA_CHECK_TIMEOUT", 1)
+        healthy = []
+        for bind in app.config.get("REPLICA_BINDS", []):
+            try:
+                lag = replica_lag(db.get_engine(app, bind=bind), timeout)
+            except Exception as error:  # any failure takes the replica out
+                logger.warning("Replica %s is unavailable: %s", bind, error)
+                continue
+            if lag > max_lag:
+                logger.warning("Replica %s lags %.1f seconds behind", bind, lag)
+                continue
+            healthy.append(bind)
+        with self._lock:
+            # a reset while we were checking makes our results stale
+            if generation == self._generation:
+                self.healthy = healthy
+                self._checked_at = time.monotonic()
+            self.checks += 1
+        return healthy
+
+    def check_in_background(self, db, app):
+        """ Starts checking the replicas unless a check is running """
+        with self._lock:
+            if self._checking:
+                return
+            self._checking = True
+        threading.Thread(target=self._check, args=(db, app), name="replica-check",
+                         daemon=True).start()
+
+    def _check(self, db, app):
+        try:
+            self.check(db, app)
+        except Exception as error:  # the last healthy replicas stay until the next attempt
+            logger.error("Replica check failed: %s", error)
+        finally:
+            with self._lock:
+                self._checking = False
+
+    def choose(self, db, app):
+        """ Returns the bind key of the next healthy replica or None """
+        interval = app.config.get("REPLICA_CHECK_INTERVAL", 10)
+        with self._lock:
+            due = self._checked_at is None or time.monotonic() - self._checked_at >= interval
+            healthy = self.healthy
+        if due:
+            self.check_in_background(db, app)
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+
+replica_pool = ReplicaPool()
+
+
+class RoutingSession(SignallingSession):
+    """ A session sending the reads of read only requests to a replica """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        """ Returns the replica chosen for this request unless we are writing """
+        if not self._flushing and has_request_context():
+            bind = g.get("replica_bind")
+            if bind is not None:
+                return self.db.get_engine(self.app, bind=bind)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy using the RoutingSession """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_endpoint(resource):
+    """ Marks a Flask-RESTX Resource whose POST only reads (class decorator) """
+    READ_ENDPOINTS.add(resource.endpoint)
+    return resource
+
+
+def is_read_request():
+    """ Returns True when the current request only reads """
+    return request.method in READ_METHODS or request.endpoint in READ_ENDPOINTS
+
+
+def _wants_primary():
+    """ Returns True when the client must read its own writes """
+    if request.headers.get(READ_PRIMARY_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def route_request():
+    """ Chooses the database serving the current request (before_request hook) """
+    g.replica_bind = None
+    if not is_read_request() or not current_app.config.get("REPLICA_BINDS"):
+        return
+    if _wants_primary():
+        return
+    db = current_app.extensions["sqlalchemy"].db
+    # the check thread outlives the request and needs the app itself
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    g.replica_bind = replica_pool.choose(db, app)
+
+
+def stick_to_primary(response):
+    """ Keeps a client that just wrote on the primary (after_request hook) """
+    window = current_app.config.get("READ_YOUR_WRITES_SECONDS", 0)
+    if (not is_read_request() and response.status_code < 400
+            and window and current_app.config.get("REPLICA_BINDS")):
+        response.set_cookie(READ_PRIMARY_COOKIE, "%.3f" % (time.time() + window),
+                            max_age=window, httponly=True)
+    return response
@@ -0,0 +1,445 @@
+"""
+Storage backends for the Customer service
+
+The routes never talk to a database directly, they call the repository
+returned by create_repository(). Every backend implements the operations of
+CustomerRepository and returns objects the serializers can encode (ORM
+instances or the records of service.queries):
+
+  sql     - the Flask-SQLAlchemy models (the default)
+  memory  - an in-process engine with hash and sorted indexes, see service.memory
+  sharded - the customers spread over SHARD_DATABASE_URIS, see service.sharding
+
+The backend is chosen with the STORAGE_BACKEND configuration.
+"""
+import logging
+import threading
+from abc import ABC, abstractmethod
+from flask import current_app
+from service.models import db, Customer, Address, ResourceConflictError, upgrade_schema
+from service.queries import find_customer, find_customers, find_address, customer_criteria, \
+    json_aggregation_available, find_customer_document, find_customer_documents, find_changes, \
+    find_customers_by_ids, iter_usernames, find_lock_counts, find_customer_count, find_stats, \
+    rebuild_stats_tables, read_model_enabled, find_stored_document, find_stored_documents, \
+    check_documents, rebuild_documents
+from service.search import SearchIndex, fetch_search, create_search_indexes
+
+logger = logging.getLogger("flask.app")
+
+CUSTOMER_UPDATE_FIELDS = ("username", "first_name", "last_name", "password")
+
+_search_index_lock = threading.Lock()
+
+
+class CustomerRepository(ABC):
+    """ The storage operations the routes rely on """
+
+    ##################################################################
+    # Customers
+    ##################################################################
+
+    @abstractmethod
+    def create_customer(self, data):
+        """
+        Creates a Customer with its addresses and returns it
+
+        Args:
+            data (dict): the request body, validated with Customer.deserialize
+        Raises:
+            DataValidationError: when the data is not a valid Customer
+            ResourceConflictError: when the username is taken
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_customer(self, customer_id, fields=None):
+        """
+        Returns the Customer with the given id or None
+
+        Args:
+            fields (tuple): the fields the caller needs, backends may leave
+                the others out, see list_customers
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_by_username(self, username):
+        """ Returns the Customer with the given username or None """
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_usernames(self):
+        """ Iterates over the usernames of all the Customers """
+        raise NotImplementedError
+
+    def sees_all_writes(self):
+        """
+        Returns True when every worker learns of every new username, through
+        the invalidation bus of service.cache or because a single process
+        holds all the data
+        """
+        return False
+
+    @abstractmethod
+    def get_customers(self, customer_ids):
+        """
+        Returns the existing Customers among customer_ids, in any order
+
+        The customers and their addresses are read from one consistent
+        snapshot where the backend allows it
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_customers(self, username=None, first_name=None, last_name=None,
+                       prefix_username=None, locked=None, sort=None, descending=False,
+                       after=None, limit=None, fields=None):
+        """
+        Returns the Customers matching all of the given filters
+
+        Args:
+            locked (bool): only the locked, or only the unlocked, Customers
+            sort (string): one of SORT_COLUMNS, or None for any order
+            descending (bool): sort in descending order
+            after (tuple): the (sort value, id) of the last customer of the
+                previous page, see service.queries.decode_page_cursor
+            limit (int): the maximum number of customers to return
+            fields (tuple): the fields of the Customers the caller needs,
+                backends may leave the others None and skip the addresses
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_customers(self, username=None, first_name=None, last_name=None,
+                        prefix_username=None, locked=None):
+        """
+        Returns the number of Customers matching all of the given filters
+
+        Returns:
+            tuple: the count and its kind, service.queries.EXACT_COUNT or
+                ESTIMATED_COUNT when the backend estimated an unfiltered count
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_lock_states(self):
+        """ Returns the numbers of locked and unlocked Customers as a dict """
+        raise NotImplementedError
+
+    @abstractmethod
+    def customer_stats(self):
+        """
+        Returns the statistics of the Customers, see service.queries.stats_document
+
+        With STATS_ROLLUPS the database backends keep them rolled up as the
+        Customers change, so reading them does not depend on the number of
+        Customers
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rebuild_stats(self):
+        """ Recomputes the rolled up statistics from the Customers """
+        raise NotImplementedError
+
+    def search_customers(self, words, limit, offset=0):
+        """
+        Returns one page of (rank, Customer) pairs matching the search, best first
+
+        The default searches an in-process trigram index of the customers that
+        follows the change feed, see service.search
+
+        Args:
+            words (list): the words returned by service.search.search_words()
+            limit (int): the maximum number of customers to return
+            offset (int): the number of better matches to skip
+        """
+        with _search_index_lock:
+            index = getattr(self, "_search_index", None)
+            if index is None:
+                index = self._search_index = SearchIndex(
+                    self, current_app.config.get("SEARCH_SIMILARITY", 0.3),
+                    current_app.config.get("CHANGES_SETTLE_SECONDS", 2.0)
+                )
+        return index.search(words, limit, offset)
+
+    @abstractmethod
+    def update_customer(self, customer_id, values):
+        """
+        Updates the fields of a Customer and returns it, or None if not found
+
+        Args:
+            values (dict): new values for some of CUSTOMER_UPDATE_FIELDS
+        Raises:
+            ResourceConflictError: when the new username is taken
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_locked(self, customer_id, locked):
+        """ Locks or unlocks a Customer and returns it, or None if not found """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_customer(self, customer_id):
+        """ Deletes a Customer with its addresses if it exists """
+        raise NotImplementedError
+
+    ##################################################################
+    # Addresses
+    ##################################################################
+
+    @abstractmethod
+    def create_address(self, customer_id, data):
+        """
+        Creates an Address for a Customer and returns it, or None if the
+        Customer does not exist
+
+        Raises:
+            DataValidationError: when the data is not a valid Address
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_address(self, customer_id, address_id):
+        """ Returns the Address of a Customer or None """
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_address(self, customer_id, address_id, data):
+        """ Replaces an Address of a Customer and returns it, or None if not found """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_address(self, customer_id, address_id):
+        """ Deletes an Address of a Customer if it exists """
+        raise NotImplementedError
+
+    ##################################################################
+    # Change feed
+    ##################################################################
+
+    @abstractmethod
+    def list_changes(self, since=None, until=None, limit=100):
+        """
+        Returns up to limit Changes (upserts and deletes of Customers) in feed order
+
+        Args:
+            since (tuple): the (timestamp, id) position of the last change already seen
+            until (datetime): leaves out the changes made after this time
+            limit (int): the maximum number of changes to return
+        """
+        raise NotImplementedError
+
+    ##################################################################
+    # Prebuilt JSON documents
+    ##################################################################
+
+    def supports_documents(self):
+        """ Returns True when the backend can build the JSON documents itself """
+        return False
+
+    def customer_document(self, customer_id):
+        """ Returns the JSON text of a Customer or None, when supports_documents() """
+        raise NotImplementedError
+
+    def customer_documents(self, **filters):
+        """ Returns the JSON text of the array of matching Customers, when supports_documents() """
+        raise NotImplementedError
+
+    ##################################################################
+    # Schema
+    ##################################################################
+
+    @abstractmethod
+    def upgrade_schema(self):
+        """
+        Adds the new tables, columns and indexes to an existing database
+
+        Returns:
+            list: a description of every change made, see service.models.upgrade_schema
+        """
+        raise NotImplementedError
+
+    ##################################################################
+    # Read model
+    ##################################################################
+
+    @abstractmethod
+    def check_documents(self):
+        """
+        Compares the stored documents of the read model with the Customers
+
+        Returns:
+            dict: see service.queries.check_documents
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rebuild_documents(self):
+        """ Rewrites the stored documents of the read model, returns how many changed """
+        raise NotImplementedError
+
+
+class SqlRepository(CustomerRepository):
+    """ Stores the Customers with the Flask-SQLAlchemy models """
+
+    def create_customer(self, data):
+        customer = Customer()
+        customer.deserialize(data)
+        if Customer.find_by_name(customer.username).first():
+            raise ResourceConflictError("Username '" + customer.username + "' already exists.")
+        customer.locked = False
+        customer.create()
+        return customer
+
+    def find_customer(self, customer_id, fields=None):
+        return find_customer(customer_id, fields)
+
+    def find_by_username(self, username):
+        return Customer.find_by_name(username).first()
+
+    def iter_usernames(self):
+        return iter_usernames()
+
+    def sees_all_writes(self):
+        return True
+
+    def get_customers(self, customer_ids):
+        return find_customers_by_ids(customer_ids)
+
+    def list_customers(self, username=None, first_name=None, last_name=None,
+                       prefix_username=None, locked=None, sort=None, descending=False,
+                       after=None, limit=None, fields=None):
+        return find_customers(
+            customer_criteria(username, first_name, last_name, prefix_username, locked),
+            sort, descending, after, limit, fields
+        )
+
+    def count_customers(self, username=None, first_name=None, last_name=None,
+                        prefix_username=None, locked=None):
+        return find_customer_count(
+            customer_criteria(username, first_name, last_name, prefix_username, locked),
+            current_app.config.get("EXACT_COUNT_BELOW", 10000)
+        )
+
+    def count_lock_states(self):
+        return find_lock_counts()
+
+    def customer_stats(self):
+        return find_stats()
+
+    def rebuild_stats(self):
+        engine = db.engine
+        with engine.begin() as connection:
+            rebuild_stats_tables(connection.execute, engine.dialect.name)
+
+    def search_customers(self, words, limit, offset=0):
+        if db.session.get_bind().dialect.name != "postgresql":
+            return super().search_customers(words, limit, offset)
+        return fetch_search(db.session.execute, words, limit, offset)
+
+    def update_customer(self, customer_id, values):
+        customer = Customer.find(customer_id)
+        if not customer:
+            return None
+        username = values.get("username", customer.username)
+        if username != customer.username and Customer.find_by_name(username).first():
+            raise ResourceConflictError("Username '" + username + "' already exists.")
+        for key, value in values.items():
+            setattr(customer, key, value)
+        customer.update()
+        return customer
+
+    def set_locked(self, customer_id, locked):
+        customer = Customer.find(customer_id)
+        if not customer:
+            return None
+        customer.locked = locked
+        customer.update()
+        return customer
+
+    def delete_customer(self, customer_id):
+        customer = Customer.find(customer_id)
+        if customer:
+            customer.delete()
+
+    def create_address(self, customer_id, data):
+        if not Customer.find(customer_id):
+            return None
+        address = Address()
+        address.deserialize(data)
+        address.customer_id = customer_id
+        address.create()
+        return address
+
+    def find_address(self, customer_id, address_id):
+        address = find_address(address_id)
+        if not address or address.customer_id != customer_id:
+            return None
+        return address
+
+    def update_address(self, customer_id, address_id, data):
+        address = Address.find(address_id)
+        if not address or address.customer_id != customer_id:
+            return None
+        address.deserialize(data)
+        address.update()
+        return address
+
+    def delete_address(self, customer_id, address_id):
+        address = Address.find(address_id)
+        if address and address.customer_id == customer_id:
+            address.delete()
+
+    def list_changes(self, since=None, until=None, limit=100):
+        return find_changes(since, until, limit)
+
+    def supports_documents(self):
+        return read_model_enabled() or json_aggregation_available()
+
+    def customer_document(self, customer_id):
+        if read_model_enabled():
+            return find_stored_document(customer_id)
+        return find_customer_document(customer_id)
+
+    def customer_documents(self, username=None, first_name=None, last_name=None,
+                           prefix_username=None, locked=None):
+        # pylint: disable=arguments-differ
+        criteria = customer_criteria(username, first_name, last_name, prefix_username, locked)
+        if read_model_enabled():
+            return find_stored_documents(criteria)
+        return find_customer_documents(criteria)
+
+    def upgrade_schema(self):
+        changes = upgrade_schema(db.engine)
+        # the existing customers were never counted in the rollups
+        self.rebuild_stats()
+        return changes
+
+    def check_documents(self):
+        return check_documents(db.engine)
+
+    def rebuild_documents(self):
+        return rebuild_documents(db.engine)
+
+
+def create_repository(app):
+    """ Returns the repository configured by STORAGE_BACKEND """
+    backend = app.config.get("STORAGE_BACKEND", "sql")
+    logger.info("Using the %s storage backend", backend)
+    if backend == "sql":
+        Customer.init_db(app)
+        create_search_indexes(db.get_engine(app))
+        return SqlRepository()
+    if backend == "memory":
+        from service.memory import MemoryRepository
+        return MemoryRepository()
+    if backend == "sharded":
+        from service.sharding import ShardRouter, ShardedRepository
+        router = ShardRouter(app.config["SHARD_DATABASE_URIS"],
+                             read_model=app.config.get("READ_MODEL", False),
+                             stats_rollups=app.config.get("STATS_ROLLUPS", False))
+        router.create_all()
+        return ShardedRepository(router)
+    raise ValueError("Unknown STORAGE_BACKEND '{}'".format(backend))
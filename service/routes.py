@@ -7,16 +7,42 @@ A service for manipulating and accessing customer information for the eCommerce
 import os
 import sys
 import logging
-from flask import Flask, jsonify, request, make_response, abort
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+import click
+from flask import Flask, jsonify, request, make_response, abort, g
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from . import status  # HTTP Status Codes
 
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Customer, Address, DataValidationError, ResourceConflictError, UnsupportedKeyError
+from service.models import db, DataValidationError, ResourceConflictError, UnsupportedKeyError
+from service.serializers import serialize_with, json_passthrough_allowed, json_response, \
+    payload_mimetypes, request_payload, requested_fields
+from service.compression import compress_response
+from service.replicas import route_request, stick_to_primary, read_endpoint
+from service.repository import SqlRepository, create_repository, CUSTOMER_UPDATE_FIELDS
+from service.queries import encode_cursor, decode_cursor, EPOCH, SORT_COLUMNS, \
+    encode_page_cursor, decode_page_cursor
+from service.outbox import start_publisher, outbox_metrics
+from service.usernames import create_username_filter, create_username_index
+from service.search import search_words
+from service.cache import create_cache, create_query_cache, create_negative_cache, query_key, \
+    start_listener, cache_metrics, single_flight, bus
 from werkzeug.exceptions import NotFound
 # Import Flask application
 from . import app
 
+# The storage backend, replaced by init_db() according to STORAGE_BACKEND
+repository = SqlRepository()
+# The customer and list caches of this worker, created by init_db() with CACHE_ENABLED
+customer_cache = None
+query_cache = None
+negative_cache = None
+# The Bloom filter of the usernames, built by init_db() with USERNAME_FILTER
+username_filter = None
+# The sorted usernames for autocomplete, built by init_db() with USERNAME_INDEX
+username_index = None
+
 ######################################################################
 # Serve UI HTML 
 ######################################################################
@@ -25,6 +51,18 @@ def index():
     """ Root URL response """
     return app.send_static_file("index.html")
 
+@app.route("/outbox/metrics")
+def outbox_metrics_view():
+    """ Backlog, lag and delivery counters of the event outbox """
+    return jsonify(outbox_metrics())
+
+@app.route("/cache/metrics")
+def cache_metrics_view():
+    """ Size, hit rate and invalidations of the customer cache of this worker """
+    return jsonify(cache_metrics(customers=customer_cache, queries=query_cache,
+                                 missing=negative_cache, single_flight=single_flight,
+                                 usernames=username_filter, username_index=username_index))
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -100,11 +138,108 @@ customer_model = api.inherit(
     }
 )
 
+# the fields a client may pick with fields=, the addresses are only read when picked
+CUSTOMER_FIELDS = ', '.join(customer_model.resolved)
+
+change_model = api.model('Change', {
+    'type': fields.String(description='upsert or delete'),
+    'id': fields.Integer(description='The id of the changed customer'),
+    'changed_at': fields.String(description='When the customer changed (ISO 8601, UTC)'),
+    'customer': fields.Nested(customer_model, allow_null=True,
+                                description='The customer after an upsert, null for a delete')
+})
+
+change_feed_model = api.model('ChangeFeed', {
+    'changes': fields.List(fields.Nested(change_model),
+                                description='The changes after the cursor, oldest first'),
+    'next': fields.String(description='The cursor to pass as since to get the next changes')
+})
+
+batch_get_model = api.model('BatchGetRequest', {
+    'ids': fields.List(fields.Integer, required=True,
+                                description='The ids of the customers to return')
+})
+
+batch_entry_model = api.model('BatchGetEntry', {
+    'id': fields.Integer(description='A requested customer id'),
+    'found': fields.Boolean(description='Does the customer exist?'),
+    'customer': fields.Nested(customer_model, allow_null=True,
+                                description='The customer, null when it was not found')
+})
+
+batch_result_model = api.model('BatchGetResult', {
+    'customers': fields.List(fields.Nested(batch_entry_model),
+                                description='One entry per requested id, in request order')
+})
+
+username_model = api.model('UsernameAvailability', {
+    'username': fields.String(description='The checked username'),
+    'available': fields.Boolean(description='Is the username free?'),
+    'checked_by': fields.String(description='filter when the username filter answered alone, '
+                                'database when the database was asked')
+})
+
+autocomplete_model = api.model('UsernameAutocomplete', {
+    'prefix': fields.String(description='The searched prefix'),
+    'usernames': fields.List(fields.String, description='The first matching usernames, '
+                             'ordered case insensitively'),
+    'searched_by': fields.String(description='index when the username index answered, '
+                                 'database when the database was asked')
+})
+
+lock_counts_model = api.model('LockCounts', {
+    'locked': fields.Integer(description='The number of locked customers'),
+    'unlocked': fields.Integer(description='The number of unlocked customers')
+})
+
+region_stats_model = api.model('RegionStats', {
+    'country': fields.String(description='The country of the addresses'),
+    'state': fields.String(description='The state of the addresses'),
+    'customers': fields.Integer(description='The number of customers with an address there'),
+    'addresses': fields.Integer(description='The number of addresses there')
+})
+
+stats_model = api.model('CustomerStats', {
+    'customers': fields.Integer(description='The number of customers'),
+    'locked': fields.Integer(description='The number of locked customers'),
+    'unlocked': fields.Integer(description='The number of unlocked customers'),
+    'locked_ratio': fields.Float(description='The share of the customers that are locked'),
+    'addresses': fields.Integer(description='The number of addresses'),
+    'addresses_per_customer': fields.Float(description='The average number of addresses of a customer'),
+    'regions': fields.List(fields.Nested(region_stats_model),
+                                description='The customers and addresses per country and state')
+})
+
 customer_args = reqparse.RequestParser()
 customer_args.add_argument('username', type=str, required=False, location='args', help='List Customers by username')
 customer_args.add_argument('first_name', type=str, required=False, location='args', help='List Customers by first name')
 customer_args.add_argument('last_name', type=str, required=False, location='args', help='List Customers by last name')
 customer_args.add_argument('prefix_username', type=str, required=False, location='args', help='List Customers by username prefix')
+customer_args.add_argument('locked', type=inputs.boolean, required=False, location='args', help='List only the locked (true) or the unlocked (false) Customers')
+customer_args.add_argument('q', type=str, required=False, location='args', help='Search Customers by name, username and address, best matches first')
+customer_args.add_argument('sort', type=str, required=False, location='args', choices=SORT_COLUMNS, help='Sort the Customers by this field, ties by id')
+customer_args.add_argument('order', type=str, required=False, location='args', choices=('asc', 'desc'), help='The order of the sort, asc by default')
+customer_args.add_argument('limit', type=int, required=False, location='args', help='The maximum number of Customers to return, the Link header points to the next page')
+customer_args.add_argument('after', type=str, required=False, location='args', help='The cursor of the next page, from the Link header of the previous one')
+customer_args.add_argument('count', type=inputs.boolean, required=False, location='args', help='Return the number of matching Customers in the X-Total-Count header')
+customer_args.add_argument('fields', type=str, required=False, location='args', help='Return only these comma separated fields of the Customers: ' + CUSTOMER_FIELDS)
+customer_args.add_argument('offset', type=int, required=False, location='args', help='The number of search results to skip')
+
+# the filters of customer_args, HEAD counts the customers matching them
+count_args = customer_args.copy()
+for name in ('q', 'sort', 'order', 'limit', 'after', 'count', 'fields', 'offset'):
+    count_args.remove_argument(name)
+
+customer_fields_args = reqparse.RequestParser()
+customer_fields_args.add_argument('fields', type=str, required=False, location='args', help='Return only these comma separated fields of the Customer: ' + CUSTOMER_FIELDS)
+
+change_args = reqparse.RequestParser()
+change_args.add_argument('since', type=str, required=False, location='args', help='The cursor returned by the previous request')
+change_args.add_argument('limit', type=int, required=False, location='args', help='The maximum number of changes to return')
+
+autocomplete_args = reqparse.RequestParser()
+autocomplete_args.add_argument('prefix', type=str, required=True, location='args', help='The start of the usernames')
+autocomplete_args.add_argument('limit', type=int, required=False, location='args', help='The maximum number of usernames to return')
 
 address_args = reqparse.RequestParser()
 address_args.add_argument('street_address', type=str, required=False, location='args', help='List Customer\'s Addresses by street address')
@@ -113,6 +248,13 @@ address_args.add_argument('state', type=str, required=False, location='args', he
 address_args.add_argument('zipcode', type=str, required=False, location='args', help='List Customer\'s Addresses by zipcode')
 address_args.add_argument('country', type=str, required=False, location='args', help='List Customer\'s Addresses by country')
 
+######################################################################
+# Route reads to the replicas and compress large responses
+######################################################################
+app.before_request(route_request)
+app.after_request(stick_to_primary)
+app.after_request(compress_response)
+
 ######################################################################
 # Special Error Handlers
 ###################################################################### 
@@ -173,7 +315,7 @@ class AddressResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_addresses')
     @api.response(404, 'The specified address belonging to the specified customer was not found')
-    @api.marshal_with(address_model)
+    @serialize_with(address_model)
     def get(self, customer_id, address_id):
         """
         Retrieve a single customer's address
@@ -182,10 +324,10 @@ class AddressResource(Resource):
         """
         app.logger.info(f"Request address with address_id {address_id} for customer with customer_id {customer_id}")
     
-        address = Address.find(address_id)
-        if not address or address.customer_id != customer_id:
+        address = repository.find_address(customer_id, address_id)
+        if not address:
             raise NotFound("Address with id '{}' for customer with id '{}' was not found.".format(address_id, customer_id))
-        return address.serialize(), status.HTTP_200_OK
+        return address, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # UPDATE A CUSTOMER'S ADDRESS
@@ -194,25 +336,22 @@ class AddressResource(Resource):
     @api.response(404, 'The specified address belonging to the specified customer was not found')
     @api.response(400, 'The posted Address data was not valid')
     @api.expect(create_address_model)
-    @api.marshal_with(address_model)   
+    @serialize_with(address_model)   
     def put(self, customer_id, address_id):
         """
         Update a Customer's address
         This endpoint will update a Customer's addresses based on the request body.
         """
         app.logger.info("Request to update addresses of Customer with id: %s", customer_id)
-        check_content_type("application/json")
-        check_address_data(api.payload)
-        address = Address.find(address_id)
-        if not address or address.customer_id != customer_id:
+        check_content_type(*payload_mimetypes())
+        payload = request_payload()
+        check_address_data(payload)
+        address = repository.update_address(customer_id, address_id, payload)
+        if not address:
             raise NotFound("Address with id '{}' for customer with id '{}' was not found.".format(address_id, customer_id))
 
-        address.deserialize(api.payload)
-        address.address_id = address_id
-        address.update()
-
         app.logger.info("address with ID [%s] for customer with ID [%s] updated.", address.address_id, customer_id)
-        return address.serialize(), status.HTTP_200_OK
+        return address, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # DELETE A CUSTOMER'S ADDRESS
@@ -225,10 +364,7 @@ class AddressResource(Resource):
         This endpoint will delete a Customer's address based the customer_id and address_id specified in the path.
         """
         app.logger.info("Request to delete address with id: %s, customer with id: %s", address_id, customer_id)
-        customer = Customer.find(customer_id)
-        if customer:
-            address = Address.find(address_id)
-            if address: address.delete()
+        repository.delete_address(customer_id, address_id)
         return "", status.HTTP_204_NO_CONTENT
 
 ######################################################################
@@ -254,7 +390,7 @@ class AddressCollection(Resource):
     @api.response(404, 'Customer not found')
     @api.response(400, 'The posted Address data was not valid')
     @api.expect(create_address_model)
-    @api.marshal_with(address_model)  
+    @serialize_with(address_model)  
     def post(self, customer_id):
         """
         Creates an Address for the Customer with an id equal to customer_id
@@ -262,19 +398,15 @@ class AddressCollection(Resource):
         to the customer_id based on the data in the request body
         """  
         app.logger.info("Request to create address for customer with id {}".format(customer_id))
-        check_content_type("application/json")
-        check_address_data(api.payload)
-        customer = Customer.find(customer_id)
-        if not customer:
+        check_content_type(*payload_mimetypes())
+        payload = request_payload()
+        check_address_data(payload)
+        address = repository.create_address(customer_id, payload)
+        if not address:
             raise NotFound(f"Customer with id '{customer_id}' was not found.")
-        address = Address()
-        address.deserialize(api.payload)
-        address.customer_id = customer_id
-        address.create()
-        message = address.serialize()
-        location_url = api.url_for(AddressResource, customer_id = customer.id, 
+        location_url = api.url_for(AddressResource, customer_id = customer_id, 
             address_id = address.address_id, _external = True)
-        return message, status.HTTP_201_CREATED, {"Location": location_url}
+        return address, status.HTTP_201_CREATED, {"Location": location_url}
 
     #------------------------------------------------------------------
     # RETRIEVE A CUSTOMER'S ADDRESSES
@@ -282,18 +414,17 @@ class AddressCollection(Resource):
     @api.doc('list_addresses')
     @api.response(404, 'Customer not found')
     @api.expect(address_args, validate=True)
-    @api.marshal_list_with(address_model) 
+    @serialize_with(address_model, as_list=True) 
     def get(self, customer_id):
         """
         Retrieve a single customer's addresses
         This endpoint will return a customer's addresses based on the customer's id
         """  
         app.logger.info(f"Request addresses for customer with customer_id: {customer_id}")
-        customer = Customer.find(customer_id)
+        customer = read_customer(customer_id)
         if not customer:
             raise NotFound(f"Customer with id '{customer_id}' was not found.")
-        customer_dict = customer.serialize()
-        addresses = customer_dict["addresses"]
+        addresses = customer.addresses
 
         if len(request.args) != 0:
             all_query_key = ["city", "state", "country", "zipcode", "street_address"]
@@ -313,7 +444,7 @@ class AddressCollection(Resource):
                 found = 0
                 for query_key in args.keys():
                     value = args[query_key]
-                    found = 1 if str(address[query_key]) == value else 0
+                    found = 1 if str(getattr(address, query_key)) == value else 0
                     if not found: break
                     if found:  
                         filter_addresses.append(address)
@@ -340,19 +471,17 @@ class LockAction(Resource):
     #------------------------------------------------------------------
     @api.doc('lock_customer')
     @api.response(404, 'The specified customer was not found')
-    @api.marshal_with(customer_model)
+    @serialize_with(customer_model)
     def put(self, customer_id):
         """
         Lock a Customer
         """
         app.logger.info("Request to lock Customer with id: %s", customer_id)
-        customer = Customer.find(customer_id)
+        customer = repository.set_locked(customer_id, True)
         if not customer:
             raise NotFound("customer with id '{}' was not found.".format(customer_id))
-        customer.locked = True
-        customer.update()
         app.logger.info("customer with ID [%s] is locked.", customer.id)
-        return customer.serialize_for_lock(), status.HTTP_200_OK
+        return customer, status.HTTP_200_OK
 
 ######################################################################
 # PATH: /customers/{customer_id}/unlock
@@ -373,19 +502,240 @@ class UnlockAction(Resource):
     #------------------------------------------------------------------
     @api.doc('unlock_customer')
     @api.response(404, 'The specified customer was not found')
-    @api.marshal_with(customer_model)
+    @serialize_with(customer_model)
     def put(self, customer_id):
         """
         Unock a Customer
         """
         app.logger.info("Request to lock Customer with id: %s", customer_id)
-        customer = Customer.find(customer_id)
+        customer = repository.set_locked(customer_id, False)
         if not customer:
             raise NotFound("customer with id '{}' was not found.".format(customer_id))
-        customer.locked = False
-        customer.update()
         app.logger.info("customer with ID [%s] is unlocked.", customer.id)
-        return customer.serialize_for_lock(), status.HTTP_200_OK
+        return customer, status.HTTP_200_OK
+
+######################################################################
+# PATH: /customers/changes
+######################################################################
+@api.route('/customers/changes')
+class ChangeFeed(Resource):
+    """
+    ChangeFeed class
+
+    Allows downstream systems to sync only what changed since their last pull
+
+    GET /customers/changes?since={cursor} - Returns the upserts and deletes of
+        Customers after the cursor, oldest first, with the cursor of the next page
+    """
+    #------------------------------------------------------------------
+    # LIST THE CHANGES AFTER A CURSOR
+    #------------------------------------------------------------------
+    @api.doc('list_changes')
+    @api.response(400, 'The cursor or the limit was not valid')
+    @api.expect(change_args, validate=True)
+    @serialize_with(change_feed_model)
+    def get(self):
+        """
+        Returns the changes of the customers after a cursor
+        Start without a cursor and pass the returned next cursor as since to
+        get the following changes, an empty page means the consumer is up to date
+        """
+        for key in request.args.keys():
+            if key not in ("since", "limit"):
+                raise UnsupportedKeyError("The query key: '" + key + "' is not supported.")
+        args = change_args.parse_args()
+        since = decode_cursor(args["since"]) if args["since"] else None
+        limit = app.config["CHANGES_PAGE_SIZE"] if args["limit"] is None else args["limit"]
+        if not 0 < limit <= app.config["CHANGES_MAX_PAGE_SIZE"]:
+            raise DataValidationError(
+                "limit must be between 1 and {}".format(app.config["CHANGES_MAX_PAGE_SIZE"])
+            )
+        # changes younger than the settle time may still be committing out of order
+        until = datetime.utcnow() - timedelta(seconds=app.config["CHANGES_SETTLE_SECONDS"])
+        app.logger.info("Request for changes after %s", since)
+        changes = repository.list_changes(since, until, limit)
+        if changes:
+            cursor = changes[-1].cursor
+        else:
+            cursor = args["since"] or encode_cursor((EPOCH, 0))
+        return {"changes": changes, "next": cursor}, status.HTTP_200_OK
+
+######################################################################
+# PATH: /customers/usernames
+######################################################################
+@api.route('/customers/usernames')
+class UsernameAutocomplete(Resource):
+    """
+    UsernameAutocomplete class
+
+    Allows type-ahead fields to suggest usernames
+
+    GET /customers/usernames?prefix={prefix} - Returns the first usernames starting with prefix
+    """
+    #------------------------------------------------------------------
+    # COMPLETE A USERNAME
+    #------------------------------------------------------------------
+    @api.doc('autocomplete_usernames')
+    @api.response(400, 'The prefix or the limit was not valid')
+    @api.expect(autocomplete_args, validate=True)
+    @serialize_with(autocomplete_model)
+    def get(self):
+        """
+        Returns the usernames starting with a prefix
+        The prefix is matched case insensitively and at most limit usernames are
+        returned, served from the username index of the worker when there is one
+        """
+        for key in request.args.keys():
+            if key not in ("prefix", "limit"):
+                raise UnsupportedKeyError("The query key: '" + key + "' is not supported.")
+        args = autocomplete_args.parse_args()
+        prefix = args["prefix"]
+        limit = app.config["AUTOCOMPLETE_LIMIT"] if args["limit"] is None else args["limit"]
+        if not prefix:
+            raise DataValidationError("prefix must not be empty")
+        if not 0 < limit <= app.config["AUTOCOMPLETE_MAX_LIMIT"]:
+            raise DataValidationError(
+                "limit must be between 1 and {}".format(app.config["AUTOCOMPLETE_MAX_LIMIT"])
+            )
+        usernames = username_index.search(prefix, limit) if username_index is not None else None
+        searched_by = "index"
+        if usernames is None:
+            customers = repository.list_customers(prefix_username=prefix)
+            usernames = sorted((customer.username for customer in customers),
+                               key=lambda name: (name.lower(), name))[:limit]
+            searched_by = "database"
+        return {"prefix": prefix, "usernames": usernames, "searched_by": searched_by}, \
+            status.HTTP_200_OK
+
+######################################################################
+# PATH: /customers/usernames/{username}
+######################################################################
+@api.route('/customers/usernames/<string:username>')
+@api.param('username', 'The username to check')
+class UsernameAvailability(Resource):
+    """
+    UsernameAvailability class
+
+    Allows signup forms to check whether a username is still free
+
+    GET /customers/usernames/{username} - Returns whether the username is available
+    """
+    #------------------------------------------------------------------
+    # CHECK A USERNAME
+    #------------------------------------------------------------------
+    @api.doc('check_username')
+    @serialize_with(username_model)
+    def get(self, username):
+        """
+        Check whether a username is available
+        Names the username filter has never seen are answered without a query
+        """
+        def lookup(name):
+            return repository.find_by_username(name) is not None
+
+        if username_filter is not None:
+            taken, checked_by = username_filter.is_taken(username, lookup)
+        else:
+            taken, checked_by = lookup(username), "database"
+        return {"username": username, "available": not taken, "checked_by": checked_by}, \
+            status.HTTP_200_OK
+
+######################################################################
+# PATH: /customers/locks
+######################################################################
+@api.route('/customers/locks')
+class LockCounts(Resource):
+    """
+    LockCounts class
+
+    Allows dashboards to follow how many accounts are locked
+
+    GET /customers/locks - Returns the numbers of locked and unlocked Customers
+    """
+    #------------------------------------------------------------------
+    # COUNT THE CUSTOMERS BY LOCK STATE
+    #------------------------------------------------------------------
+    @api.doc('count_lock_states')
+    @serialize_with(lock_counts_model)
+    def get(self):
+        """
+        Returns the numbers of locked and unlocked customers
+        The locked ones are counted from the partial index of the locked customers
+        """
+        app.logger.info("Request for the lock counts")
+        return repository.count_lock_states(), status.HTTP_200_OK
+
+######################################################################
+# PATH: /customers/stats
+######################################################################
+@api.route('/customers/stats')
+class CustomerStatistics(Resource):
+    """
+    CustomerStatistics class
+
+    Allows dashboards to chart the customers without downloading them
+
+    GET /customers/stats - Returns the totals of the Customers and their addresses
+    """
+    #------------------------------------------------------------------
+    # READ THE STATISTICS
+    #------------------------------------------------------------------
+    @api.doc('customer_stats')
+    @serialize_with(stats_model)
+    def get(self):
+        """
+        Returns the statistics of the customers
+        The customers per country and state, the addresses per customer and the
+        locked ratio are read from rollup tables kept up to date by every write
+        with STATS_ROLLUPS, and counted from the customers otherwise
+        """
+        app.logger.info("Request for the customer statistics")
+        return repository.customer_stats(), status.HTTP_200_OK
+
+######################################################################
+# PATH: /customers:batchGet
+######################################################################
+@read_endpoint
+@api.route('/customers:batchGet')
+class BatchGetAction(Resource):
+    """
+    BatchGetAction class
+
+    Allows clients to fetch many Customers in a single request
+
+    POST /customers:batchGet - Returns the customers with the posted ids
+    """
+    #------------------------------------------------------------------
+    # RETRIEVE MANY CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('batch_get_customers')
+    @api.response(400, 'The posted ids were not valid')
+    @api.expect(batch_get_model)
+    @serialize_with(batch_result_model)
+    def post(self):
+        """
+        Retrieve many customers by id
+        This endpoint will return one entry per posted id in the same order,
+        marking the ids of customers that do not exist as not found
+        """
+        check_content_type(*payload_mimetypes())
+        payload = request_payload()
+        ids = payload.get("ids") if isinstance(payload, dict) else None
+        if not isinstance(ids, list) or not all(
+                isinstance(customer_id, int) and not isinstance(customer_id, bool)
+                for customer_id in ids):
+            raise DataValidationError("Invalid batch request: ids must be a list of integers")
+        if len(ids) > app.config["BATCH_GET_MAX_IDS"]:
+            raise DataValidationError(
+                "Invalid batch request: at most {} ids".format(app.config["BATCH_GET_MAX_IDS"])
+            )
+        app.logger.info("Request for a batch of %d customers", len(ids))
+        customers = {customer.id: customer for customer in repository.get_customers(ids)}
+        entries = []
+        for customer_id in ids:
+            customer = customers.get(customer_id)
+            entries.append({"id": customer_id, "found": customer is not None, "customer": customer})
+        return {"customers": entries}, status.HTTP_200_OK
 
 ######################################################################
 # PATH: /customers/{customer_id}
@@ -407,17 +757,27 @@ class CustomerResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_customers')
     @api.response(404, "Customer not found")
-    @api.marshal_with(customer_model)
+    @api.response(400, 'The fields were not valid')
+    @api.expect(customer_fields_args, validate=True)
+    @serialize_with(customer_model, sparse=True)
     def get(self, customer_id):
         """
         Retrieve a single customer
-        This endpoint will return a customer based on their id
+        This endpoint will return a customer based on their id, with only the
+        listed fields when fields is given
         """
         app.logger.info("Request information for customer with id [%s]", customer_id)
-        customer = Customer.find(customer_id)
+        fields = requested_fields(customer_model)
+        if fields is None and customer_cache is None and repository.supports_documents() \
+                and json_passthrough_allowed():
+            document = repository.customer_document(customer_id)
+            if document is None:
+                raise NotFound("Customer with id '{}' was not found.".format(customer_id))
+            return json_response(document, status.HTTP_200_OK)
+        customer = read_customer(customer_id, fields)
         if not customer:
             raise NotFound("Customer with id '{}' was not found.".format(customer_id))
-        return customer.serialize(), status.HTTP_200_OK
+        return customer, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING CUSTOMER
@@ -426,37 +786,30 @@ class CustomerResource(Resource):
     @api.response(404, 'Customer not found')
     @api.response(400, 'The posted Customer data was not valid')
     @api.expect(update_customer_model)
-    @api.marshal_with(customer_model)
+    @serialize_with(customer_model)
     def put(self, customer_id):
         """
         Update a Customer
         This endpoint will update a Customer based the body that is posted
         """
         app.logger.info("Request to update Customer with id: [%s]", customer_id)
-        check_content_type("application/json")
-        check_customer_data(api.payload)
-        request_data = api.payload
-        customer = Customer.find(customer_id)
-        if not customer:
+        check_content_type(*payload_mimetypes())
+        request_data = request_payload()
+        check_customer_data(request_data)
+        if not repository.find_customer(customer_id):
             raise NotFound("customer with id '{}' was not found.".format(customer_id))
         
         try:
-            if "username" in request_data:
-                other_customer = Customer.find_by_name(request_data["username"]).first()
-                if other_customer is not None and other_customer.id != customer_id:
-                    raise ResourceConflictError("Username '" + request_data["username"] + "' already exists.")
-            customer.username = request_data["username"]
-            customer.id = customer_id
-            customer.first_name = request_data["first_name"]
-            customer.last_name = request_data["last_name"]
-            customer.password = request_data["password"]
-            customer.update()
+            values = {key: request_data[key] for key in CUSTOMER_UPDATE_FIELDS}
         except KeyError as error:
             raise DataValidationError(
                 "Invalid Customer update: missing " + error.args[0]
             )
+        customer = repository.update_customer(customer_id, values)
+        if not customer:
+            raise NotFound("customer with id '{}' was not found.".format(customer_id))
         app.logger.info("customer with ID [%s] updated.", customer.id)
-        return customer.serialize(), status.HTTP_200_OK
+        return customer, status.HTTP_200_OK
     
     #------------------------------------------------------------------
     # DELETE A CUSTOMER
@@ -469,9 +822,7 @@ class CustomerResource(Resource):
         This endpoint will delete a Customer based the id specified in the path
         """
         app.logger.info("Request to delete customer with id: %s", customer_id)
-        customer = Customer.find(customer_id)
-        if customer:
-            customer.delete()
+        repository.delete_customer(customer_id)
         return "", status.HTTP_204_NO_CONTENT
     
 ######################################################################
@@ -494,88 +845,265 @@ class CustomerCollection(Resource):
     @api.response(400, 'The posted data was not valid')
     @api.response(409, 'Duplicated usernames')
     @api.expect(create_customer_model)
-    @api.marshal_with(customer_model, code=201)
+    @serialize_with(customer_model, code=201)
     def post(self):
         """
         Creates a Customer
         This endpoint will create a Customer based the data in the body that is posted
         """
         app.logger.info("Request to create a customer")
-        check_content_type("application/json")
-        check_customer_data(api.payload)
-        check_addresses_data(api.payload)
+        check_content_type(*payload_mimetypes())
+        payload = request_payload()
+        check_customer_data(payload)
+        check_addresses_data(payload)
         
-        customer = Customer()
-        customer.deserialize(api.payload)
-        customer_found = Customer.find_by_name(customer.username).first()
-        if customer_found:
-            raise ResourceConflictError( "Username '" + customer.username + "' already exists.")
-        customer.locked=False
-        customer.create()
-        message = customer.serialize()
+        customer = repository.create_customer(payload)
         location_url = api.url_for(CustomerResource, customer_id=customer.id, _external=True)
-        return message, status.HTTP_201_CREATED, {"Location": location_url}
+        return customer, status.HTTP_201_CREATED, {"Location": location_url}
 
     #------------------------------------------------------------------
     # LIST ALL CUSTOMERS
     #------------------------------------------------------------------
     @api.doc('list_customers')
     @api.expect(customer_args, validate=True)
-    @api.marshal_list_with(customer_model)
+    @serialize_with(customer_model, as_list=True, sparse=True)
     def get(self):
         """Returns all of the customers"""
         app.logger.info("Request for customer list")
         
-        all_query_key = ["username", "first_name", "last_name", "prefix_username"]
+        all_query_key = ["username", "first_name", "last_name", "prefix_username", "locked", "q",
+                         "sort", "order", "limit", "after", "offset", "count", "fields"]
         for key in request.args.keys():
             if key not in all_query_key:
                 raise UnsupportedKeyError("The query key: '" + key + "' is not supported.")
         
         args = customer_args.parse_args()
+        if args["q"] is not None:
+            return search_customers(args), status.HTTP_200_OK
+        if args["offset"] is not None:
+            raise DataValidationError("offset is only supported with q")
         username = args["username"]
         first_name = args["first_name"]
         last_name = args["last_name"]
         prefix_username = args["prefix_username"]
+        locked = args["locked"]
+        fields = requested_fields(customer_model)
+        sort, descending, after, limit = list_page(args)
+        headers = total_count_headers(args) if args["count"] else {}
 
-        def filter(customers1, customers2):
-            filter_customers = []
-            for cust1 in customers1:
-                for cust2 in customers2:
-                    cust2 = cust2.serialize()
-                    if cust1['id'] == cust2['id']:
-                        filter_customers.append(cust1)
-                        break
-            return filter_customers
-
-        customers = Customer.all()
-        results = [customer.serialize() for customer in customers]
-        if username:
-            results = filter(results, Customer.find_by_name(username))
-        if first_name:
-            results = filter(results, Customer.find_by_first_name(first_name))
-        if last_name:
-            results = filter(results, Customer.find_by_last_name(last_name))
-        if prefix_username:
-            results = filter(results, Customer.find_by_prefix_name(prefix_username))
+        if query_cache is not None:
+            results = query_cache.get_or_load(
+                query_key(username=username, first_name=first_name, last_name=last_name,
+                          prefix_username=prefix_username, locked=locked, sort=sort,
+                          order=args["order"], after=args["after"], limit=limit, fields=fields),
+                lambda: repository.list_customers(username=username, first_name=first_name,
+                                                  last_name=last_name, prefix_username=prefix_username,
+                                                  locked=locked, sort=sort, descending=descending,
+                                                  after=after, limit=limit, fields=fields),
+                cacheable=g.get("replica_bind") is None
+            )
+            app.logger.info("Returning %d customers", len(results))
+            return results, status.HTTP_200_OK, dict(headers, **next_page_link(results, sort, limit))
+        if sort is None and fields is None and repository.supports_documents() \
+                and json_passthrough_allowed():
+            app.logger.info("Returning customer documents built by the database")
+            document = repository.customer_documents(username=username, first_name=first_name,
+                                                     last_name=last_name, prefix_username=prefix_username,
+                                                     locked=locked)
+            return json_response(document, status.HTTP_200_OK, headers)
+        results = repository.list_customers(username=username, first_name=first_name,
+                                            last_name=last_name, prefix_username=prefix_username,
+                                            locked=locked, sort=sort, descending=descending,
+                                            after=after, limit=limit, fields=fields)
 
         app.logger.info("Returning %d customers", len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, dict(headers, **next_page_link(results, sort, limit))
+
+    #------------------------------------------------------------------
+    # COUNT THE CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('count_customers', responses={200: 'The count is in the X-Total-Count header'})
+    @api.expect(count_args, validate=True)
+    def head(self):
+        """
+        Returns the number of matching customers without the customers
+        The X-Total-Count header holds the count of the customers matching the
+        filters, X-Total-Count-Kind tells whether it is exact or estimated
+        """
+        app.logger.info("Request for customer count")
+        all_query_key = [argument.name for argument in count_args.args]
+        for key in request.args.keys():
+            if key not in all_query_key:
+                raise UnsupportedKeyError("The query key: '" + key + "' is not supported.")
+        return make_response("", status.HTTP_200_OK, total_count_headers(count_args.parse_args()))
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """ Adds the new tables, columns and indexes to an existing database """
+    app.logger.info("Upgrading the database schema")
+    changes = repository.upgrade_schema()
+    for change in changes:
+        click.echo(change)
+    click.echo("Upgraded the database with {} changes".format(len(changes)))
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """ Recomputes the rolled up customer statistics from the customers """
+    app.logger.info("Rebuilding the customer statistics")
+    repository.rebuild_stats()
+    stats = repository.customer_stats()
+    click.echo("Rebuilt the statistics of {} customers and {} addresses".format(
+        stats["customers"], stats["addresses"]))
+
+@app.cli.command("check-read-model")
+def check_read_model_command():
+    """ Compares the stored customer documents with the customers """
+    app.logger.info("Checking the customer documents")
+    report = repository.check_documents()
+    click.echo("Checked the documents of {} customers".format(report["checked"]))
+    problems = 0
+    for kind in ("missing", "stale", "orphaned"):
+        if report[kind]:
+            problems += len(report[kind])
+            click.echo("{} {} documents: {}".format(
+                len(report[kind]), kind, ", ".join(str(i) for i in report[kind])))
+    if problems:
+        raise click.ClickException(
+            "{} documents differ, run flask rebuild-read-model".format(problems))
+
+@app.cli.command("rebuild-read-model")
+def rebuild_read_model_command():
+    """ Rewrites the stored customer documents from the customers """
+    app.logger.info("Rebuilding the customer documents")
+    written = repository.rebuild_documents()
+    click.echo("Rewrote {} customer documents".format(written))
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
 def init_db():
-    """ Initialies the SQLAlchemy app """
-    global app
-    Customer.init_db(app)
+    """ Initialies the storage backend """
+    global app, repository, customer_cache, query_cache, negative_cache, username_filter, \
+        username_index
+    repository = create_repository(app)
+    if app.config.get("CACHE_ENABLED"):
+        if isinstance(repository, SqlRepository):
+            customer_cache = create_cache(app)
+            if app.config.get("QUERY_CACHE_SIZE"):
+                query_cache = create_query_cache(app)
+            if app.config.get("NEGATIVE_CACHE_SIZE"):
+                negative_cache = create_negative_cache(app)
+        else:
+            app.logger.warning("CACHE_ENABLED is only supported by the sql storage backend")
+    filter_usernames = app.config.get("USERNAME_FILTER") and repository.sees_all_writes()
+    index_usernames = app.config.get("USERNAME_INDEX") and repository.sees_all_writes()
+    if isinstance(repository, SqlRepository) and (customer_cache is not None or filter_usernames
+                                                  or index_usernames):
+        listener = start_listener(app, db.get_engine(app))
+        # a username committed between the scans below and the LISTEN would be missed
+        if listener is not None:
+            listener.wait_listening()
+    if filter_usernames:
+        username_filter = create_username_filter(app, repository)
+    if index_usernames:
+        username_index = create_username_index(app, repository)
+    if app.config.get("OUTBOX_PUBLISHER"):
+        start_publisher(app)
+
+def search_customers(args):
+    """ Returns the page of the q= search of the customer list, best matches first """
+    for key in ("username", "first_name", "last_name", "prefix_username", "locked", "sort",
+                "order", "after", "count"):
+        if args[key] is not None:
+            raise DataValidationError("q cannot be combined with " + key)
+    words = search_words(args["q"])
+    if not words:
+        raise DataValidationError("q must contain at least one word")
+    limit = app.config["SEARCH_PAGE_SIZE"] if args["limit"] is None else args["limit"]
+    offset = args["offset"] or 0
+    if not 0 < limit <= app.config["SEARCH_MAX_PAGE_SIZE"]:
+        raise DataValidationError(
+            "limit must be between 1 and {}".format(app.config["SEARCH_MAX_PAGE_SIZE"])
+        )
+    if not 0 <= offset <= app.config["SEARCH_MAX_OFFSET"]:
+        raise DataValidationError(
+            "offset must be between 0 and {}".format(app.config["SEARCH_MAX_OFFSET"])
+        )
+    app.logger.info("Request to search customers for %s", words)
+    results = repository.search_customers(words, limit, offset)
+    app.logger.info("Returning %d customers", len(results))
+    return [customer for _, customer in results]
+
+def list_page(args):
+    """ Returns the sort, descending, after and limit of a customer list request """
+    sort = args["sort"]
+    if sort is None and (args["order"] or args["after"] or args["limit"] is not None):
+        sort = "id"  # pages need an order
+    descending = args["order"] == "desc"
+    after = decode_page_cursor(args["after"], sort) if args["after"] else None
+    limit = args["limit"]
+    if limit is not None and not 0 < limit <= app.config["LIST_MAX_PAGE_SIZE"]:
+        raise DataValidationError(
+            "limit must be between 1 and {}".format(app.config["LIST_MAX_PAGE_SIZE"])
+        )
+    return sort, descending, after, limit
+
+def total_count_headers(args):
+    """ Returns the X-Total-Count headers of the customers matching the list filters """
+    count, kind = repository.count_customers(username=args["username"],
+                                             first_name=args["first_name"],
+                                             last_name=args["last_name"],
+                                             prefix_username=args["prefix_username"],
+                                             locked=args["locked"])
+    app.logger.info("Counted %d customers (%s)", count, kind)
+    return {"X-Total-Count": str(count), "X-Total-Count-Kind": kind}
+
+def next_page_link(results, sort, limit):
+    """ Returns the Link header of the next page of a full page of customers """
+    if limit is None or len(results) < limit:
+        return {}
+    args = request.args.to_dict()
+    args["after"] = encode_page_cursor(sort, results[-1])
+    return {"Link": '<{}?{}>; rel="next"'.format(request.base_url, urlencode(args))}
+
+def read_customer(customer_id, fields=None):
+    """
+    Returns a Customer from the cache or the repository, or None
+
+    Only the listed fields are read when the customer is not cached, the
+    cache holds whole customers
+    """
+    replica = g.get("replica_bind")
+
+    def load(fields=None):
+        if not app.config.get("SINGLE_FLIGHT"):
+            return repository.find_customer(customer_id, fields)
+        # a request never joins a read that started before a write it knows of
+        key = ("customer", customer_id, fields, replica, bus.changes)
+        return single_flight.do(key, lambda: repository.find_customer(customer_id, fields))
+
+    def cached():
+        if customer_cache is None:
+            return load(fields)
+        # reads of a lagging replica could undo an invalidation, keep them out
+        return customer_cache.get_or_load(customer_id, load, cacheable=replica is None)
+
+    if negative_cache is not None:
+        # a lagging replica may not have the customer yet
+        return negative_cache.get_or_load(customer_id, cached, cacheable=replica is None)
+    return cached()
 
-def check_content_type(content_type):
-    """ Checks that the media type is correct """
-    if "Content-Type" in request.headers and request.headers["Content-Type"] == content_type:
+def check_content_type(*content_types):
+    """ Checks that the media type is one of content_types, whatever its parameters """
+    if request.mimetype in content_types:
         return
     app.logger.error("Invalid Content-Type: [%s]", request.headers.get("Content-Type"))
-    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be {}".format(content_type))
+    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be {}".format(" or ".join(content_types)))
 
 def check_customer_data(request):
     string_keys = ["first_name", "last_name", "username", "password"]
@@ -0,0 +1,302 @@
+"""
+Full-text and fuzzy search of Customers
+
+A search matches the words of the q= parameter against the username, the
+names and the address fields of every customer and returns the best matches
+first. A word matches a field token exactly or when they share enough
+trigrams (the three letter pieces pg_trgm compares), so a misspelled name
+still finds its customer.
+
+On Postgres the filtering, the ranking and the paging run as one statement:
+
+  - to_tsvector('simple', ...) expressions over the customer and the address
+    columns, each backed by a GIN index, find the exact words
+  - pg_trgm GIN indexes on username, first_name and last_name find the
+    misspelled ones with the % operator
+  - ts_rank() plus the trigram similarity() of every word orders the matches
+
+create_search_indexes() creates the indexes and the pg_trgm extension at
+startup. Without the permission to create the extension the search keeps
+working with the exact words only.
+
+Other databases and the memory backend are searched with an NgramIndex, a
+trigram index of every customer kept in the memory of the worker. A
+SearchIndex loads it from the change feed of the repository and catches up
+with the feed before every search, so it also sees the writes of the other
+workers.
+"""
+import logging
+import re
+import threading
+from collections import Counter
+from datetime import timedelta
+from sqlalchemy import select, func, literal_column, and_, or_, text
+from service.queries import customer_table, address_table, CustomerRecord, AddressRecord, \
+    CUSTOMER_COLUMNS, ADDRESS_COLUMNS
+
+logger = logging.getLogger("flask.app")
+
+WORD = re.compile(r"\w+")
+SEARCH_CONFIG = literal_column("'simple'")
+CUSTOMER_SEARCH_FIELDS = ("username", "first_name", "last_name")
+ADDRESS_SEARCH_FIELDS = ("street_address", "city", "state", "zipcode", "country")
+
+SEARCH_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+FULL_TEXT_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS customer_search_idx ON customer USING gin "
+    "(to_tsvector('simple', username || ' ' || first_name || ' ' || last_name))",
+    "CREATE INDEX IF NOT EXISTS address_search_idx ON address USING gin "
+    "(to_tsvector('simple', street_address || ' ' || city || ' ' || state || ' ' || "
+    "zipcode || ' ' || country))",
+)
+TRIGRAM_INDEXES = tuple(
+    "CREATE INDEX IF NOT EXISTS customer_{0}_trgm_idx ON customer USING gin "
+    "({0} gin_trgm_ops)".format(name) for name in CUSTOMER_SEARCH_FIELDS
+)
+
+# cleared by create_search_indexes() when pg_trgm cannot be installed
+trigrams_available = True
+
+
+def search_words(text_query, limit=8):
+    """ Returns the distinct lowercase words of a search, at most limit of them """
+    words = []
+    for word in WORD.findall(text_query.lower()):
+        if word not in words:
+            words.append(word)
+    return words[:limit]
+
+
+def trigrams(word):
+    """ Returns the trigrams of a word padded like pg_trgm does """
+    padded = "  " + word + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+######################################################################
+#  P O S T G R E S   S E A R C H
+######################################################################
+
+def create_search_indexes(engine):
+    """ Creates the full-text and trigram indexes on a Postgres database """
+    global trigrams_available
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        for statement in FULL_TEXT_INDEXES:
+            connection.execute(text(statement))
+    try:
+        with engine.begin() as connection:
+            connection.execute(text(SEARCH_EXTENSION))
+            for statement in TRIGRAM_INDEXES:
+                connection.execute(text(statement))
+    except Exception as error:  # pylint: disable=broad-except
+        logger.warning("No pg_trgm, searches match exact words only: %s", error)
+        trigrams_available = False
+
+
+def _joined(columns):
+    """ The columns joined with spaces, like the indexed expressions """
+    expression = columns[0]
+    for column in columns[1:]:
+        expression = expression.op("||")(literal_column("' '")).op("||")(column)
+    return expression
+
+
+def search_query(words, limit, offset, fuzzy=True):
+    """
+    Returns the SELECT of one page of the customers matching words, best first
+
+    The rows hold the CUSTOMER_COLUMNS followed by the rank
+    """
+    query = None
+    for word in words:
+        word_query = func.plainto_tsquery(SEARCH_CONFIG, word)
+        query = word_query if query is None else query.op("||")(word_query)
+    customer_vector = func.to_tsvector(
+        SEARCH_CONFIG, _joined([customer_table.c[name] for name in CUSTOMER_SEARCH_FIELDS])
+    )
+    address = address_table.alias("a")
+    address_vector = func.to_tsvector(
+        SEARCH_CONFIG, _joined([address.c[name] for name in ADDRESS_SEARCH_FIELDS])
+    )
+    address_match = address_vector.op("@@")(query)
+    address_rank = select([func.max(func.ts_rank(address_vector, query))]).where(
+        and_(address.c.customer_id == customer_table.c.id, address_match)
+    ).as_scalar()
+    rank = func.ts_rank(customer_vector, query) + func.coalesce(address_rank, 0)
+    matches = [
+        customer_vector.op("@@")(query),
+        customer_table.c.id.in_(select([address.c.customer_id]).where(address_match)),
+    ]
+    if fuzzy:
+        for word in words:
+            columns = [customer_table.c[name] for name in CUSTOMER_SEARCH_FIELDS]
+            # the pg_trgm % operator, doubled for the format paramstyle of the drivers
+            matches.extend(column.op("%%")(word) for column in columns)
+            rank = rank + func.greatest(*[func.similarity(column, word) for column in columns])
+    rank = rank.label("rank")
+    return select([customer_table.c[name] for name in CUSTOMER_COLUMNS] + [rank]).where(
+        or_(*matches)
+    ).order_by(rank.desc(), customer_table.c.id).limit(limit).offset(offset)
+
+
+def fetch_search(execute, words, limit, offset):
+    """
+    Returns one page of (rank, CustomerRecord) pairs matching words, best first
+
+    Args:
+        execute (function): runs a statement, db.session.execute or Connection.execute
+        words (list): the words returned by search_words()
+    """
+    rows = execute(search_query(words, limit, offset, fuzzy=trigrams_available)).fetchall()
+    results = [(row[-1], CustomerRecord(*row[:-1])) for row in rows]
+    customers = {customer.id: customer for _, customer in results}
+    if customers:
+        addresses = select([address_table.c[name] for name in ADDRESS_COLUMNS]).where(
+            address_table.c.customer_id.in_(list(customers))
+        ).order_by(address_table.c.address_id)
+        for row in execute(addresses):
+            customers[row[0]].addresses.append(AddressRecord(*row))
+    return results
+
+
+######################################################################
+#  I N - P R O C E S S   S E A R C H
+######################################################################
+
+def document_words(customer):
+    """ Returns the searchable words of a customer and its addresses """
+    values = [getattr(customer, name) or "" for name in CUSTOMER_SEARCH_FIELDS]
+    for address in customer.addresses:
+        values.extend(getattr(address, name) or "" for name in ADDRESS_SEARCH_FIELDS)
+    return set(WORD.findall(" ".join(values).lower()))
+
+
+class NgramIndex:
+    """
+    A trigram index of the words of the customers
+
+    Args:
+        threshold (float): the least trigram similarity of a matching word
+    """
+
+    def __init__(self, threshold=0.3):
+        self.threshold = threshold
+        self._documents = {}  # customer id -> its words
+        self._postings = {}  # word -> set of customer ids
+        self._grams = {}  # trigram -> set of words
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, customer):
+        """ Indexes a new or changed customer """
+        words = document_words(customer)
+        with self._lock:
+            self._remove(customer.id)
+            self._documents[customer.id] = words
+            for word in words:
+                ids = self._postings.get(word)
+                if ids is None:
+                    ids = self._postings[word] = set()
+                    for gram in trigrams(word):
+                        self._grams.setdefault(gram, set()).add(word)
+                ids.add(customer.id)
+
+    def remove(self, customer_id):
+        """ Forgets a deleted customer """
+        with self._lock:
+            self._remove(customer_id)
+
+    def _remove(self, customer_id):
+        for word in self._documents.pop(customer_id, ()):
+            ids = self._postings[word]
+            ids.discard(customer_id)
+            if ids:
+                continue
+            del self._postings[word]
+            for gram in trigrams(word):
+                words = self._grams[gram]
+                words.discard(word)
+                if not words:
+                    del self._grams[gram]
+
+    def _similar(self, word):
+        """ Yields the indexed words similar to word with their similarity """
+        grams = trigrams(word)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._grams.get(gram, ()))
+        for other, count in shared.items():
+            similarity = count / (len(grams) + len(trigrams(other)) - count)
+            if similarity >= self.threshold:
+                yield other, similarity
+
+    def search(self, words, limit, offset=0):
+        """
+        Returns one page of the ids of the matching customers, best first
+
+        Every word adds the similarity of the most similar word of a
+        customer to its score, 1 for an exact match
+        """
+        scores = Counter()
+        with self._lock:
+            for word in words:
+                best = {}
+                for other, similarity in self._similar(word):
+                    for customer_id in self._postings[other]:
+                        if similarity > best.get(customer_id, 0):
+                            best[customer_id] = similarity
+                scores.update(best)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[offset:offset + limit]
+
+
+class SearchIndex:
+    """
+    An NgramIndex following the change feed of a repository
+
+    Args:
+        repository (CustomerRepository): the repository to search
+        threshold (float): the least trigram similarity of a matching word
+        settle (float): how many seconds of changes are read again, changes
+            may commit a little out of order
+    """
+
+    def __init__(self, repository, threshold=0.3, settle=2.0, page_size=1000):
+        self.repository = repository
+        self.index = NgramIndex(threshold)
+        self.settle = timedelta(seconds=settle)
+        self.page_size = page_size
+        self._position = None  # the key of the last change applied
+        self._lock = threading.Lock()
+
+    def catch_up(self):
+        """ Applies the changes made since the last search """
+        with self._lock:
+            since = self._position
+            if since is not None:
+                since = (since[0] - self.settle, 0)
+            while True:
+                changes = self.repository.list_changes(since, None, self.page_size)
+                for change in changes:
+                    if change.type == "delete":
+                        self.index.remove(change.id)
+                    else:
+                        self.index.add(change.customer)
+                    if self._position is None or change.key > self._position:
+                        self._position = change.key
+                if len(changes) < self.page_size:
+                    break
+                since = changes[-1].key
+
+    def search(self, words, limit, offset=0):
+        """ Returns one page of (rank, customer) pairs matching words, best first """
+        self.catch_up()
+        ranked = self.index.search(words, limit, offset)
+        customers = {customer.id: customer
+                     for customer in self.repository.get_customers([i for i, _ in ranked])}
+        return [(score, customers[customer_id]) for customer_id, score in ranked
+                if customer_id in customers]
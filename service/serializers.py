@@ -0,0 +1,335 @@
+"""
+Serializers for the Customer service
+
+Flask-RESTX marshals a response by walking the data against the model fields
+and then hands the result to the stdlib json module, so every object is built
+twice before a single byte is written. This module compiles a Flask-RESTX model
+once into a flat list of encoders that write JSON text straight from ORM rows,
+records or dictionaries, producing exactly what ``marshal`` + ``json.dumps``
+would have produced.
+
+Internal clients may ask for MessagePack or CBOR instead of JSON with the
+Accept header and send request bodies in the same formats. Both codecs are
+optional dependencies and only offered when they are installed.
+"""
+from collections import OrderedDict
+from functools import wraps
+from http import HTTPStatus
+from json.encoder import encode_basestring_ascii  # C accelerated when available
+from flask import current_app, request, make_response, Response
+from flask_restx import fields, marshal
+from flask_restx.utils import merge, unpack
+from service.models import DataValidationError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/msgpack"
+CBOR_MIMETYPE = "application/cbor"
+
+
+def _get(key):
+    """ Returns an accessor for key that works on objects and dictionaries """
+
+    def getter(obj):
+        if isinstance(obj, dict):
+            return obj.get(key)
+        return getattr(obj, key, None)
+
+    return getter
+
+
+def _encode_string(value):
+    return "null" if value is None else encode_basestring_ascii(str(value))
+
+
+def _encode_integer(value):
+    return "null" if value is None else int.__repr__(int(value))
+
+
+def _encode_float(value):
+    return "null" if value is None else float.__repr__(float(value))
+
+
+def _encode_boolean(value):
+    if value is None:
+        return "null"
+    return "true" if value else "false"
+
+
+def _convert_string(value):
+    return None if value is None else str(value)
+
+
+def _convert_integer(value):
+    return None if value is None else int(value)
+
+
+def _convert_float(value):
+    return None if value is None else float(value)
+
+
+def _convert_boolean(value):
+    return None if value is None else bool(value)
+
+
+def _compile_field(field, as_json):
+    """ Returns an encoder (or a converter to python values) for a Flask-RESTX field """
+    if isinstance(field, type):
+        field = field()
+    if field.default is not None or getattr(field, "mask", None):
+        raise ValueError("Cannot compile field {!r}".format(field))
+    if isinstance(field, fields.String):
+        return _encode_string if as_json else _convert_string
+    if isinstance(field, fields.Integer):
+        return _encode_integer if as_json else _convert_integer
+    if isinstance(field, fields.Boolean):
+        return _encode_boolean if as_json else _convert_boolean
+    if isinstance(field, fields.Float):
+        return _encode_float if as_json else _convert_float
+    if isinstance(field, fields.List):
+        if isinstance(field.container, fields.Nested):
+            encode_item = _compile_model(field.container.nested, as_json)
+        else:
+            encode_item = _compile_field(field.container, as_json)
+
+        if not as_json:
+            return lambda value: None if value is None else [encode_item(item) for item in value]
+
+        def encode_list(value):
+            if value is None:
+                return "null"
+            return "[" + ", ".join([encode_item(item) for item in value]) + "]"
+
+        return encode_list
+    if isinstance(field, fields.Nested) and not isinstance(field, fields.Polymorph) \
+            and not field.skip_none:
+        encode_item = _compile_model(field.nested, as_json)
+        if not field.allow_null:
+            # marshal() renders a missing object with all its fields null
+            return encode_item
+        null = "null" if as_json else None
+        return lambda value: null if value is None else encode_item(value)
+    raise ValueError("Cannot compile field {!r}".format(field))
+
+
+def _compile_model(model, as_json):
+    plan = []
+    for index, (key, field) in enumerate(getattr(model, "resolved", model).items()):
+        attribute = getattr(field, "attribute", None) or key
+        prefix = ("{" if index == 0 else ", ") + encode_basestring_ascii(key) + ": "
+        plan.append((prefix if as_json else key, _get(attribute), _compile_field(field, as_json)))
+    plan = tuple(plan)
+
+    if not as_json:
+        return lambda obj: {key: encode(get(obj)) for key, get, encode in plan}
+
+    def serialize(obj):
+        parts = [prefix + encode(get(obj)) for prefix, get, encode in plan]
+        return "".join(parts) + "}" if parts else "{}"
+
+    return serialize
+
+
+def compile_serializer(model):
+    """
+    Compiles a Flask-RESTX model into a function returning JSON text
+
+    The generated function produces the same output as marshalling the
+    object with the model and encoding it with ``json.dumps``
+    Args:
+        model (Model): the Flask-RESTX model to compile
+    """
+    return _compile_model(model, as_json=True)
+
+
+def compile_converter(model):
+    """
+    Compiles a Flask-RESTX model into a function returning plain python values
+
+    The generated function returns the same dictionary as ``marshal`` and
+    feeds the binary encoders
+    Args:
+        model (Model): the Flask-RESTX model to compile
+    """
+    return _compile_model(model, as_json=False)
+
+
+######################################################################
+#  C O N T E N T   N E G O T I A T I O N
+######################################################################
+
+def binary_mimetypes():
+    """ Returns the binary media types supported by the installed codecs """
+    mimetypes = []
+    if msgpack is not None:
+        mimetypes.append(MSGPACK_MIMETYPE)
+    if cbor2 is not None:
+        mimetypes.append(CBOR_MIMETYPE)
+    return mimetypes
+
+
+def payload_mimetypes():
+    """ Returns the media types accepted for request and response bodies """
+    return [JSON_MIMETYPE] + binary_mimetypes()
+
+
+def negotiated_mimetype():
+    """ Returns the response media type preferred by the client """
+    return request.accept_mimetypes.best_match(payload_mimetypes(), default=JSON_MIMETYPE)
+
+
+def request_mimetype():
+    """ Returns the media type of the request body without its parameters """
+    return request.mimetype or JSON_MIMETYPE
+
+
+def request_payload():
+    """ Returns the decoded request body whatever its supported media type """
+    mimetype = request_mimetype()
+    if mimetype not in binary_mimetypes():
+        return request.get_json()
+    try:
+        if mimetype == MSGPACK_MIMETYPE:
+            return msgpack.unpackb(request.get_data(), raw=False)
+        return cbor2.loads(request.get_data())
+    except Exception as error:  # the codecs raise many unrelated exception types
+        raise DataValidationError("Invalid request body: " + str(error))
+
+
+######################################################################
+#  R E S P O N S E S
+######################################################################
+
+def fast_path_enabled():
+    """ Returns True when the compiled serializers may replace marshalling """
+    config = current_app.config
+    return (
+        not current_app.debug
+        and not config.get("RESTX_JSON")
+        and not request.headers.get(config["RESTX_MASK_HEADER"])
+    )
+
+
+def json_passthrough_allowed():
+    """ Returns True when JSON text built elsewhere may be sent as is """
+    return fast_path_enabled() and negotiated_mimetype() == JSON_MIMETYPE
+
+
+def json_response(body, code=HTTPStatus.OK, headers=None):
+    """ Wraps already encoded JSON text into a Flask response """
+    response = make_response(body + "\n", code)
+    response.headers.extend(headers or {})
+    response.headers["Content-Type"] = JSON_MIMETYPE
+    return response
+
+
+def binary_response(data, mimetype, code=HTTPStatus.OK, headers=None):
+    """ Encodes python values with a binary codec into a Flask response """
+    if mimetype == MSGPACK_MIMETYPE:
+        body = msgpack.packb(data, use_bin_type=True)
+    else:
+        body = cbor2.dumps(data)
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    response.headers["Content-Type"] = mimetype
+    return response
+
+
+def requested_fields(model):
+    """
+    Returns the keys of model listed by the fields= parameter, or None
+
+    The keys are returned in the order of the model whatever their order in
+    the parameter
+    Raises:
+        DataValidationError: when a listed field is not one of the model
+    """
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    keys = list(getattr(model, "resolved", model))
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    if not names or not names.issubset(keys):
+        raise DataValidationError("fields must be a comma separated list of " + ", ".join(keys))
+    return tuple(key for key in keys if key in names)
+
+
+def serialize_with(model, as_list=False, code=HTTPStatus.OK, description=None, sparse=False):
+    """
+    A drop in replacement for ``api.marshal_with`` using a compiled serializer
+
+    The Swagger documentation is generated exactly as ``marshal_with`` does and
+    requests the compiled serializer cannot honour (debug indentation, custom
+    RESTX_JSON settings or a fields mask) are marshalled the regular way.
+    Clients accepting MessagePack or CBOR get the same data in that format,
+    so every response varies on Accept. Responses returned by the resource
+    are otherwise passed through untouched
+    Args:
+        model (Model): the Flask-RESTX model describing the response
+        as_list (bool): document the response as a list of model
+        code (int): the documented HTTP status code
+        sparse (bool): only return the fields listed by the fields= parameter,
+            see requested_fields()
+    """
+    serialize_all = compile_serializer(model)
+    convert_all = compile_converter(model)
+    sparse_models = {}  # requested fields -> (fields, serializer, converter)
+
+    def select(keys):
+        if keys not in sparse_models:
+            resolved = getattr(model, "resolved", model)
+            selected = OrderedDict((key, resolved[key]) for key in keys)
+            sparse_models[keys] = (selected, compile_serializer(selected),
+                                   compile_converter(selected))
+        return sparse_models[keys]
+
+    def wrapper(func):
+        doc = {
+            "responses": {
+                str(code): (description, [model], {}) if as_list else (description, model, {})
+            },
+            "__mask__": True,
+        }
+        func.__apidoc__ = merge(getattr(func, "__apidoc__", {}), doc)
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            resp = func(*args, **kwargs)
+            if isinstance(resp, Response):
+                # already encoded, e.g. a document built by the database
+                resp.vary.add("Accept")
+                return resp
+            data, status_code, headers = unpack(resp)
+            headers = dict(headers or {}, Vary="Accept")
+            fields_model, serialize, convert = model, serialize_all, convert_all
+            keys = requested_fields(model) if sparse else None
+            if keys is not None:
+                fields_model, serialize, convert = select(keys)
+            mimetype = negotiated_mimetype()
+            if mimetype != JSON_MIMETYPE:
+                if isinstance(data, (list, tuple)):
+                    data = [convert(item) for item in data]
+                else:
+                    data = convert(data)
+                return binary_response(data, mimetype, status_code, headers)
+            if not fast_path_enabled():
+                mask = request.headers.get(current_app.config["RESTX_MASK_HEADER"])
+                return marshal(data, fields_model, mask=mask), status_code, headers
+            if isinstance(data, (list, tuple)):
+                body = "[" + ", ".join([serialize(item) for item in data]) + "]"
+            else:
+                body = serialize(data)
+            return json_response(body, status_code, headers)
+
+        return wrapped
+
+    return wrapper
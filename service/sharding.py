@@ -0,0 +1,646 @@
+"""
+Hash based sharding of Customers across several databases
+
+Every customer lives on exactly one shard together with its addresses. Ids
+are allocated by the shard itself as ``n * shard_count + shard_index`` so
+they are unique across all shards and the shard of any customer or address
+is simply ``id % shard_count``. New customers are placed by a hash of their
+username.
+
+The first shard also holds the username directory, mapping every username
+to its shard, which keeps usernames globally unique and makes lookups by
+username a single query. Lists and searches are sent to all shards in
+parallel and merged in id order with keyset pagination.
+
+ShardedRepository serves the routes from a ShardRouter when STORAGE_BACKEND
+is "sharded".
+"""
+import heapq
+import logging
+import zlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import create_engine, select, MetaData, Table, Column, Integer, String
+from sqlalchemy.exc import IntegrityError
+from service.models import db, Customer, Address, ResourceConflictError, StatsDelta, \
+    write_documents, upgrade_schema
+from service.queries import customer_table, address_table, tombstone_table, AddressRecord, \
+    ADDRESS_COLUMNS, customer_criteria, fetch_changes, page_order, page_criteria, \
+    projected_columns, customer_records, fetch_lock_counts, fetch_customer_count, EXACT_COUNT, \
+    ESTIMATED_COUNT, customer_stats_table, region_stats_table, fetch_stats, stats_document, \
+    rebuild_stats_tables, document_table, fetch_stored_document, fetch_stored_documents, \
+    check_documents, rebuild_documents, read_model_enabled
+from service.repository import CustomerRepository
+from service.search import create_search_indexes, fetch_search
+
+logger = logging.getLogger("flask.app")
+
+shard_metadata = MetaData()
+
+id_allocation = Table(
+    "id_allocation", shard_metadata,
+    Column("id", Integer, primary_key=True),
+)
+
+username_directory = Table(
+    "username_directory", shard_metadata,
+    Column("username", String(64), primary_key=True),
+    Column("shard", Integer, nullable=False),
+)
+
+# the tables of the models every shard holds
+SHARD_TABLES = [customer_table, address_table, tombstone_table, customer_stats_table,
+                region_stats_table, document_table]
+
+# The collations sorting strings by code point like Python does, the shards of
+# other databases already do (SQLite compares the UTF-8 bytes)
+MERGE_COLLATIONS = {"postgresql": "C"}
+
+CUSTOMER_FIELDS = ("username", "password", "first_name", "last_name", "locked")
+ADDRESS_FIELDS = ("street_address", "city", "state", "zipcode", "country")
+
+
+class ShardRouter:
+    """
+    Maps Customer and Address operations to N databases
+
+    Args:
+        uris (list): the database URI of every shard, in shard order
+        read_model (bool): keep the customer documents of the read model on
+            every shard, see service.models.write_documents
+        stats_rollups (bool): keep the statistics rolled up on every shard,
+            see service.models.StatsDelta
+    """
+
+    def __init__(self, uris, read_model=False, stats_rollups=False):
+        if not uris:
+            raise ValueError("ShardRouter needs at least one database URI")
+        self.read_model = read_model
+        self.stats_rollups = stats_rollups
+        self.engines = [create_engine(uri) for uri in uris]
+        self.directory = self.engines[0]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.engines),
+                                           thread_name_prefix="shard")
+
+    @property
+    def shard_count(self):
+        """ The number of shards """
+        return len(self.engines)
+
+    def shard_for_id(self, by_id):
+        """ Returns the index of the shard holding the customer or address id """
+        return int(by_id) % self.shard_count
+
+    def shard_for_username(self, username):
+        """ Returns the index of the shard a new customer is placed on """
+        return zlib.crc32(username.encode("utf-8")) % self.shard_count
+
+    ##################################################################
+    # Schema
+    ##################################################################
+
+    def create_all(self):
+        """ Creates the tables on every shard """
+        for engine in self.engines:
+            db.Model.metadata.create_all(engine, tables=SHARD_TABLES)
+            shard_metadata.create_all(engine, tables=[id_allocation])
+            create_search_indexes(engine)
+        shard_metadata.create_all(self.directory, tables=[username_directory])
+
+    def drop_all(self):
+        """ Drops the tables on every shard """
+        for engine in self.engines:
+            db.Model.metadata.drop_all(engine, tables=SHARD_TABLES)
+            shard_metadata.drop_all(engine)
+
+    def upgrade_schema(self):
+        """ Adds the new tables, columns and indexes to every shard """
+        changes = []
+        for shard, engine in enumerate(self.engines):
+            changes.extend("shard {}: {}".format(shard, change)
+                           for change in upgrade_schema(engine, SHARD_TABLES))
+            shard_metadata.create_all(engine, tables=[id_allocation])
+        shard_metadata.create_all(self.directory, tables=[username_directory])
+        return changes
+
+    def close(self):
+        """ Releases the threads and connections of the router """
+        self.executor.shutdown()
+        for engine in self.engines:
+            engine.dispose()
+
+    ##################################################################
+    # Helpers
+    ##################################################################
+
+    def _allocate_id(self, connection, shard):
+        """ Allocates a globally unique id on a shard """
+        local_id = connection.execute(id_allocation.insert()).inserted_primary_key[0]
+        return local_id * self.shard_count + shard
+
+    def _reserve_username(self, username, shard):
+        """ Records username in the directory or raises ResourceConflictError """
+        try:
+            with self.directory.begin() as connection:
+                connection.execute(username_directory.insert(),
+                                   {"username": username, "shard": shard})
+        except IntegrityError:
+            raise ResourceConflictError("Username '" + username + "' already exists.")
+
+    def _release_username(self, username):
+        with self.directory.begin() as connection:
+            connection.execute(username_directory.delete().where(
+                username_directory.c.username == username))
+
+    def _record_stats(self, connection, shard, delta):
+        """ Applies a StatsDelta to the rollup tables of a shard """
+        delta.apply(connection.execute, self.engines[shard].dialect.name)
+
+    def _write_document(self, connection, customer_id):
+        """ Rewrites the read model document of a changed customer in the transaction """
+        if self.read_model:
+            write_documents(connection.execute, [customer_id])
+
+    def _address_region(self, connection, customer_id, address_id):
+        """ Returns the (country, state) of an address or None """
+        row = connection.execute(select([address_table.c.country, address_table.c.state]).where(
+            address_table.c.address_id == address_id
+        ).where(address_table.c.customer_id == customer_id)).first()
+        return tuple(row) if row else None
+
+    def _touch_customer(self, connection, customer_id):
+        """ Marks a customer as changed when one of its addresses changes """
+        connection.execute(customer_table.update().where(customer_table.c.id == customer_id),
+                           {"updated_at": datetime.utcnow()})
+
+    def _fetch_changes(self, shard, since, until, limit):
+        with self.engines[shard].connect() as connection:
+            return fetch_changes(connection.execute, since, until, limit)
+
+    def _fetch_customers(self, shard, criteria=(), after=None, limit=None, sort="id",
+                         descending=False, fields=None):
+        """ Returns the CustomerRecords of one shard in the order of sort """
+        # the shards are merged in Python, they must sort the strings the way it compares them
+        collation = MERGE_COLLATIONS.get(self.engines[shard].dialect.name)
+        columns = projected_columns(fields, sort)
+        query = select([customer_table.c[name] for name in columns])
+        for criterion in criteria:
+            query = query.where(criterion)
+        if after is not None:
+            query = query.where(page_criteria(sort, descending, after, collation))
+        query = query.order_by(*page_order(sort, descending, collation))
+        if limit is not None:
+            query = query.limit(limit)
+        with self.engines[shard].connect() as connection:
+            customers = customer_records(connection.execute(query), columns)
+            if customers and (fields is None or "addresses" in fields):
+                by_id = {customer.id: customer for customer in customers}
+                addresses = select([address_table.c[name] for name in ADDRESS_COLUMNS]).where(
+                    address_table.c.customer_id.in_(list(by_id))
+                ).order_by(address_table.c.address_id)
+                for row in connection.execute(addresses):
+                    by_id[row[0]].addresses.append(AddressRecord(*row))
+        return customers
+
+    ##################################################################
+    # Customers
+    ##################################################################
+
+    def create_customer(self, data):
+        """
+        Creates a Customer with its addresses and returns its CustomerRecord
+
+        Args:
+            data (dict): the validated customer data, as accepted by Customer.deserialize
+        """
+        username = data["username"]
+        shard = self.shard_for_username(username)
+        self._reserve_username(username, shard)
+        try:
+            with self.engines[shard].begin() as connection:
+                customer_id = self._allocate_id(connection, shard)
+                values = {name: data.get(name) for name in CUSTOMER_FIELDS}
+                values["locked"] = bool(values["locked"])
+                connection.execute(customer_table.insert(), dict(values, id=customer_id))
+                addresses = data.get("addresses", [])
+                for address in addresses:
+                    self._insert_address(connection, shard, customer_id, address)
+                if self.stats_rollups:
+                    delta = StatsDelta()
+                    delta.customer(values["locked"], [(address.get("country"),
+                                                       address.get("state"))
+                                                      for address in addresses])
+                    self._record_stats(connection, shard, delta)
+                self._write_document(connection, customer_id)
+        except Exception:
+            self._release_username(username)
+            raise
+        logger.info("Created customer %s on shard %s", customer_id, shard)
+        return self.find_customer(customer_id)
+
+    def find_customer(self, customer_id):
+        """ Returns the CustomerRecord with the given id or None """
+        customers = self._fetch_customers(self.shard_for_id(customer_id),
+                                          [customer_table.c.id == customer_id])
+        return customers[0] if customers else None
+
+    def iter_usernames(self):
+        """ Streams all the usernames from the directory """
+        with self.directory.connect() as connection:
+            for row in connection.execute(select([username_directory.c.username])):
+                yield row[0]
+
+    def get_customers(self, customer_ids):
+        """ Returns the CustomerRecords with the given ids, asking every shard once """
+        by_shard = {}
+        for customer_id in set(customer_ids):
+            by_shard.setdefault(self.shard_for_id(customer_id), []).append(customer_id)
+        futures = [self.executor.submit(self._fetch_customers, shard,
+                                        [customer_table.c.id.in_(ids)])
+                   for shard, ids in by_shard.items()]
+        return [customer for future in futures for customer in future.result()]
+
+    def find_by_username(self, username):
+        """ Returns the CustomerRecord with the given username or None """
+        with self.directory.connect() as connection:
+            shard = connection.execute(select([username_directory.c.shard]).where(
+                username_directory.c.username == username)).scalar()
+        if shard is None:
+            return None
+        customers = self._fetch_customers(shard, [customer_table.c.username == username])
+        return customers[0] if customers else None
+
+    def update_customer(self, customer_id, data):
+        """ Updates the fields of a Customer present in data, returns False if not found """
+        customer = self.find_customer(customer_id)
+        if customer is None:
+            return False
+        new_username = data.get("username", customer.username)
+        if new_username != customer.username:
+            self._reserve_username(new_username, self.shard_for_id(customer_id))
+        values = {name: data[name] for name in CUSTOMER_FIELDS if name in data}
+        try:
+            shard = self.shard_for_id(customer_id)
+            with self.engines[shard].begin() as connection:
+                connection.execute(customer_table.update().where(
+                    customer_table.c.id == customer_id), values)
+                if self.stats_rollups and "locked" in values \
+                        and bool(values["locked"]) != bool(customer.locked):
+                    delta = StatsDelta()
+                    delta.lock(bool(values["locked"]))
+                    self._record_stats(connection, shard, delta)
+                self._write_document(connection, customer_id)
+        except Exception:
+            if new_username != customer.username:
+                self._release_username(new_username)
+            raise
+        if new_username != customer.username:
+            self._release_username(customer.username)
+        return True
+
+    def delete_customer(self, customer_id):
+        """ Deletes a Customer and its addresses """
+        customer = self.find_customer(customer_id)
+        if customer is None:
+            return
+        shard = self.shard_for_id(customer_id)
+        with self.engines[shard].begin() as connection:
+            connection.execute(address_table.delete().where(
+                address_table.c.customer_id == customer_id))
+            connection.execute(customer_table.delete().where(
+                customer_table.c.id == customer_id))
+            connection.execute(tombstone_table.insert(), {"customer_id": customer_id})
+            if self.stats_rollups:
+                delta = StatsDelta()
+                delta.customer(customer.locked, [(address.country, address.state)
+                                                 for address in customer.addresses], -1)
+                self._record_stats(connection, shard, delta)
+            self._write_document(connection, customer_id)
+        self._release_username(customer.username)
+
+    def list_customers(self, criteria=(), after_id=None, limit=None, sort="id",
+                       descending=False, after=None, fields=None):
+        """
+        Returns the CustomerRecords matching criteria from all shards in the order of sort
+
+        Args:
+            criteria (list): SQL expressions built with customer_criteria()
+            after_id (int): only return customers with a larger id (the page cursor)
+            limit (int): the maximum number of customers to return
+            sort (string): one of SORT_COLUMNS, ties are ordered by id
+            descending (bool): sort in descending order
+            after (tuple): the (sort value, id) of the last customer already seen
+            fields (tuple): only read these fields, see service.queries.find_customers
+        """
+        if after_id is not None:
+            after = (after_id, after_id)
+        futures = [self.executor.submit(self._fetch_customers, shard, criteria, after, limit,
+                                        sort, descending, fields)
+                   for shard in range(self.shard_count)]
+        merged = heapq.merge(*[future.result() for future in futures],
+                             key=lambda customer: (getattr(customer, sort), customer.id),
+                             reverse=descending)
+        if limit is None:
+            return list(merged)
+        return [customer for _, customer in zip(range(limit), merged)]
+
+    def _count_customers(self, shard, criteria, exact_below):
+        engine = self.engines[shard]
+        with engine.connect() as connection:
+            return fetch_customer_count(connection.execute, engine.dialect.name, criteria,
+                                        exact_below)
+
+    def count_customers(self, criteria=(), exact_below=10000):
+        """
+        Returns the number of customers matching criteria on all shards and its kind
+
+        The count is estimated when the count of any shard is
+        """
+        futures = [self.executor.submit(self._count_customers, shard, criteria, exact_below)
+                   for shard in range(self.shard_count)]
+        counts = [future.result() for future in futures]
+        kind = ESTIMATED_COUNT if any(k == ESTIMATED_COUNT for _, k in counts) else EXACT_COUNT
+        return sum(count for count, _ in counts), kind
+
+    def _count_lock_states(self, shard):
+        with self.engines[shard].connect() as connection:
+            return fetch_lock_counts(connection.execute)
+
+    def count_lock_states(self):
+        """ Returns the numbers of locked and unlocked customers of all shards """
+        counts = {"locked": 0, "unlocked": 0}
+        for future in [self.executor.submit(self._count_lock_states, shard)
+                       for shard in range(self.shard_count)]:
+            for state, count in future.result().items():
+                counts[state] += count
+        return counts
+
+    def _fetch_stats(self, shard):
+        with self.engines[shard].connect() as connection:
+            return fetch_stats(connection.execute, self.stats_rollups)
+
+    def customer_stats(self):
+        """
+        Returns the statistics of the customers of all shards
+
+        A customer and its addresses live on one shard, so the customers of a
+        region are the sum of the customers of the region on every shard
+        """
+        futures = [self.executor.submit(self._fetch_stats, shard)
+                   for shard in range(self.shard_count)]
+        totals, regions = [0, 0, 0], {}
+        for future in futures:
+            shard_totals, shard_regions = future.result()
+            totals = [total + value for total, value in zip(totals, shard_totals)]
+            for country, state, customers, addresses in shard_regions:
+                counts = regions.setdefault((country, state), [0, 0])
+                counts[0] += customers
+                counts[1] += addresses
+        return stats_document(*totals, [region + tuple(counts)
+                                        for region, counts in regions.items()])
+
+    def rebuild_stats(self):
+        """ Recomputes the rollup tables of every shard """
+        for engine in self.engines:
+            with engine.begin() as connection:
+                rebuild_stats_tables(connection.execute, engine.dialect.name)
+
+    def find_document(self, customer_id):
+        """ Returns the stored JSON text of a customer or None """
+        with self.engines[self.shard_for_id(customer_id)].connect() as connection:
+            return fetch_stored_document(connection.execute, customer_id)
+
+    def _fetch_documents(self, shard, criteria):
+        with self.engines[shard].connect() as connection:
+            return fetch_stored_documents(connection.execute, criteria)
+
+    def list_documents(self, criteria=()):
+        """ Returns the JSON text of an array of the stored documents of all shards in id order """
+        futures = [self.executor.submit(self._fetch_documents, shard, criteria)
+                   for shard in range(self.shard_count)]
+        merged = heapq.merge(*[future.result() for future in futures])
+        return "[" + ", ".join(document for _, document in merged) + "]"
+
+    def check_documents(self):
+        """ Compares the stored documents of every shard with its customers """
+        report = {"checked": 0, "missing": [], "stale": [], "orphaned": []}
+        for engine in self.engines:
+            for key, value in check_documents(engine).items():
+                report[key] += value
+        return {key: sorted(value) if isinstance(value, list) else value
+                for key, value in report.items()}
+
+    def rebuild_documents(self):
+        """ Rewrites the stored documents of every shard, returns how many changed """
+        return sum(rebuild_documents(engine) for engine in self.engines)
+
+    @property
+    def searches_in_database(self):
+        """ True when every shard runs the full-text search of Postgres """
+        return all(engine.dialect.name == "postgresql" for engine in self.engines)
+
+    def _search(self, shard, words, limit):
+        with self.engines[shard].connect() as connection:
+            return fetch_search(connection.execute, words, limit, 0)
+
+    def search_customers(self, words, limit, offset=0):
+        """ Returns one page of (rank, CustomerRecord) pairs of all shards, best first """
+        futures = [self.executor.submit(self._search, shard, words, offset + limit)
+                   for shard in range(self.shard_count)]
+        merged = heapq.merge(*[future.result() for future in futures],
+                             key=lambda result: (-result[0], result[1].id))
+        return [result for _, result in zip(range(offset + limit), merged)][offset:]
+
+    def list_changes(self, since=None, until=None, limit=100):
+        """ Returns up to limit Changes of all shards in feed order """
+        futures = [self.executor.submit(self._fetch_changes, shard, since, until, limit)
+                   for shard in range(self.shard_count)]
+        merged = heapq.merge(*[future.result() for future in futures],
+                             key=lambda change: change.key)
+        return [change for _, change in zip(range(limit), merged)]
+
+    ##################################################################
+    # Addresses
+    ##################################################################
+
+    def _insert_address(self, connection, shard, customer_id, data):
+        address_id = self._allocate_id(connection, shard)
+        values = {name: data.get(name) for name in ADDRESS_FIELDS}
+        connection.execute(address_table.insert(),
+                           dict(values, address_id=address_id, customer_id=customer_id))
+        return address_id
+
+    def create_address(self, customer_id, data):
+        """ Creates an Address for a Customer and returns its AddressRecord """
+        shard = self.shard_for_id(customer_id)
+        with self.engines[shard].begin() as connection:
+            address_id = self._insert_address(connection, shard, customer_id, data)
+            self._touch_customer(connection, customer_id)
+            if self.stats_rollups:
+                delta = StatsDelta()
+                delta.address(connection.execute, customer_id, address_id,
+                              new_region=(data.get("country"), data.get("state")))
+                self._record_stats(connection, shard, delta)
+            self._write_document(connection, customer_id)
+        return self.find_address(customer_id, address_id)
+
+    def find_address(self, customer_id, address_id):
+        """ Returns the AddressRecord of a Customer or None """
+        query = select([address_table.c[name] for name in ADDRESS_COLUMNS]).where(
+            address_table.c.address_id == address_id
+        ).where(address_table.c.customer_id == customer_id)
+        with self.engines[self.shard_for_id(customer_id)].connect() as connection:
+            row = connection.execute(query).first()
+        return AddressRecord(*row) if row else None
+
+    def update_address(self, customer_id, address_id, data):
+        """ Updates an Address of a Customer """
+        values = {name: data[name] for name in ADDRESS_FIELDS if name in data}
+        shard = self.shard_for_id(customer_id)
+        with self.engines[shard].begin() as connection:
+            old_region = None
+            if self.stats_rollups:
+                old_region = self._address_region(connection, customer_id, address_id)
+            connection.execute(address_table.update().where(
+                address_table.c.address_id == address_id
+            ).where(address_table.c.customer_id == customer_id), values)
+            self._touch_customer(connection, customer_id)
+            if old_region is not None:
+                delta = StatsDelta()
+                delta.address(connection.execute, customer_id, address_id, old_region,
+                              (values.get("country", old_region[0]),
+                               values.get("state", old_region[1])))
+                self._record_stats(connection, shard, delta)
+            self._write_document(connection, customer_id)
+
+    def delete_address(self, customer_id, address_id):
+        """ Deletes an Address of a Customer """
+        shard = self.shard_for_id(customer_id)
+        with self.engines[shard].begin() as connection:
+            old_region = None
+            if self.stats_rollups:
+                old_region = self._address_region(connection, customer_id, address_id)
+            deleted = connection.execute(address_table.delete().where(
+                address_table.c.address_id == address_id
+            ).where(address_table.c.customer_id == customer_id)).rowcount
+            if deleted:
+                self._touch_customer(connection, customer_id)
+                if self.stats_rollups:
+                    delta = StatsDelta()
+                    delta.address(connection.execute, customer_id, address_id,
+                                  old_region=old_region)
+                    self._record_stats(connection, shard, delta)
+                self._write_document(connection, customer_id)
+
+
+class ShardedRepository(CustomerRepository):
+    """ Stores the Customers on the shards of a ShardRouter """
+
+    def __init__(self, router):
+        self.router = router
+
+    def create_customer(self, data):
+        values = Customer().deserialize(data).serialize()
+        values["locked"] = False
+        return self.router.create_customer(values)
+
+    def find_customer(self, customer_id, fields=None):
+        return self.router.find_customer(customer_id)
+
+    def find_by_username(self, username):
+        return self.router.find_by_username(username)
+
+    def iter_usernames(self):
+        return self.router.iter_usernames()
+
+    def get_customers(self, customer_ids):
+        return self.router.get_customers(customer_ids)
+
+    def search_customers(self, words, limit, offset=0):
+        if not self.router.searches_in_database:
+            return super().search_customers(words, limit, offset)
+        return self.router.search_customers(words, limit, offset)
+
+    def list_customers(self, username=None, first_name=None, last_name=None,
+                       prefix_username=None, locked=None, sort=None, descending=False,
+                       after=None, limit=None, fields=None):
+        # the shards are merged in id order unless sorted otherwise
+        return self.router.list_customers(
+            customer_criteria(username, first_name, last_name, prefix_username, locked),
+            limit=limit, sort=sort or "id", descending=descending, after=after, fields=fields
+        )
+
+    def customer_stats(self):
+        return self.router.customer_stats()
+
+    def rebuild_stats(self):
+        self.router.rebuild_stats()
+
+    def count_customers(self, username=None, first_name=None, last_name=None,
+                        prefix_username=None, locked=None):
+        return self.router.count_customers(
+            customer_criteria(username, first_name, last_name, prefix_username, locked),
+            current_app.config.get("EXACT_COUNT_BELOW", 10000)
+        )
+
+    def count_lock_states(self):
+        return self.router.count_lock_states()
+
+    def update_customer(self, customer_id, values):
+        if not self.router.update_customer(customer_id, values):
+            return None
+        return self.router.find_customer(customer_id)
+
+    def set_locked(self, customer_id, locked):
+        return self.update_customer(customer_id, {"locked": locked})
+
+    def delete_customer(self, customer_id):
+        self.router.delete_customer(customer_id)
+
+    def create_address(self, customer_id, data):
+        if self.router.find_customer(customer_id) is None:
+            return None
+        values = Address().deserialize(data).serialize()
+        return self.router.create_address(customer_id, values)
+
+    def find_address(self, customer_id, address_id):
+        return self.router.find_address(customer_id, address_id)
+
+    def update_address(self, customer_id, address_id, data):
+        if self.router.find_address(customer_id, address_id) is None:
+            return None
+        values = Address().deserialize(data).serialize()
+        self.router.update_address(customer_id, address_id, values)
+        return self.router.find_address(customer_id, address_id)
+
+    def delete_address(self, customer_id, address_id):
+        self.router.delete_address(customer_id, address_id)
+
+    def list_changes(self, since=None, until=None, limit=100):
+        return self.router.list_changes(since, until, limit)
+
+    def supports_documents(self):
+        return self.router.read_model and read_model_enabled()
+
+    def customer_document(self, customer_id):
+        return self.router.find_document(customer_id)
+
+    def customer_documents(self, username=None, first_name=None, last_name=None,
+                           prefix_username=None, locked=None):
+        # pylint: disable=arguments-differ
+        return self.router.list_documents(
+            customer_criteria(username, first_name, last_name, prefix_username, locked)
+        )
+
+    def upgrade_schema(self):
+        changes = self.router.upgrade_schema()
+        # the existing customers were never counted in the rollups
+        self.router.rebuild_stats()
+        return changes
+
+    def check_documents(self):
+        return self.router.check_documents()
+
+    def rebuild_documents(self):
+        return self.router.rebuild_documents()
@@ -0,0 +1,93 @@
+"""
+Tuned SQLite for single node deployments
+
+The models and queries only use portable SQL, so the service runs on SQLite
+by pointing DATABASE_URI at a file (``sqlite:////var/lib/customers.db``).
+With SQLITE_TUNED every new SQLite connection is configured for a small
+server instead of SQLite's conservative defaults:
+
+  journal_mode=WAL    readers no longer block the writer and the writer no
+                      longer blocks readers
+  synchronous=NORMAL  the WAL is synced at checkpoints instead of on every
+                      commit, a power loss may lose the last commits but
+                      never corrupts the database
+  mmap_size           reads are served from memory mapped pages
+  busy_timeout        a writer waits for the lock instead of failing
+  foreign_keys        addresses must belong to a customer, as on Postgres
+
+The PRAGMAs run once per new connection of the application's engine, which
+keeps up to SQLITE_POOL_SIZE connections open in a QueuePool (the pool
+SQLAlchemy 2.0 picks for SQLite files) shared by the threads serving requests.
+Other engines, such as the shards or a bench database, keep their own settings.
+"""
+import logging
+import weakref
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app")
+
+# The PRAGMAs run on every new connection of the tuned engines
+_engine_pragmas = weakref.WeakKeyDictionary()
+
+
+def is_sqlite(uri):
+    """ Returns True when uri is a SQLite database URI """
+    return (uri or "").startswith("sqlite")
+
+
+def is_tuned(app):
+    """ Returns True when the SQLite database of app is tuned """
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+    return is_sqlite(uri) and app.config.get("SQLITE_TUNED", True)
+
+
+def sqlite_pragmas(app):
+    """ Returns the PRAGMA statements configured for app """
+    return [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA mmap_size={:d}".format(app.config.get("SQLITE_MMAP_SIZE", 256 * 2 ** 20)),
+        "PRAGMA busy_timeout={:d}".format(app.config.get("SQLITE_BUSY_TIMEOUT", 5000)),
+        "PRAGMA foreign_keys=ON",
+    ]
+
+
+def configure_sqlite(app):
+    """ Chooses the pool of the SQLite engine of app, call before the engine is created """
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+    if not is_tuned(app):
+        return
+    logger.info("Tuning SQLite for %s", uri)
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    if ":memory:" not in uri and uri.rstrip("/") != "sqlite:":
+        options.setdefault("poolclass", QueuePool)
+        options.setdefault("pool_size", app.config.get("SQLITE_POOL_SIZE", 32))
+        # a pooled connection is used by one thread at a time, whichever it is
+        connect_args = dict(options.get("connect_args") or {})
+        connect_args.setdefault("check_same_thread", False)
+        options["connect_args"] = connect_args
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+def tune_sqlite(app, engine):
+    """ Applies the PRAGMAs configured for app to every new connection of engine """
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = sqlite_pragmas(app) if is_tuned(app) else []
+    if engine in _engine_pragmas:
+        # the engine is reused by a later init_db(), keep a single listener
+        _engine_pragmas[engine][:] = pragmas
+        return
+    _engine_pragmas[engine] = pragmas
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        """ Applies the configured PRAGMAs to a new SQLite connection """
+        # pylint: disable=unused-argument
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
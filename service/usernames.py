@@ -0,0 +1,490 @@
+"""
+In-memory username indexes for the Customer service
+
+Signup forms check whether a username is free on every keystroke. Every
+worker keeps a UsernameFilter, a Bloom filter of all the usernames built in
+the background at startup from the repository (with USERNAME_FILTER) and
+told about every new username: a name the
+filter never saw is definitely free and only the names it may have seen are
+looked up in the database.
+
+A Bloom filter cannot forget, so the usernames of deleted and renamed
+customers stay in it and merely cost a database lookup. The filter is
+rebuilt in the background once more names were added than it was sized for,
+and whenever the invalidation bus of service.cache may have missed a new
+username; until the rebuild is done every check goes to the database.
+
+Username autocomplete is served by a UsernameIndex (with USERNAME_INDEX),
+one sorted copy of all the usernames per worker packed into a single
+bytearray with an array of offsets. A prefix search is a binary search followed by a short scan, a few
+microseconds even for millions of names. At 10M usernames of 12 bytes on
+average the index takes about 160 MB per worker (12 bytes of text and a 4
+byte offset per name), 680 MB if every name had the maximal 64 bytes, and
+USERNAME_INDEX_MAX_USERNAMES caps it: beyond the cap the index is not built
+and the searches go to the database. Building it sorts all the usernames as
+Python bytes objects, about 150 bytes per name for the few seconds it takes;
+it is built in the background and the searches go to the database until it
+is ready.
+
+New, renamed and deleted usernames arrive through the invalidation bus and
+go to a small sorted delta next to the array. Once the delta holds
+USERNAME_INDEX_MERGE_AT names it is merged into a new array in the
+background, which streams the old array and needs no more memory than the
+new one. Prefixes are matched case insensitively for ASCII letters only.
+"""
+import bisect
+import hashlib
+import logging
+import math
+import threading
+from array import array
+from heapq import merge
+from service.cache import bus
+
+logger = logging.getLogger("flask.app")
+
+
+class BloomFilter:
+    """
+    A set of strings answering "definitely not present" or "maybe present"
+
+    Args:
+        capacity (int): the number of strings the filter is sized for
+        error_rate (float): the false positive rate at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing: two 64 bit halves of one digest give all the positions
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """ Adds a string to the filter """
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def expected_error_rate(self):
+        """ The false positive rate expected for the strings added so far """
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    @property
+    def memory(self):
+        """ The size of the bit array in bytes """
+        return len(self.bits)
+
+
+class UsernameFilter:
+    """
+    The Bloom filter of the usernames of one worker and its maintenance
+
+    Args:
+        load (function): returns an iterable of all the usernames
+        capacity (int): the initial capacity of the filter
+        error_rate (float): the false positive rate at capacity
+    """
+
+    def __init__(self, load, capacity=1000000, error_rate=0.01):
+        self.load = load
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filter = None
+        self._lock = threading.Lock()
+        self._building = False
+        self._pending = []  # usernames added while a rebuild runs
+        self.builds = 0
+        self.free = 0
+        self.confirmed = 0
+        self.false_positives = 0
+        self.unfiltered = 0
+
+    def build(self):
+        """ Builds a new filter from all the usernames and starts using it """
+        with self._lock:
+            self._building = True
+        capacity = self.capacity
+        while True:
+            bloom = BloomFilter(capacity, self.error_rate)
+            for username in self.load():
+                bloom.add(username)
+                if bloom.count > capacity:
+                    break
+            else:
+                break
+            capacity *= 4
+        with self._lock:
+            for username in self._pending:
+                bloom.add(username)
+            self._pending = []
+            self.capacity = capacity
+            self._filter = bloom
+            self._building = False
+            self.builds += 1
+        logger.info("Username filter built with %d names in %d bytes", bloom.count, bloom.memory)
+        return bloom
+
+    def rebuild_in_background(self):
+        """ Starts rebuilding the filter unless a rebuild is running """
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+            self._filter = None
+            self._pending = []
+        threading.Thread(target=self._rebuild, name="username-filter", daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            self.build()
+        except Exception as error:  # checks go to the database until the next attempt
+            logger.error("Username filter rebuild failed: %s", error)
+            with self._lock:
+                self._building = False
+
+    def add(self, username):
+        """ Tells the filter about a new username """
+        with self._lock:
+            if self._building:
+                self._pending.append(username)
+            bloom = self._filter
+            if bloom is None:
+                return
+            bloom.add(username)
+            full = bloom.count > bloom.capacity
+        if full:
+            self.capacity = bloom.capacity * 2
+            self.rebuild_in_background()
+
+    def invalidate(self, customer_id=None):
+        """ Rebuilds the filter after new usernames may have been missed """
+        # pylint: disable=unused-argument
+        self.rebuild_in_background()
+
+    def is_taken(self, username, lookup):
+        """
+        Returns whether a username is taken and what answered
+
+        Args:
+            username (string): the username to check
+            lookup (function): returns True when the database has the username
+        """
+        bloom = self._filter
+        if bloom is not None and username not in bloom:
+            self.free += 1
+            return False, "filter"
+        taken = lookup(username)
+        if bloom is None:
+            self.unfiltered += 1
+        elif taken:
+            self.confirmed += 1
+        else:
+            self.false_positives += 1
+        return taken, "database"
+
+    def metrics(self):
+        """ Returns the size of the filter and how well it answered """
+        bloom = self._filter
+        free = self.free + self.false_positives
+        return {
+            "usernames": bloom.count if bloom is not None else 0,
+            "capacity": bloom.capacity if bloom is not None else 0,
+            "memory_bytes": bloom.memory if bloom is not None else 0,
+            "hashes": bloom.hashes if bloom is not None else 0,
+            "expected_false_positive_rate":
+                round(bloom.expected_error_rate, 5) if bloom is not None else 0.0,
+            "false_positive_rate": round(self.false_positives / free, 5) if free else 0.0,
+            "answered_by_filter": self.free,
+            "confirmed_taken": self.confirmed,
+            "false_positives": self.false_positives,
+            "unfiltered": self.unfiltered,
+            "builds": self.builds,
+            "building": self._building,
+        }
+
+
+class SortedNames:
+    """
+    Usernames ordered case insensitively in one bytearray
+
+    Args:
+        names (iterable): the UTF-8 encoded usernames in index order
+    """
+
+    def __init__(self, names=()):
+        self.blob = bytearray()
+        self.offsets = array("I", [0])  # up to 4 GiB of usernames
+        for name in names:
+            self.blob += name
+            self.offsets.append(len(self.blob))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        return bytes(self.blob[self.offsets[position]:self.offsets[position + 1]])
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def bisect(self, key):
+        """ Returns the position of the first name not ordered before the lowercase key """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle].lower() < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, name):
+        position = self.bisect(name.lower())
+        while position < len(self):
+            found = self[position]
+            if found == name:
+                return True
+            if found.lower() != name.lower():
+                return False
+            position += 1
+        return False
+
+    @property
+    def memory(self):
+        """ The size of the text and of the offsets in bytes """
+        return len(self.blob) + self.offsets.itemsize * len(self.offsets)
+
+
+def _order(name):
+    return name.lower(), name
+
+
+class UsernameIndex:
+    """
+    The sorted usernames of one worker for prefix searches
+
+    Args:
+        load (function): returns an iterable of all the usernames
+        max_usernames (int): the most usernames the index holds
+        merge_at (int): the size of the delta that is merged into the array
+    """
+
+    def __init__(self, load, max_usernames=10000000, merge_at=10000):
+        self.load = load
+        self.max_usernames = max_usernames
+        self.merge_at = merge_at
+        self._names = None
+        self._added = []  # sorted (lowercase, name) pairs missing from _names
+        self._removed = set()  # names in _names that are gone
+        self._journal = None  # changes made while a build runs
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.merges = 0
+        self.searches = 0
+        self.unindexed = 0
+
+    def build(self):
+        """ Builds the index from all the usernames and starts using it """
+        with self._lock:
+            if self._journal is None:
+                self._journal = []
+        names = []
+        for name in self.load():
+            if len(names) == self.max_usernames:
+                logger.warning("More than %d usernames, autocomplete goes to the database",
+                               self.max_usernames)
+                names = None
+                break
+            names.append(name.encode("utf-8"))
+        if names is not None:
+            names.sort(key=bytes.lower)
+            names = SortedNames(names)
+        self._install(names)
+        self.builds += 1
+        if names is not None:
+            logger.info("Username index built with %d names in %d bytes", len(names), names.memory)
+        return names
+
+    def _merge(self, names, added, removed):
+        # streams the old array, the memory of the new one is all it takes
+        kept = (name for name in names if name not in removed)
+        self._install(SortedNames(merge(kept, (name for _, name in added), key=bytes.lower)))
+        self.merges += 1
+
+    def _install(self, names):
+        with self._lock:
+            self._names = names
+            self._added = []
+            self._removed = set()
+            journal, self._journal = self._journal, None
+            for change, name in journal:
+                change(name)
+
+    def _start(self, target, *args):
+        """ Runs a build or a merge unless one is running, recording the changes meanwhile """
+        with self._lock:
+            if self._journal is not None:
+                return
+            self._journal = []
+        threading.Thread(target=self._run, args=(target,) + args, name="username-index",
+                         daemon=True).start()
+
+    def _run(self, target, *args):
+        try:
+            target(*args)
+        except Exception as error:  # the index stays as it was until the next attempt
+            logger.error("Username index update failed: %s", error)
+            with self._lock:
+                self._journal = None
+
+    def rebuild_in_background(self):
+        """ Starts rebuilding the index from the repository """
+        self._start(self.build)
+
+    def _merge_if_full(self):
+        if len(self._added) + len(self._removed) >= self.merge_at and self._journal is None:
+            self._journal = []
+            names, added, removed = self._names, list(self._added), set(self._removed)
+            threading.Thread(target=self._run, args=(self._merge, names, added, removed),
+                             name="username-index", daemon=True).start()
+
+    def _add(self, name):
+        if self._names is None:
+            return
+        if name in self._names:
+            self._removed.discard(name)
+            return
+        position = bisect.bisect_left(self._added, _order(name))
+        if position == len(self._added) or self._added[position][1] != name:
+            self._added.insert(position, _order(name))
+
+    def _remove(self, name):
+        if self._names is None:
+            return
+        position = bisect.bisect_left(self._added, _order(name))
+        if position < len(self._added) and self._added[position][1] == name:
+            del self._added[position]
+        elif name in self._names:
+            self._removed.add(name)
+
+    def add(self, username):
+        """ Tells the index about a new username """
+        self._change(self._add, username)
+
+    def remove(self, username):
+        """ Tells the index about a username that is no longer used """
+        self._change(self._remove, username)
+
+    def _change(self, change, username):
+        name = username.encode("utf-8")
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((change, name))
+            change(name)
+            self._merge_if_full()
+
+    def invalidate(self, customer_id=None):
+        """ Rebuilds the index after changes may have been missed """
+        # pylint: disable=unused-argument
+        self.rebuild_in_background()
+
+    def search(self, prefix, limit=10):
+        """
+        Returns the first usernames starting with prefix in index order,
+        or None while there is no index
+
+        Args:
+            prefix (string): the start of the usernames, matched case insensitively
+            limit (int): the most usernames to return
+        """
+        key = prefix.encode("utf-8").lower()
+        with self._lock:
+            names, added, removed = self._names, self._added, self._removed
+            if names is None:
+                self.unindexed += 1
+                return None
+            self.searches += 1
+            found = []
+            position = names.bisect(key)
+            while len(found) < limit and position < len(names):
+                name = names[position]
+                if not name.lower().startswith(key):
+                    break
+                if name not in removed:
+                    found.append(_order(name))
+                position += 1
+            position = bisect.bisect_left(added, (key,))
+            for lowered, name in added[position:position + limit]:
+                if not lowered.startswith(key):
+                    break
+                found.append((lowered, name))
+        return [name.decode("utf-8") for _, name in sorted(found)[:limit]]
+
+    def metrics(self):
+        """ Returns the size of the index and how it answered """
+        names = self._names
+        return {
+            "usernames": len(names) - len(self._removed) + len(self._added)
+                         if names is not None else 0,
+            "memory_bytes": names.memory if names is not None else 0,
+            "delta": len(self._added) + len(self._removed),
+            "max_usernames": self.max_usernames,
+            "searches": self.searches,
+            "unindexed": self.unindexed,
+            "builds": self.builds,
+            "merges": self.merges,
+            "updating": self._journal is not None,
+        }
+
+
+def create_username_filter(app, repository):
+    """ Starts building the username filter of this worker and subscribes it to the bus """
+    # pylint: disable=redefined-outer-name
+
+    def load():
+        with app.app_context():
+            yield from repository.iter_usernames()
+
+    username_filter = UsernameFilter(load, app.config.get("USERNAME_FILTER_CAPACITY", 1000000),
+                                     app.config.get("USERNAME_FILTER_ERROR_RATE", 0.01))
+    # the checks go to the database until the first build is done
+    username_filter.rebuild_in_background()
+    bus.subscribe(lambda customer_id: None, username_filter.invalidate)
+    bus.subscribe_usernames(username_filter.add)
+    return username_filter
+
+
+def create_username_index(app, repository):
+    """ Starts building the username index of this worker and subscribes it to the bus """
+    # pylint: disable=redefined-outer-name
+
+    def load():
+        with app.app_context():
+            yield from repository.iter_usernames()
+
+    username_index = UsernameIndex(load, app.config.get("USERNAME_INDEX_MAX_USERNAMES", 10000000),
+                                   app.config.get("USERNAME_INDEX_MERGE_AT", 10000))
+    # the searches go to the database until the first build is done
+    username_index.rebuild_in_background()
+    bus.subscribe(lambda customer_id: None, username_index.invalidate)
+    bus.subscribe_usernames(username_index.add, username_index.remove)
+    return username_index
@@ -0,0 +1,71 @@
+"""
+Test cases for response compression
+
+"""
+import gzip
+import logging
+import unittest
+from flask import Response
+from service.routes import app
+from service.compression import compress_response
+
+LARGE_BODY = b'[' + b', '.join([b'{"country": "United States", "state": "NY"}'] * 100) + b']'
+
+######################################################################
+#  C O M P R E S S I O N   T E S T   C A S E S
+######################################################################
+class TestCompression(unittest.TestCase):
+    """ Test Cases for compress_response """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+
+    def _compress(self, response, accept_encoding="gzip"):
+        """ Runs compress_response for a request accepting accept_encoding """
+        with app.test_request_context(headers={"Accept-Encoding": accept_encoding}):
+            return compress_response(response)
+
+    def test_compress_large_response(self):
+        """ Compress a large JSON response with gzip """
+        resp = self._compress(Response(LARGE_BODY, mimetype="application/json"))
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertLess(len(resp.get_data()), len(LARGE_BODY))
+        self.assertEqual(int(resp.headers["Content-Length"]), len(resp.get_data()))
+        self.assertEqual(gzip.decompress(resp.get_data()), LARGE_BODY)
+
+    def test_skip_small_response(self):
+        """ Small responses are not compressed """
+        resp = self._compress(Response(b'{"id": 1}', mimetype="application/json"))
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_data(), b'{"id": 1}')
+
+    def test_skip_not_accepted(self):
+        """ Responses are not compressed when the client does not accept it """
+        resp = self._compress(Response(LARGE_BODY, mimetype="application/json"), "identity")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp = self._compress(Response(LARGE_BODY, mimetype="image/png"))
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_compress_streamed_response(self):
+        """ Compress a streamed response chunk by chunk """
+        chunks = [LARGE_BODY[i:i + 500] for i in range(0, len(LARGE_BODY), 500)]
+        resp = self._compress(Response(iter(chunks), mimetype="application/json"))
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", resp.headers)
+        compressed = list(resp.response)
+        self.assertGreater(len(compressed), 1)
+        self.assertEqual(gzip.decompress(b"".join(compressed)), LARGE_BODY)
+
+    def test_compress_disabled(self):
+        """ Compression can be turned off """
+        app.config["COMPRESS_ENABLED"] = False
+        try:
+            resp = self._compress(Response(LARGE_BODY, mimetype="application/json"))
+        finally:
+            app.config["COMPRESS_ENABLED"] = True
+        self.assertNotIn("Content-Encoding", resp.headers)
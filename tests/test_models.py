@@ -7,7 +7,9 @@ import unittest
 import os
 import json
 from service import app
-from service.models import Customer, Address, DataValidationError, db
+from sqlalchemy import text
+from service.models import Customer, Address, DataValidationError, db, batched_commits, \
+    upgrade_schema
 from werkzeug.exceptions import NotFound
 from tests.factories import CustomerFactory, AddressFactory
 
@@ -501,3 +503,56 @@ class TestYourResourceModel(unittest.TestCase):
         self.assertEqual(len(customers), 1)
         self.assertEqual(customers[0].id, 1)
         self.assertEqual(customers[0].locked, False)
+
+    def test_batched_commits(self):
+        """ Create several customers with a single commit """
+        with batched_commits():
+            for _ in range(3):
+                customer = CustomerFactory()
+                customer.create()
+                self.assertIsNotNone(customer.id)
+            self.assertTrue(db.session.info["batched"])
+        self.assertNotIn("batched", db.session.info)
+        db.session.remove()
+        self.assertEqual(len(Customer.all()), 3)
+
+    def test_batched_commits_rollback(self):
+        """ A failing batch creates nothing """
+        with self.assertRaises(DataValidationError):
+            with batched_commits():
+                CustomerFactory().create()
+                raise DataValidationError("bad customer")
+        self.assertEqual(Customer.all(), [])
+
+    def test_upgrade_schema(self):
+        """ Add the new columns, indexes and tables to an old database """
+        db.session.remove()
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE customer (id INTEGER PRIMARY KEY, "
+                "username VARCHAR(64) NOT NULL UNIQUE, password VARCHAR(64) NOT NULL, "
+                "first_name VARCHAR(32) NOT NULL, last_name VARCHAR(32) NOT NULL, locked BOOLEAN)"
+            ))
+            connection.execute(text(
+                "CREATE TABLE address (customer_id INTEGER NOT NULL REFERENCES customer (id), "
+                "address_id INTEGER PRIMARY KEY, street_address VARCHAR(100) NOT NULL, "
+                "city VARCHAR(100) NOT NULL, state VARCHAR(100) NOT NULL, "
+                "zipcode VARCHAR(100) NOT NULL, country VARCHAR(100) NOT NULL)"
+            ))
+            connection.execute(text(
+                "INSERT INTO customer VALUES (1, 'jdoe', 'secret', 'John', 'Doe', false)"
+            ))
+        changes = upgrade_schema(db.engine)
+        self.assertIn("added column customer.created_at", changes)
+        self.assertIn("added column address.updated_at", changes)
+        self.assertIn("created index ix_customer_last_name_id", changes)
+        self.assertIn("created index ix_customer_locked_id", changes)
+        self.assertIn("created table customer_tombstone", changes)
+        customer = Customer.find(1)
+        self.assertIsNotNone(customer.created_at)
+        self.assertEqual(customer.created_at, customer.updated_at)
+        self.assertEqual(upgrade_schema(db.engine), [])
+        result = app.test_cli_runner().invoke(args=["upgrade-db"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Upgraded the database with 0 changes", result.output)
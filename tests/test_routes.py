@@ -7,12 +7,14 @@ Test cases can be run with the following:
 """
 import os
 import json
+import gzip
 import logging
-from unittest import TestCase
+from unittest import TestCase, skipIf
 from urllib.parse import quote_plus
 from werkzeug.exceptions import NotFound
 from unittest.mock import MagicMock, patch
 from service import status  # HTTP Status Codes
+from service.serializers import msgpack
 from service.models import db, Customer, Address
 from service.routes import app
 from tests.factories import CustomerFactory, AddressFactory
@@ -30,6 +32,7 @@ if 'VCAP_SERVICES' in os.environ:
     vcap = json.loads(os.environ['VCAP_SERVICES'])
     DATABASE_URI = vcap['user-provided'][0]['credentials']['url']
 CONTENT_TYPE_JSON="application/json"
+CONTENT_TYPE_MSGPACK="application/msgpack"
 
 ######################################################################
 #  T E S T   C A S E S
@@ -143,6 +146,18 @@ class TestYourResourceServer(TestCase):
          resp = self.app.post(BASE_API)
          self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_create_customer_content_type_parameters(self):
+        """ Create a Customer with a parameterised content type """
+        test_customer = CustomerFactory()
+        resp = self.app.post(
+            BASE_API, data=json.dumps(test_customer.serialize()),
+            content_type="Application/JSON; charset=utf-8"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn("Accept", resp.headers["Vary"])
+        resp = self.app.post(BASE_API, data="{}", content_type="text/plain; charset=utf-8")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_create_customer_address(self):
         """ Create a new address for a customer """
         test_customer = CustomerFactory()
@@ -568,6 +583,52 @@ class TestYourResourceServer(TestCase):
         for cust in data:
             self.assertEqual(cust["username"], test_prefix_username)
 
+    def test_list_sorted(self):
+        """ List customers sorted by a field, ties by id """
+        customers = [customer.serialize() for customer in self._create_customers(8)]
+        for sort in ("username", "last_name", "first_name", "id"):
+            for order in ("asc", "desc"):
+                resp = self.app.get(BASE_API, query_string={"sort": sort, "order": order})
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                expected = sorted(customers, key=lambda c: (c[sort], c["id"]),
+                                  reverse=order == "desc")
+                self.assertEqual([c["id"] for c in resp.get_json()],
+                                 [c["id"] for c in expected])
+
+    def test_list_keyset_pages(self):
+        """ Page through a sorted list with the Link headers """
+        customers = self._create_customers(7)
+        for customer in customers[:4]:
+            customer.last_name = "Doe"  # ties are ordered by id
+            resp = self.app.put("{}/{}".format(BASE_API, customer.id), json=customer.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        url, pages = BASE_API + "?sort=last_name&order=desc&limit=3", []
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            pages.append([customer["id"] for customer in resp.get_json()])
+            link = resp.headers.get("Link")
+            url = link[link.index("<") + 1:link.index(">")] if link else None
+        expected = sorted(customers, key=lambda c: (c.last_name, c.id), reverse=True)
+        self.assertEqual(sum(pages, []), [customer.id for customer in expected])
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        resp = self.app.get(BASE_API, query_string={"limit": 7})
+        self.assertEqual([c["id"] for c in resp.get_json()], sorted(c.id for c in customers))
+        self.assertIn("rel=\"next\"", resp.headers["Link"])
+
+    def test_list_pages_bad_request(self):
+        """ Reject invalid sorts, orders, limits and cursors """
+        self._create_customers(2)
+        resp = self.app.get(BASE_API, query_string={"sort": "username", "limit": 1})
+        cursor = resp.headers["Link"].split("after=")[1].split(">")[0]
+        for query in ({"sort": "password"}, {"order": "up"}, {"limit": 0}, {"limit": 1001},
+                      {"after": "nonsense"}, {"sort": "last_name", "after": cursor},
+                      {"offset": 1}):
+            resp = self.app.get(BASE_API, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+        resp = self.app.get(BASE_API, query_string={"sort": "username", "after": cursor})
+        self.assertEqual(len(resp.get_json()), 1)
+
     def test_query_customer_list_by_last_name(self):
         """ Query customers by last name """
         customers = self._create_customers(10)
@@ -774,4 +835,203 @@ class TestYourResourceServer(TestCase):
             json={},
             content_type = CONTENT_TYPE_JSON,
         )
-        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_query_customer_list_by_lock_state(self):
+        """ List the locked or the unlocked customers and count them """
+        customers = self._create_customers(5)
+        for customer in customers[:2]:
+            resp = self.app.put("{}/{}/lock".format(BASE_API, customer.id))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_API, query_string={"locked": "true"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(c["id"] for c in resp.get_json()),
+                         sorted(c.id for c in customers[:2]))
+        resp = self.app.get(BASE_API, query_string={"locked": "false", "sort": "id"})
+        self.assertEqual([c["id"] for c in resp.get_json()], [c.id for c in customers[2:]])
+        self.assertTrue(all(not c["locked"] for c in resp.get_json()))
+        resp = self.app.get(BASE_API + "/locks")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"locked": 2, "unlocked": 3})
+        for query in ("locked=maybe", "locked=true&q=smith"):
+            resp = self.app.get(BASE_API + "?" + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_customer_stats(self):
+        """ Return the rolled up statistics of the customers """
+        self.addCleanup(app.config.__setitem__, "STATS_ROLLUPS", False)
+        app.config["STATS_ROLLUPS"] = True
+        customers = self._create_customers(2)
+        self.app.put("{}/{}/lock".format(BASE_API, customers[0].id))
+        resp = self.app.get(BASE_API + "/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = resp.get_json()
+        self.assertEqual((stats["customers"], stats["locked"], stats["unlocked"]), (2, 1, 1))
+        self.assertEqual(stats["locked_ratio"], 0.5)
+        self.assertEqual(sum(region["addresses"] for region in stats["regions"]),
+                         stats["addresses"])
+        result = app.test_cli_runner().invoke(args=["rebuild-stats"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("2 customers", result.output)
+        self.assertEqual(self.app.get(BASE_API + "/stats").get_json(), stats)
+
+    def test_list_total_count(self):
+        """ Return the number of matching customers when asked to """
+        customers = self._create_customers(4)
+        resp = self.app.get(BASE_API, query_string={"limit": 2, "count": "true"})
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertEqual(resp.headers["X-Total-Count"], "4")
+        self.assertEqual(resp.headers["X-Total-Count-Kind"], "exact")
+        self.assertIn("Link", resp.headers)
+        resp = self.app.get(BASE_API, query_string={"last_name": customers[0].last_name,
+                                                    "count": "true"})
+        self.assertEqual(resp.headers["X-Total-Count"], str(len(resp.get_json())))
+        resp = self.app.get(BASE_API)
+        self.assertNotIn("X-Total-Count", resp.headers)
+        resp = self.app.get(BASE_API, query_string={"q": "smith", "count": "true"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_head_customer_count(self):
+        """ HEAD the customer list for its count only """
+        customers = self._create_customers(3)
+        self.app.put("{}/{}/lock".format(BASE_API, customers[0].id))
+        resp = self.app.head(BASE_API)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["X-Total-Count"], "3")
+        self.assertEqual(resp.headers["X-Total-Count-Kind"], "exact")
+        resp = self.app.head(BASE_API, query_string={"locked": "true"})
+        self.assertEqual(resp.headers["X-Total-Count"], "1")
+        for query in ("q=smith", "sort=id", "nonsense=1"):
+            resp = self.app.head(BASE_API + "?" + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_list_sparse_fieldset(self):
+        """ List only the requested fields of the customers """
+        customers = self._create_customers(3, always_has_address=True)
+        resp = self.app.get(BASE_API, query_string={"fields": "username,id,locked"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"username": c.username, "id": c.id, "locked": False}
+                                           for c in customers])
+        resp = self.app.get(BASE_API, query_string={"fields": "addresses", "sort": "username",
+                                                    "limit": 2})
+        self.assertEqual([list(c) for c in resp.get_json()], [["addresses"]] * 2)
+        self.assertTrue(all(c["addresses"] for c in resp.get_json()))
+        self.assertIn("Link", resp.headers)
+        resp = self.app.get(BASE_API, query_string={"fields": "id,secret"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_sparse_fieldset(self):
+        """ Get only the requested fields of a customer """
+        customer = self._create_customers(1)[0]
+        resp = self.app.get("{}/{}".format(BASE_API, customer.id),
+                            query_string={"fields": "first_name"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"first_name": customer.first_name})
+        resp = self.app.get("{}/{}".format(BASE_API, customer.id), query_string={"fields": "x"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("{}/0".format(BASE_API), query_string={"fields": "id"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_customer_with_fields_mask(self):
+        """ Get a single Customer with a fields mask """
+        test_customer = self._create_customers(1)[0]
+        resp = self.app.get(
+            "{0}/{1}".format(BASE_API, test_customer.id), headers={"X-Fields": "id,username"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"id": test_customer.id, "username": test_customer.username})
+
+    def test_get_customer_list_compressed(self):
+        """ Get a list of Customers compressed with gzip """
+        self._create_customers(10, always_has_address = True)
+        resp = self.app.get(BASE_API)
+        resp_gzip = self.app.get(BASE_API, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp_gzip.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp_gzip.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(resp_gzip.data), resp.data)
+
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_customer_msgpack(self):
+        """ Create and get a Customer using MessagePack """
+        test_customer = CustomerFactory()
+        test_customer.addresses = [AddressFactory()]
+        resp = self.app.post(
+            BASE_API, data=msgpack.packb(test_customer.serialize()),
+            content_type=CONTENT_TYPE_MSGPACK + "; v=1", headers={"Accept": CONTENT_TYPE_MSGPACK}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.content_type, CONTENT_TYPE_MSGPACK)
+        self.assertIn("Accept", resp.headers["Vary"])
+        new_customer = msgpack.unpackb(resp.data)
+        self.assertEqual(new_customer["username"], test_customer.username)
+        self.assertEqual(new_customer["addresses"][0]["city"], test_customer.addresses[0].city)
+
+        resp = self.app.get(BASE_API, headers={"Accept": CONTENT_TYPE_MSGPACK})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(msgpack.unpackb(resp.data), [new_customer])
+        resp = self.app.get(BASE_API, headers={"Accept": CONTENT_TYPE_JSON})
+        self.assertEqual(resp.get_json(), [new_customer])
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_create_customer_bad_msgpack(self):
+        """ Create a Customer with an invalid MessagePack body """
+        resp = self.app.post(BASE_API, data=b"\xc1", content_type=CONTENT_TYPE_MSGPACK)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_changes(self):
+        """ Page through the change feed """
+        self.addCleanup(app.config.__setitem__, "CHANGES_SETTLE_SECONDS",
+                        app.config["CHANGES_SETTLE_SECONDS"])
+        app.config["CHANGES_SETTLE_SECONDS"] = 0
+        customers = self._create_customers(3)
+        resp = self.app.delete("{}/{}".format(BASE_API, customers[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(BASE_API + "/changes", query_string={"limit": 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        page = resp.get_json()
+        self.assertEqual([change["id"] for change in page["changes"]],
+                         [customers[1].id, customers[2].id])
+        self.assertEqual(page["changes"][0]["type"], "upsert")
+        self.assertEqual(page["changes"][0]["customer"]["username"], customers[1].username)
+        resp = self.app.get(BASE_API + "/changes", query_string={"since": page["next"]})
+        page = resp.get_json()
+        self.assertEqual(page["changes"], [{
+            "type": "delete", "id": customers[0].id,
+            "changed_at": page["changes"][0]["changed_at"], "customer": None
+        }])
+        resp = self.app.get(BASE_API + "/changes", query_string={"since": page["next"]})
+        self.assertEqual(resp.get_json(), {"changes": [], "next": page["next"]})
+
+    def test_batch_get(self):
+        """ Get many customers in request order """
+        customers = self._create_customers(3, always_has_address=True)
+        ids = [customers[2].id, 0, customers[0].id]
+        resp = self.app.post(BASE_API + ":batchGet", json={"ids": ids})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        entries = resp.get_json()["customers"]
+        self.assertEqual([entry["id"] for entry in entries], ids)
+        self.assertEqual([entry["found"] for entry in entries], [True, False, True])
+        self.assertIsNone(entries[1]["customer"])
+        self.assertEqual(entries[0]["customer"]["username"], customers[2].username)
+        self.assertEqual(len(entries[2]["customer"]["addresses"]), len(customers[0].addresses))
+
+    def test_batch_get_bad_request(self):
+        """ Reject invalid batch requests """
+        for body in ({}, {"ids": "1,2"}, {"ids": [1, "2"]}, {"ids": [True]}, [1, 2]):
+            resp = self.app.post(BASE_API + ":batchGet", json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_API + ":batchGet", json={"ids": list(range(501))})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_API + ":batchGet", data="ids=1")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_list_changes_bad_request(self):
+        """ Reject invalid change feed cursors and limits """
+        resp = self.app.get(BASE_API + "/changes", query_string={"since": "yesterday"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_API + "/changes", query_string={"limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_API + "/changes", query_string={"after": 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
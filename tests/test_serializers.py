@@ -0,0 +1,93 @@
+"""
+Test cases for the compiled serializers
+
+"""
+import json
+import logging
+import unittest
+from flask_restx import marshal
+from service.routes import app, customer_model, address_model, change_feed_model, \
+    autocomplete_model
+from service.models import Customer, Address, DataValidationError
+from service.serializers import compile_serializer, compile_converter, \
+    requested_fields, msgpack, cbor2
+from tests.factories import CustomerFactory, AddressFactory
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(unittest.TestCase):
+    """ Test Cases for the compiled serializers """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+
+    def _assert_same_as_marshal(self, data, model):
+        """ The compiled serializer must match marshal + json.dumps """
+        expected = json.dumps(marshal(data, model))
+        self.assertEqual(compile_serializer(model)(data), expected)
+
+    def test_serialize_customer(self):
+        """ Serialize a Customer with addresses """
+        customer = CustomerFactory()
+        customer.addresses = [AddressFactory(customer_id=customer.id), AddressFactory()]
+        self._assert_same_as_marshal(customer, customer_model)
+        self._assert_same_as_marshal(customer.serialize(), customer_model)
+
+    def test_serialize_escaped_strings(self):
+        """ Serialize strings that need escaping """
+        customer = Customer(id=7, username="üml\"aut\\\n\U0001F600", password="p",
+                            first_name="Zoë", last_name="O'Neil", locked=True,
+                            addresses=[Address(street_address="1 Rue é\t", city="c",
+                                               state="s", zipcode="z", country="k")])
+        self._assert_same_as_marshal(customer, customer_model)
+
+    def test_serialize_missing_values(self):
+        """ Serialize objects with missing values """
+        self._assert_same_as_marshal(Customer(), customer_model)
+        self._assert_same_as_marshal({}, customer_model)
+        self._assert_same_as_marshal(Address(), address_model)
+        self._assert_same_as_marshal({"addresses": None}, customer_model)
+
+    def test_serialize_change_feed(self):
+        """ Serialize nested objects that may be null """
+        customer = CustomerFactory()
+        customer.addresses = [AddressFactory()]
+        feed = {"changes": [{"type": "upsert", "id": 1, "changed_at": "t", "customer": customer},
+                            {"type": "delete", "id": 2, "changed_at": "t", "customer": None}],
+                "next": "1-2"}
+        self._assert_same_as_marshal(feed, change_feed_model)
+        self.assertEqual(compile_converter(change_feed_model)(feed),
+                         marshal(feed, change_feed_model))
+
+    def test_serialize_string_list(self):
+        """ Serialize lists of strings """
+        data = {"prefix": "al", "usernames": ["alan", "ålice\""], "searched_by": "index"}
+        self._assert_same_as_marshal(data, autocomplete_model)
+        self._assert_same_as_marshal({"usernames": None}, autocomplete_model)
+        self.assertEqual(compile_converter(autocomplete_model)(data),
+                         marshal(data, autocomplete_model))
+
+    def test_convert_customer(self):
+        """ Convert a Customer to the same python values as marshal """
+        customer = CustomerFactory()
+        customer.addresses = [AddressFactory(customer_id=customer.id)]
+        self.assertEqual(compile_converter(customer_model)(customer),
+                         marshal(customer, customer_model))
+        self.assertEqual(compile_converter(customer_model)({}), marshal({}, customer_model))
+
+    def test_requested_fields(self):
+        """ Read the sparse fieldset of a request in model order """
+        with app.test_request_context("/?fields=locked,%20id,username,id"):
+            self.assertEqual(requested_fields(customer_model),
+                             tuple(key for key in customer_model.resolved
+                                   if key in ("username", "id", "locked")))
+        with app.test_request_context("/"):
+            self.assertIsNone(requested_fields(customer_model))
+        for query in ("fields=", "fields=id,secret", "fields=,"):
+            with app.test_request_context("/?" + query):
+                self.assertRaises(DataValidationError, requested_fields, customer_model)
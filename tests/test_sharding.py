@@ -0,0 +1,144 @@
+"""
+Test cases for the Customer shard router
+
+Several local databases stand in for the shards. Set SHARD_DATABASE_URIS to
+a comma separated list of database URIs to run against other databases.
+"""
+import os
+import logging
+import tempfile
+import unittest
+from service import app
+from service.models import ResourceConflictError
+from service.queries import customer_criteria
+from service.sharding import ShardRouter
+from tests.factories import CustomerFactory, AddressFactory
+
+SHARD_DIR = tempfile.mkdtemp()
+SHARD_DATABASE_URIS = [uri for uri in os.getenv("SHARD_DATABASE_URIS", "").split(",") if uri] or [
+    "sqlite:///" + os.path.join(SHARD_DIR, "shard{}.db".format(i)) for i in range(3)
+]
+
+######################################################################
+#  S H A R D   R O U T E R   T E S T   C A S E S
+######################################################################
+class TestShardRouter(unittest.TestCase):
+    """ Test Cases for ShardRouter """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.logger.setLevel(logging.CRITICAL)
+        cls.router = ShardRouter(SHARD_DATABASE_URIS)
+
+    @classmethod
+    def tearDownClass(cls):
+        """ This runs once after the entire test suite """
+        cls.router.close()
+
+    def setUp(self):
+        """ This runs before each test """
+        self.router.drop_all()
+        self.router.create_all()
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.router.drop_all()
+
+    def _create_customers(self, count, addresses=1):
+        """ Creates customers through the router """
+        customers = []
+        for _ in range(count):
+            data = CustomerFactory().serialize()
+            data["addresses"] = [AddressFactory().serialize() for _ in range(addresses)]
+            customers.append(self.router.create_customer(data))
+        return customers
+
+    def test_create_customer(self):
+        """ Create customers on several shards with unique ids """
+        customers = self._create_customers(12)
+        ids = [customer.id for customer in customers]
+        self.assertEqual(len(set(ids)), 12)
+        self.assertGreater(len({self.router.shard_for_id(i) for i in ids}), 1)
+        for customer in customers:
+            self.assertEqual(self.router.find_customer(customer.id).username, customer.username)
+            address = customer.addresses[0]
+            self.assertEqual(self.router.shard_for_id(address.address_id),
+                             self.router.shard_for_id(customer.id))
+
+    def test_username_is_unique(self):
+        """ Usernames stay unique across shards """
+        customer = self._create_customers(1)[0]
+        data = CustomerFactory().serialize()
+        data["username"] = customer.username
+        self.assertRaises(ResourceConflictError, self.router.create_customer, data)
+        other = self._create_customers(1)[0]
+        self.assertRaises(ResourceConflictError, self.router.update_customer,
+                          other.id, {"username": customer.username})
+
+    def test_find_by_username(self):
+        """ Find a customer through the username directory """
+        customers = self._create_customers(5)
+        self.assertEqual(self.router.find_by_username(customers[3].username).id, customers[3].id)
+        self.assertIsNone(self.router.find_by_username("nobody"))
+        self.router.update_customer(customers[3].id, {"username": "renamed"})
+        self.assertEqual(self.router.find_by_username("renamed").id, customers[3].id)
+        self.assertIsNone(self.router.find_by_username(customers[3].username))
+
+    def test_list_customers_with_keyset_pagination(self):
+        """ List customers of all shards page by page """
+        customers = self._create_customers(10)
+        expected = sorted(customer.id for customer in customers)
+        self.assertEqual([c.id for c in self.router.list_customers()], expected)
+        pages, cursor = [], None
+        while True:
+            page = self.router.list_customers(after_id=cursor, limit=3)
+            if not page:
+                break
+            pages.append([customer.id for customer in page])
+            cursor = page[-1].id
+        self.assertEqual(pages[0], expected[:3])
+        self.assertEqual(sum(pages, []), expected)
+        found = self.router.list_customers(customer_criteria(username=customers[4].username))
+        self.assertEqual([c.id for c in found], [customers[4].id])
+
+    def test_list_customers_sorted_by_mixed_case_names(self):
+        """ Merge and page the shards in the same order whatever the case of the names """
+        names = ["adams", "Baker", "baker", "Zimmer", "Éclair", "eve", "_under", "Adams", "zoe"]
+        customers = []
+        for name in names:
+            data = CustomerFactory().serialize()
+            data["last_name"] = name
+            customers.append(self.router.create_customer(data))
+        self.assertGreater(len({self.router.shard_for_id(c.id) for c in customers}), 1)
+        for descending in (False, True):
+            expected = sorted(((c.last_name, c.id) for c in customers), reverse=descending)
+            found = self.router.list_customers(sort="last_name", descending=descending)
+            self.assertEqual([(c.last_name, c.id) for c in found], expected)
+            pages, after = [], None
+            while True:
+                page = self.router.list_customers(sort="last_name", descending=descending,
+                                                  after=after, limit=2)
+                if not page:
+                    break
+                pages.extend((c.last_name, c.id) for c in page)
+                after = (page[-1].last_name, page[-1].id)
+            self.assertEqual(pages, expected)
+
+    def test_delete_customer(self):
+        """ Delete a customer and free its username """
+        customer = self._create_customers(1)[0]
+        self.router.delete_customer(customer.id)
+        self.assertIsNone(self.router.find_customer(customer.id))
+        self.assertIsNone(self.router.find_by_username(customer.username))
+        self.router.delete_customer(customer.id)
+
+    def test_addresses(self):
+        """ Create, update and delete addresses on the customer's shard """
+        customer = self._create_customers(1, addresses=0)[0]
+        address = self.router.create_address(customer.id, AddressFactory().serialize())
+        self.assertEqual(address.customer_id, customer.id)
+        self.router.update_address(customer.id, address.address_id, {"city": "Gotham"})
+        self.assertEqual(self.router.find_address(customer.id, address.address_id).city, "Gotham")
+        self.router.delete_address(customer.id, address.address_id)
+        self.assertIsNone(self.router.find_address(customer.id, address.address_id))
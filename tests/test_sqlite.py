@@ -0,0 +1,93 @@
+"""
+Test cases for the tuned SQLite mode
+
+"""
+import os
+import tempfile
+import threading
+import unittest
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from service.sqlite import configure_sqlite, tune_sqlite, is_sqlite
+
+######################################################################
+#  S Q L I T E   T E S T   C A S E S
+######################################################################
+class TestSqliteTuning(unittest.TestCase):
+    """ Test Cases for the SQLite tuning """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.app = Flask(__name__)
+        self.path = os.path.join(tempfile.mkdtemp(), "tuned.db")
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + self.path
+
+    def _engine(self):
+        """ Creates the engine of the app the way Flask-SQLAlchemy does """
+        options = self.app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        engine = create_engine(self.app.config["SQLALCHEMY_DATABASE_URI"], **options)
+        self.addCleanup(engine.dispose)
+        tune_sqlite(self.app, engine)
+        return engine
+
+    def test_is_sqlite(self):
+        """ Recognize SQLite URIs """
+        self.assertTrue(is_sqlite("sqlite:////tmp/customers.db"))
+        self.assertTrue(is_sqlite("sqlite://"))
+        self.assertFalse(is_sqlite("postgres://postgres@localhost/postgres"))
+        self.assertFalse(is_sqlite(None))
+
+    def test_tuned_connections(self):
+        """ New SQLite connections use WAL and the configured PRAGMAs """
+        self.app.config["SQLITE_MMAP_SIZE"] = 2 ** 20
+        configure_sqlite(self.app)
+        options = self.app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+        self.assertIs(options["poolclass"], QueuePool)
+        engine = self._engine()
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(connection.execute("PRAGMA synchronous").scalar(), 1)
+            self.assertEqual(connection.execute("PRAGMA mmap_size").scalar(), 2 ** 20)
+            self.assertEqual(connection.execute("PRAGMA foreign_keys").scalar(), 1)
+        # the connection is returned to the pool and reused by other threads
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            engine.execute("PRAGMA synchronous").scalar()))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [1])
+        self.assertEqual(engine.pool.checkedin(), 1)
+
+    def test_other_engines_untouched(self):
+        """ Only the engine of the app is tuned """
+        configure_sqlite(self.app)
+        self._engine()
+        other = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "other.db"))
+        self.addCleanup(other.dispose)
+        with other.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "delete")
+            self.assertEqual(connection.execute("PRAGMA foreign_keys").scalar(), 0)
+
+    def test_tune_engine_again(self):
+        """ Tuning an engine twice keeps one listener with the last settings """
+        engine = self._engine()
+        self.app.config["SQLITE_MMAP_SIZE"] = 2 ** 21
+        tune_sqlite(self.app, engine)
+        self.assertEqual(len(engine.pool.dispatch.connect), 1)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA mmap_size").scalar(), 2 ** 21)
+
+    def test_untuned_connections(self):
+        """ SQLITE_TUNED=False keeps the SQLite defaults """
+        self.app.config["SQLITE_TUNED"] = False
+        configure_sqlite(self.app)
+        self.assertNotIn("SQLALCHEMY_ENGINE_OPTIONS", self.app.config)
+        with self._engine().connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "delete")
+
+    def test_memory_database(self):
+        """ In-memory databases keep the pool chosen by Flask-SQLAlchemy """
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        configure_sqlite(self.app)
+        self.assertNotIn("poolclass", self.app.config["SQLALCHEMY_ENGINE_OPTIONS"])